@@ -15,6 +15,7 @@ class Config(config_dict.ConfigDict):
 
     Attributes:
         data_dir: str, path to the data directory
+        tmp_dir: str, path to the directory of the figures and images of the report
         manual_seg_filepath: str, path to the manual segmentation nifti file
         remove_contamination: bool, whether to remove gas contamination
         remove_noisy_projections: bool, whether to remove noisy projections
@@ -32,6 +33,7 @@ class Config(config_dict.ConfigDict):
         """Initialize config parameters."""
         super().__init__()
         self.data_dir = ""
+        self.tmp_dir = "tmp"
         self.manual_seg_filepath = ""
         self.processes = Process()
         self.recon = Recon()
@@ -54,13 +56,26 @@ class Process(object):
         oscillation_mapping_recon: bool, whether to perform oscillation mapping
             with reconstruction
         oscillation_mapping_readin: bool, whether to perform oscillation mapping
-            by reading in the mat file
+            by reading in the subject file
+        checkpoint_stages: bool, whether to save the outputs of each stage and only
+            recompute the stages whose inputs or code changed. Bump
+            checkpoint_utils.CHECKPOINT_VERSION for changes outside of the code
+        cache_raw_data: bool, whether to cache the data read from the raw files so
+            that later runs do not parse them again, up to raw_cache.MAX_CACHE_BYTES
+        dynamic_spectroscopy: bool, whether to fit every FID of the breath-hold of
+            the dynamic spectroscopy
+        export_mat: bool, whether to write the subject to a mat file as well as to
+            the subject store, for tools that read the mat file
     """
 
     def __init__(self):
         """Initialize the process parameters."""
         self.oscillation_mapping_recon = True
         self.oscillation_mapping_readin = False
+        self.checkpoint_stages = False
+        self.cache_raw_data = False
+        self.dynamic_spectroscopy = False
+        self.export_mat = False
 
 
 class Recon(object):
@@ -74,6 +89,16 @@ class Recon(object):
         n_skip_start: int, the number of frames to skip at the beginning
         n_skip_end: int, the number of frames to skip at the end
         key_radius: int, the key radius for the keyhole image
+        binning_method: str, the method to preprocess the RBC k0 signal for binning,
+            see constants.BinningMethods
+        distance_threshold: float, the fraction of the cardiac cycle around each
+            peak that is binned
+        bin_selection: str, the method to select the high and low bins, windows
+            around the peaks or bins of the cardiac phase, see
+            constants.BinningMethods
+        autotune: bool, reconstruct with the fastest engine for this machine
+        autotune_tolerance: float, maximum relative error of the tuned engine to the
+            reference engine
     """
 
     def __init__(self):
@@ -84,8 +109,13 @@ class Recon(object):
         self.n_skip_end = 0
         self.key_radius = 9
         self.key_radius_pct = 0.3
+        self.binning_method = constants.BinningMethods.BANDPASS
+        self.distance_threshold = 0.2
+        self.bin_selection = constants.BinningMethods.PEAKS
         self.recon_size = 128
         self.recon_proton = False
+        self.autotune = False
+        self.autotune_tolerance = 0.01
 
 
 class Params(object):
@@ -95,6 +125,10 @@ class Params(object):
         threshold_oscillation: np.ndarray, the oscillation amplitude thresholds for
             binning
         threshold_rbc: np.ndarray, the RBC thresholds for binning
+        n_avg_dynamic_spectroscopy: int, the number of FIDs in the sliding average
+            of the dynamic spectroscopy fit
+        n_workers_dynamic_spectroscopy: int, the number of processes of the dynamic
+            spectroscopy fit. 0 to share the cpus among the subjects run at once
     """
 
     def __init__(self):
@@ -108,6 +142,8 @@ class Params(object):
             [-2.02, 0.53, 3.66, 7.63, 12.99, 21.07, 35.56]
         )
         self.threshold_rbc = np.array([0.066, 0.250, 0.453, 0.675, 0.956]) / 2.0
+        self.n_avg_dynamic_spectroscopy = 1
+        self.n_workers_dynamic_spectroscopy = 0
 
 
 class Dose(object):
@@ -1,99 +1,188 @@
 """Scripts to run oscillation mapping pipeline."""
 import logging
+import os
 import pdb
+from typing import Any, Dict
 
 from absl import app, flags
 from ml_collections import config_flags
 
 from config import base_config
 from subject_classmap import Subject
+from utils import recon_utils
 
 FLAGS = flags.FLAGS
 
 _CONFIG = config_flags.DEFINE_config_file("config", None, "config file.")
 flags.DEFINE_boolean("force_recon", False, "force reconstruction for the subject")
-flags.DEFINE_boolean("force_readin", False, "force read in .mat for the subject")
+flags.DEFINE_boolean("force_readin", False, "force read in of the subject file")
 flags.DEFINE_bool("force_segmentation", False, "run segmentation again.")
+flags.DEFINE_integer(
+    "n_stage_workers",
+    0,
+    "number of independent pipeline stages run at once. 0 to choose from the "
+    "number of cpus and the memory of the machine.",
+)
 
+# stages of a subject worth running at the same time
+_MAX_STAGE_WORKERS = 4
 
-def oscillation_mapping_reconstruction(config: base_config.Config):
+
+def get_n_stage_workers(config: base_config.Config, n_stage_workers: int = 0) -> int:
+    """Get the number of pipeline stages of a subject to run at the same time.
+
+    Args:
+        config (config_dict.ConfigDict): config dict
+        n_stage_workers (int): number of stage workers, 0 to choose from the number
+            of cpus and the memory of the machine.
+    Returns:
+        int: number of stage workers.
+    """
+    if n_stage_workers > 0:
+        return n_stage_workers
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    n_recons = memory // recon_utils.estimate_recon_memory(config.recon.recon_size)
+    return int(max(1, min(os.cpu_count() or 1, _MAX_STAGE_WORKERS, n_recons)))
+
+
+def get_n_fit_workers(
+    config: base_config.Config, n_stage_workers: int, n_subject_workers: int = 1
+) -> int:
+    """Get the number of processes of the dynamic spectroscopy fit.
+
+    The fit runs after the raw files are read, while no other stage of the subject
+    runs, so it may use the share of the cpus of the subject, and at least as many
+    processes as the subject has stage workers.
+
+    Args:
+        config (config_dict.ConfigDict): config dict
+        n_stage_workers (int): number of stage workers of the subject.
+        n_subject_workers (int): number of subjects run at once.
+    Returns:
+        int: number of processes.
+    """
+    if config.params.n_workers_dynamic_spectroscopy > 0:
+        return int(config.params.n_workers_dynamic_spectroscopy)
+    n_cpus = (os.cpu_count() or 1) // max(n_subject_workers, 1)
+    return max(n_stage_workers, n_cpus, 1)
+
+
+def oscillation_mapping_reconstruction(
+    config: base_config.Config,
+    n_stage_workers: int = 0,
+    write_stats: bool = True,
+    n_subject_workers: int = 1,
+) -> Dict[str, Any]:
     """Run the oscillation mapping pipeline with reconstruction.
 
     Args:
         config (config_dict.ConfigDict): config dict
+        n_stage_workers (int): number of stage workers, see get_n_stage_workers.
+        write_stats (bool): append the statistics to the csv of all subjects.
+        n_subject_workers (int): number of subjects run at once, see
+            get_n_fit_workers.
+    Returns:
+        Dict[str, Any]: statistics of the subject.
     """
+    n_stage_workers = get_n_stage_workers(config, n_stage_workers)
+    config.params.n_workers_dynamic_spectroscopy = get_n_fit_workers(
+        config, n_stage_workers, n_subject_workers
+    )
     subject = Subject(config=config)
-    try:
-        subject.read_twix_files()
-    except:
-        subject.read_mrd_files()
-    logging.info("Getting RBC:M ratio from static spectroscopy.")
-    subject.calculate_rbc_m_ratio()
+    logging.info("Reading files and getting RBC:M ratio from static spectroscopy.")
+    subject.read_files()
     logging.info("Reconstructing images")
     subject.preprocess()
+    stages = []
     if config.recon.recon_proton:
-        subject.reconstruction_ute()
-    subject.reconstruction_gas()
-    subject.reconstruction_dissolved()
-    subject.reconstruction_rbc_oscillation()
-    logging.info("Segmenting Proton Mask")
-    subject.segmentation()
-    subject.save_subject_to_mat()
-    subject.dixon_decomposition()
-    subject.dissolved_analysis()
-    subject.dissolved_binning()
-    subject.oscillation_analysis()
-    subject.oscillation_binning()
-    subject.get_statistics()
-    subject.write_stats_to_csv()
-    subject.generate_figures()
-    subject.generate_pdf()
-    subject.save_files()
+        stages.append("reconstruction_ute")
+    stages += [
+        "reconstruction_gas",
+        "reconstruction_dissolved",
+        "reconstruction_rbc_oscillation",
+        "segmentation",
+        "save_subject",
+        "dixon_decomposition",
+        "dissolved_analysis",
+        "dissolved_binning",
+        "oscillation_analysis",
+        "oscillation_binning",
+        "get_statistics",
+        "write_stats_to_csv",
+        "generate_figures",
+        "generate_pdf",
+        "save_files",
+    ]
+    if not write_stats:
+        stages.remove("write_stats_to_csv")
+    subject.run_stages(stages, max_workers=n_stage_workers)
     logging.info("Complete")
+    return subject.stats_dict
 
 
-def oscillation_mapping_readin(config: base_config.Config):
-    """Run the oscillation imaging pipeline by reading in .mat file.
+def oscillation_mapping_readin(
+    config: base_config.Config,
+    n_stage_workers: int = 0,
+    force_segmentation: bool = False,
+    write_stats: bool = True,
+) -> Dict[str, Any]:
+    """Run the oscillation imaging pipeline by reading in the subject file.
 
     Args:
         config (config_dict.ConfigDict): config dict
+        n_stage_workers (int): number of stage workers, see get_n_stage_workers.
+        force_segmentation (bool): segment the proton mask again.
+        write_stats (bool): append the statistics to the csv of all subjects.
+    Returns:
+        Dict[str, Any]: statistics of the subject.
     """
     subject = Subject(config=config)
-    subject.read_mat_file()
-    if FLAGS.force_segmentation:
+    subject.read_subject_file()
+    stages = []
+    if force_segmentation:
         logging.info("Segmenting Proton Mask")
-        subject.segmentation()
-    subject.save_subject_to_mat()
-    subject.dixon_decomposition()
-    subject.dissolved_analysis()
-    subject.dissolved_binning()
-    subject.oscillation_analysis()
-    subject.oscillation_binning()
-    subject.get_statistics()
-    subject.write_stats_to_csv()
-    subject.generate_figures()
-    subject.generate_pdf()
+        # only the new mask is written to the subject store
+        stages += ["segmentation", "save_subject"]
+    stages += [
+        "dixon_decomposition",
+        "dissolved_analysis",
+        "dissolved_binning",
+        "oscillation_analysis",
+        "oscillation_binning",
+        "get_statistics",
+        "write_stats_to_csv",
+        "generate_figures",
+        "generate_pdf",
+    ]
+    if not write_stats:
+        stages.remove("write_stats_to_csv")
+    subject.run_stages(stages, max_workers=get_n_stage_workers(config, n_stage_workers))
     logging.info("Complete")
+    return subject.stats_dict
 
 
 def main(argv):
     """Run the oscillation imaging pipeline.
 
-    Either run the reconstruction or read in the .mat file.
+    Either run the reconstruction or read in the subject file.
     """
     config = _CONFIG.value
     if FLAGS.force_recon:
         logging.info("Oscillation imaging mapping with reconstruction.")
-        oscillation_mapping_reconstruction(config)
+        oscillation_mapping_reconstruction(config, FLAGS.n_stage_workers)
     elif FLAGS.force_readin:
         logging.info("Oscillation imaging mapping with reconstruction.")
-        oscillation_mapping_readin(config)
+        oscillation_mapping_readin(
+            config, FLAGS.n_stage_workers, FLAGS.force_segmentation
+        )
     elif config.processes.oscillation_mapping_recon:
         logging.info("Oscillation imaging mapping with reconstruction.")
-        oscillation_mapping_reconstruction(config)
+        oscillation_mapping_reconstruction(config, FLAGS.n_stage_workers)
     elif config.processes.oscillation_mapping_readin:
         logging.info("Oscillation imaging mapping with reconstruction.")
-        oscillation_mapping_readin(config)
+        oscillation_mapping_readin(
+            config, FLAGS.n_stage_workers, FLAGS.force_segmentation
+        )
     else:
         pass
 
@@ -3,13 +3,9 @@
 import pdb
 from typing import Literal, Tuple
 
-import matplotlib
-from matplotlib import pyplot as plt
-
-matplotlib.use("TkAgg")
 import numpy as np
 
-from utils import constants, signal_utils
+from utils import cardiac_tracker, constants, signal_utils
 
 
 def bin_rbc_oscillations(
@@ -18,6 +14,8 @@ def bin_rbc_oscillations(
     TR: float,
     rbc_m_ratio: float,
     method: str = constants.BinningMethods.BANDPASS,
+    distance_threshold: float = 0.2,
+    bin_selection: str = constants.BinningMethods.PEAKS,
 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, float, float]:
     """Bin dissolved phase data into high and low signal bins.
 
@@ -27,6 +25,10 @@ def bin_rbc_oscillations(
         TR: repetition time in seconds
         rbc_m_ratio: RBC:m ratio
         method: method to use for binning
+        distance_threshold: fraction of the cardiac cycle around each peak that is
+            binned, see signal_utils.find_high_low_indices.
+        bin_selection: method to select the high and low bins from the processed
+            signal, see signal_utils.find_high_low_indices.
     Returns:
         Tuple of detrendend data, high and low signal indices respectively.
     """
@@ -62,7 +64,10 @@ def bin_rbc_oscillations(
     heart_rate = signal_utils.get_heartrate(data_rbc_k0_proc, ts=TR)
     # bin data to high and low signal bins
     high_indices, low_indices = signal_utils.find_high_low_indices(
-        data=data_rbc_k0_proc, peak_distance=int((60 / heart_rate) / TR)
+        data=data_rbc_k0_proc,
+        peak_distance=int((60 / heart_rate) / TR),
+        distance_threshold=distance_threshold,
+        method=bin_selection,
     )
     # calculate the mean RBC:m ratio for high and low signal bins
     rbc_m_high = np.abs(
@@ -72,3 +77,45 @@ def bin_rbc_oscillations(
         np.mean(data_rbc_k0[low_indices]) / np.mean(data_membrane_k0[low_indices])
     )
     return data_rbc_k0_proc, high_indices, low_indices, rbc_m_high, rbc_m_low
+
+
+def bin_rbc_oscillations_streaming(
+    data_gas: np.ndarray,
+    data_dissolved: np.ndarray,
+    TR: float,
+    rbc_m_ratio: float,
+    block_size: int = 1,
+) -> Tuple[np.ndarray, np.ndarray, float]:
+    """Bin dissolved phase data into high and low signal bins as it arrives.
+
+    Feeds the k0 of the projections to a causal cardiac tracker in blocks, as during
+    the acquisition. Unlike bin_rbc_oscillations, the bins are not forced to be of
+    the same length.
+
+    Args:
+        data_gas: gas phase data of shape (n_projections, n_points)
+        data_dissolved: dissolved phase data of shape (n_projections, n_points)
+        TR: repetition time in seconds
+        rbc_m_ratio: RBC:m ratio
+        block_size: number of projections per update of the tracker
+    Returns:
+        Tuple of high and low signal indices and the final heart rate in bpm.
+    """
+    tracker = cardiac_tracker.CardiacTracker(tr=TR, rbc_m_ratio=rbc_m_ratio)
+    indices = []
+    labels = []
+    for start in range(0, data_dissolved.shape[0], block_size):
+        block_indices, block_labels = tracker.update(
+            data_gas[start : start + block_size, 0],
+            data_dissolved[start : start + block_size, 0],
+        )
+        indices.append(block_indices)
+        labels.append(block_labels)
+    block_indices, block_labels = tracker.flush()
+    indices = np.concatenate(indices + [block_indices])
+    labels = np.concatenate(labels + [block_labels])
+    return (
+        indices[labels == tracker.HIGH],
+        indices[labels == tracker.LOW],
+        tracker.heart_rate,
+    )
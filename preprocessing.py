@@ -11,15 +11,26 @@ import numpy as np
 from utils import constants, recon_utils, signal_utils, spect_utils, traj_utils
 
 
-def remove_contamination(dict_dyn: Dict[str, Any], dict_dis: Dict[str, Any]) -> Dict:
-    """Remove gas contamination from data."""
-    _, fit_obj = spect_utils.calculate_static_spectroscopy(
-        fid=dict_dyn[constants.IOFields.FIDS_DIS],
-        dwell_time=dict_dyn[constants.IOFields.DWELL_TIME],
-        tr=dict_dyn[constants.IOFields.TR],
-        center_freq=dict_dyn[constants.IOFields.FREQ_CENTER],
-        rf_excitation=dict_dyn[constants.IOFields.FREQ_EXCITATION],
-    )
+def remove_contamination(
+    dict_dyn: Dict[str, Any], dict_dis: Dict[str, Any], fit_obj: Any = None
+) -> Dict:
+    """Remove gas contamination from data.
+
+    Args:
+        dict_dyn: dictionary of dynamic spectroscopy data and metadata.
+        dict_dis: dictionary of dissolved-phase data and metadata.
+        fit_obj: static spectroscopy fit of dict_dyn. Fitted if None.
+    Returns:
+        dict_dis with the gas contamination removed from the dissolved-phase FIDs.
+    """
+    if fit_obj is None:
+        _, fit_obj = spect_utils.calculate_static_spectroscopy(
+            fid=dict_dyn[constants.IOFields.FIDS_DIS],
+            dwell_time=dict_dyn[constants.IOFields.DWELL_TIME],
+            tr=dict_dyn[constants.IOFields.TR],
+            center_freq=dict_dyn[constants.IOFields.FREQ_CENTER],
+            rf_excitation=dict_dyn[constants.IOFields.FREQ_EXCITATION],
+        )
 
     dict_dis[constants.IOFields.FIDS_DIS] = signal_utils.remove_gasphase_contamination(
         data_dissolved=dict_dis[constants.IOFields.FIDS_DIS],
@@ -165,6 +176,32 @@ def prepare_data_and_traj_interleaved(
     return data_dis, traj_dis, data_gas, traj_gas
 
 
+def get_keyhole_data(
+    data: np.ndarray, bin_indices: np.ndarray, key_radius: int = 9
+) -> np.ndarray:
+    """Get the keyhole data of a bin.
+
+    The key of the projections outside of the bin is set to zero.
+
+    Args:
+        data: data FIDs of shape (n_projections, n_points)
+        bin_indices: indices of binned projections.
+        key_radius: radius of keyhole in pixels.
+    Returns:
+        Keyhole data of shape (n_projections, n_points).
+    """
+    data_copy = data.copy()
+    data = data.copy()
+    data[:, 0:key_radius] = 0.0
+    normalization = (
+        np.mean(np.abs(data_copy[bin_indices, 0])) * 1 / np.abs(data_copy[:, 0])
+    )
+    data = data * np.mean(np.abs(data_copy[bin_indices, 0]))
+    data = np.divide(data, np.expand_dims(normalization, -1))
+    data[bin_indices, 0:key_radius] = data_copy[bin_indices, 0:key_radius]
+    return data
+
+
 def prepare_data_and_traj_keyhole(
     data: np.ndarray,
     traj: np.ndarray,
@@ -185,15 +222,7 @@ def prepare_data_and_traj_keyhole(
         of shape (K, 1)
         The trajectory is flattened to a 2D array of shape (K, 3)
     """
-    data_copy = data.copy()
-    data = data.copy()
-    data[:, 0:key_radius] = 0.0
-    normalization = (
-        np.mean(np.abs(data_copy[bin_indices, 0])) * 1 / np.abs(data_copy[:, 0])
-    )
-    data = data * np.mean(np.abs(data_copy[bin_indices, 0]))
-    data = np.divide(data, np.expand_dims(normalization, -1))
-    data[bin_indices, 0:key_radius] = data_copy[bin_indices, 0:key_radius]
+    data = get_keyhole_data(data=data, bin_indices=bin_indices, key_radius=key_radius)
     data_flatten = np.delete(
         recon_utils.flatten_data(data), np.where(data.flatten() == 0.0), axis=0
     )
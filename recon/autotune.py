@@ -0,0 +1,356 @@
+"""Autotuning of the reconstruction engine.
+
+The fastest way to reconstruct an image depends on the machine and the size of the
+problem: the overgridding factor sets the size of the grid that dominates the
+memory traffic, single precision halves it, and the FFT can use several threads.
+The autotuner reconstructs a synthetic phantom sampled on the actual trajectory
+with each candidate engine, rejects engines whose image deviates from the reference
+engine by more than a tolerance, and keeps the fastest one. The winner is persisted
+per machine and problem size so that the search only runs once.
+
+Large problems are benchmarked at a smaller image size on a subsampled trajectory
+with the same kernel, which keeps the number of samples per grid cell and the
+kernel footprint. Gridding and FFT then shrink by the same factor, so the runtimes
+are extrapolated by the ratio of the number of samples.
+"""
+import contextlib
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+sys.path.append("..")
+from utils import constants
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# reference engine, identical to the default reconstruction
+REFERENCE_ENGINE = {
+    "overgrid_factor": 3,
+    "precision": constants.Precision.DOUBLE,
+    "n_threads": 1,
+}
+# largest image size that is benchmarked at full size
+BENCHMARK_IMAGE_SIZE = 64
+
+
+def get_candidate_engines() -> List[Dict[str, Any]]:
+    """Get the candidate reconstruction engines.
+
+    Returns:
+        List[Dict[str, Any]]: list of engine parameters accepted by reconstruct. The
+            first entry is the reference engine.
+    """
+    n_threads = sorted(set([1, os.cpu_count() or 1]))
+    engines = [REFERENCE_ENGINE]
+    for overgrid_factor in [3, 2]:
+        for precision in [constants.Precision.DOUBLE, constants.Precision.SINGLE]:
+            for threads in n_threads:
+                engine = {
+                    "overgrid_factor": overgrid_factor,
+                    "precision": precision,
+                    "n_threads": threads,
+                }
+                if engine != REFERENCE_ENGINE:
+                    engines.append(engine)
+    return engines
+
+
+def get_problem_key(
+    n_samples: int, image_size: int, recon_kwargs: Dict[str, Any]
+) -> str:
+    """Get the key of a reconstruction problem in the tuning cache.
+
+    The number of samples is bucketed in half octaves so that keyhole
+    reconstructions with slightly different numbers of projections share an entry.
+
+    Args:
+        n_samples (int): number of k-space samples.
+        image_size (int): reconstructed image size.
+        recon_kwargs (Dict[str, Any]): remaining reconstruction parameters.
+    Returns:
+        str: problem key.
+    """
+    bucket = int(np.round(2 * np.log2(max(n_samples, 1))))
+    params = "_".join(
+        "{}{:g}".format(key, recon_kwargs[key]) for key in sorted(recon_kwargs)
+    )
+    return "samples{}_size{}_{}".format(bucket, image_size, params)
+
+
+def sphere_kspace(traj: np.ndarray, image_size: int, radius: float = 0.25):
+    """Sample the analytic Fourier transform of a uniform sphere phantom.
+
+    Args:
+        traj (np.ndarray): trajectory of shape (K, 3) in units of the field of view.
+        image_size (int): reconstructed image size.
+        radius (float): radius of the sphere as a fraction of the field of view.
+    Returns:
+        np.ndarray: k-space data of shape (K, 1).
+    """
+    x = 2 * np.pi * radius * image_size * np.linalg.norm(traj, axis=1)
+    x = np.maximum(x, 1e-6)
+    data = 3 * (np.sin(x) - x * np.cos(x)) / x**3
+    return data.astype(np.complex128).reshape((-1, 1))
+
+
+def relative_error(image: np.ndarray, reference: np.ndarray) -> float:
+    """Get the relative L2 error of an image after removing a global scaling.
+
+    Args:
+        image (np.ndarray): image to compare.
+        reference (np.ndarray): reference image.
+    Returns:
+        float: relative L2 error.
+    """
+    image = np.asarray(image, dtype=np.complex128).flatten()
+    reference = np.asarray(reference, dtype=np.complex128).flatten()
+    scale = np.vdot(image, reference) / np.vdot(image, image)
+    return float(np.linalg.norm(scale * image - reference) / np.linalg.norm(reference))
+
+
+def get_benchmark_problem(
+    traj: np.ndarray, image_size: int, max_image_size: int = BENCHMARK_IMAGE_SIZE
+) -> Tuple[np.ndarray, int]:
+    """Get a smaller problem with the same sampling density as a reconstruction.
+
+    The image size is reduced to max_image_size and the trajectory is subsampled by
+    the ratio of the grid volumes, so each grid cell receives about as many samples
+    as in the full problem.
+
+    Args:
+        traj (np.ndarray): trajectory of shape (K, 3).
+        image_size (int): reconstructed image size.
+        max_image_size (int): largest image size of the benchmark.
+    Returns:
+        Tuple[np.ndarray, int]: trajectory and image size of the benchmark.
+    """
+    if image_size <= max_image_size:
+        return traj, image_size
+    stride = max(int(np.round((image_size / max_image_size) ** 3)), 1)
+    return traj[::stride], max_image_size
+
+
+def benchmark_engines(
+    reconstruct_fn: Callable,
+    traj: np.ndarray,
+    image_size: int,
+    recon_kwargs: Dict[str, Any],
+    engines: Optional[List[Dict[str, Any]]] = None,
+    max_image_size: int = BENCHMARK_IMAGE_SIZE,
+) -> List[Dict[str, Any]]:
+    """Time each engine on a phantom and measure its error to the reference engine.
+
+    Problems larger than max_image_size are benchmarked on a smaller problem, see
+    get_benchmark_problem, and the runtimes are extrapolated to the full problem.
+
+    Args:
+        reconstruct_fn (Callable): reconstruction function with the signature of
+            reconstruction.reconstruct.
+        traj (np.ndarray): trajectory of shape (K, 3).
+        image_size (int): reconstructed image size.
+        recon_kwargs (Dict[str, Any]): reconstruction parameters shared by all
+            engines, e.g. the kernel.
+        engines (List[Dict[str, Any]], optional): engines to benchmark. The first
+            engine is the reference. Defaults to get_candidate_engines().
+        max_image_size (int): largest image size that is benchmarked at full size.
+    Returns:
+        List[Dict[str, Any]]: engine parameters with the estimated runtime of the
+            full problem in seconds and the relative error to the reference engine.
+    """
+    engines = engines or get_candidate_engines()
+    n_samples = traj.shape[0]
+    traj, image_size = get_benchmark_problem(traj, image_size, max_image_size)
+    time_scale = n_samples / traj.shape[0]
+    data = sphere_kspace(traj, image_size)
+    # compile the numba kernels before timing on a small subset of the samples
+    reconstruct_fn(
+        data=data[:1000],
+        traj=traj[:1000],
+        image_size=16,
+        verbosity=False,
+        **recon_kwargs,
+    )
+    results = []
+    reference = None
+    for engine in engines:
+        time_start = time.time()
+        image = reconstruct_fn(
+            data=data,
+            traj=traj,
+            image_size=image_size,
+            verbosity=False,
+            **recon_kwargs,
+            **engine,
+        )
+        runtime = (time.time() - time_start) * time_scale
+        if reference is None:
+            reference = image
+        results.append(
+            {
+                "engine": engine,
+                "time": runtime,
+                "error": relative_error(image, reference),
+            }
+        )
+        logging.info(
+            "Engine {}: {:.2f} s, relative error {:.2e}".format(
+                engine, results[-1]["time"], results[-1]["error"]
+            )
+        )
+    return results
+
+
+def select_engine(results: List[Dict[str, Any]], tolerance: float) -> Dict[str, Any]:
+    """Select the fastest engine within the error tolerance.
+
+    Args:
+        results (List[Dict[str, Any]]): output of benchmark_engines.
+        tolerance (float): maximum relative error to the reference engine.
+    Returns:
+        Dict[str, Any]: parameters of the selected engine.
+    """
+    accepted = [result for result in results if result["error"] <= tolerance]
+    return min(accepted, key=lambda result: result["time"])["engine"]
+
+
+def _get_cache_path(cache_dir: str) -> str:
+    """Get the path of the tuning cache of this machine.
+
+    Args:
+        cache_dir (str): cache directory.
+    Returns:
+        str: path to the json file.
+    """
+    return os.path.join(cache_dir, "autotune_{}.json".format(socket.gethostname()))
+
+
+def _load_cache(cache_dir: str) -> Dict[str, Any]:
+    """Load the tuning cache of this machine.
+
+    Args:
+        cache_dir (str): cache directory.
+    Returns:
+        Dict[str, Any]: tuned engines keyed by the problem key.
+    """
+    path = _get_cache_path(cache_dir)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        logging.warning("Ignoring unreadable autotune cache {}".format(path))
+        return {}
+
+
+def _save_cache(cache: Dict[str, Any], cache_dir: str):
+    """Save the tuning cache of this machine.
+
+    Args:
+        cache (Dict[str, Any]): tuned engines keyed by the problem key.
+        cache_dir (str): cache directory.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _get_cache_path(cache_dir)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=cache_dir, prefix=os.path.basename(path), suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def _cache_lock(cache_dir: str) -> Iterator[None]:
+    """Hold the tuning lock of this machine, shared by all processes.
+
+    Benchmarks that run at the same time slow each other down and would store
+    meaningless timings, so only one process tunes at a time.
+
+    Args:
+        cache_dir (str): cache directory.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.splitext(_get_cache_path(cache_dir))[0] + ".lock", "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 s
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def autotune(
+    reconstruct_fn: Callable,
+    traj: np.ndarray,
+    image_size: int,
+    recon_kwargs: Dict[str, Any],
+    tolerance: float = 0.01,
+    cache_dir: str = constants.CACHE_DIR,
+    force: bool = False,
+) -> Dict[str, Any]:
+    """Get the fastest accurate reconstruction engine for a problem.
+
+    Args:
+        reconstruct_fn (Callable): reconstruction function with the signature of
+            reconstruction.reconstruct.
+        traj (np.ndarray): trajectory of shape (K, 3).
+        image_size (int): reconstructed image size.
+        recon_kwargs (Dict[str, Any]): reconstruction parameters shared by all
+            engines, e.g. the kernel.
+        tolerance (float): maximum relative error to the reference engine.
+        cache_dir (str): directory of the tuning cache.
+        force (bool): rerun the benchmark even if the problem is cached.
+    Returns:
+        Dict[str, Any]: engine parameters to pass to reconstruct.
+    """
+    key = get_problem_key(traj.shape[0], image_size, recon_kwargs)
+    entry = _load_cache(cache_dir).get(key)
+    if entry is not None and entry["tolerance"] == tolerance and not force:
+        return entry["engine"]
+    with _cache_lock(cache_dir):
+        # another process may have tuned the problem while this one waited
+        entry = _load_cache(cache_dir).get(key)
+        if entry is not None and entry["tolerance"] == tolerance and not force:
+            return entry["engine"]
+        logging.info("Autotuning reconstruction engine for {}".format(key))
+        results = benchmark_engines(
+            reconstruct_fn=reconstruct_fn,
+            traj=traj,
+            image_size=image_size,
+            recon_kwargs=recon_kwargs,
+        )
+        engine = select_engine(results, tolerance)
+        logging.info("Selected reconstruction engine {}".format(engine))
+        cache = _load_cache(cache_dir)
+        cache[key] = {"engine": engine, "tolerance": tolerance, "results": results}
+        _save_cache(cache, cache_dir)
+    return engine
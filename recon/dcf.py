@@ -4,14 +4,19 @@ import logging
 import sys
 import time
 from abc import ABC, abstractmethod
+from typing import Optional
 
 import numpy as np
 from scipy.stats import norm
 
 sys.path.append("..")
-from recon import system_model
+from recon import gram, system_model
 from utils import constants
 
+# use the Gram matrix if it has fewer nonzeros than this fraction of the nonzeros of
+# the system matrix. One Gram SpMV then costs less than the two passes through A.
+_GRAM_NNZ_RATIO = 1.0
+
 
 class DCF(ABC):
     """Density compensation filter abstract class.
@@ -54,12 +59,17 @@ class IterativeDCF(DCF):
     Medicine / Society of Magnetic Resonance in Medicine, 41(1), 179–86.
     Retrieved from http://www.ncbi.nlm.nih.gov/pubmed/10025627
 
+    Each iteration applies A * A^T to the current dcf. For narrow kernels the Gram
+    matrix G = A * A^T is sparse and can be built once, so that each iteration is a
+    single sparse matrix-vector product that never touches the full grid.
+
     Attributes:
         system_obj (MatrixSystemModel): A subclass of the SystemModel
         dcf_iterations (int): number of iterations for density compensation.
         verbosity (bool): Log output messages.
         space (str): a string
         unique_string (str): unique string defining class.
+        use_gram (bool): if the Gram matrix was used for the iterations.
     """
 
     def __init__(
@@ -67,6 +77,7 @@ class IterativeDCF(DCF):
         system_obj: system_model.MatrixSystemModel,
         dcf_iterations: int,
         verbosity: bool,
+        use_gram: Optional[bool] = None,
     ):
         """Initialize the iterative density compensation function class.
 
@@ -74,25 +85,62 @@ class IterativeDCF(DCF):
             system_obj (MatrixSystemModel): A subclass of the SystemModel
             dcf_iterations (int): number of iterations for density compensation.
             verbosity (bool): Log output messages.
+            use_gram (bool, optional): iterate with the precomputed Gram matrix. If
+                None, decide automatically from the estimated number of nonzeros of
+                the Gram matrix compared to the system matrix.
         """
         self.system_obj = system_obj
         self.dcf_iterations = dcf_iterations
         self.verbosity = verbosity
         self.unique_string = "iter" + str(dcf_iterations)
         self.space = constants.DCFSpace.DATASPACE
+        if use_gram is None:
+            use_gram = self._gram_is_cheaper(system_obj)
+        self.use_gram = use_gram
         # system_obj is a MatrixSystemModel
-        idea_PSFdata = np.ones((system_obj.A._shape[1], 1))
+        idea_PSFdata = np.ones((system_obj.A._shape[1], 1), dtype=system_obj.A.dtype)
         # reasonable first guess by summing all up
         dcf = np.divide(1, system_obj.A.dot(idea_PSFdata))
         # start timing
         time_start = time.time()
+        if self.use_gram:
+            G = gram.gram_matrix(
+                A=system_obj.A,
+                traj=system_obj.traj,
+                matrix_size=system_obj.full_size,
+                kernel_width=system_obj.kernel_width,
+                verbosity=verbosity,
+            )
         # iteratively calculating dcf
         for kk in range(0, self.dcf_iterations):
             if self.verbosity:
                 logging.info(" DCF iteration " + str(kk + 1))
-            dcf = np.divide(dcf, system_obj.A.dot(system_obj.ATrans.dot(dcf)))
+            if self.use_gram:
+                dcf = np.divide(dcf, G.dot(dcf))
+            else:
+                dcf = np.divide(dcf, system_obj.A.dot(system_obj.ATrans.dot(dcf)))
 
         time_end = time.time()
         if self.verbosity:
             logging.info("The runtime for iterative DCF: " + str(time_end - time_start))
-        self.dcf = dcf
+        # the system matrix rows are in model order, return dcf in acquisition order
+        self.dcf = system_obj.to_sample_order(dcf)
+
+    def _gram_is_cheaper(self, system_obj: system_model.MatrixSystemModel) -> bool:
+        """Decide if iterating with the Gram matrix is cheaper than with A.
+
+        Args:
+            system_obj (MatrixSystemModel): A subclass of the SystemModel
+        Returns:
+            bool: True if the estimated nonzeros of G are below the threshold.
+        """
+        nnz_gram = gram.estimate_gram_nnz(
+            traj=system_obj.traj,
+            matrix_size=system_obj.full_size,
+            kernel_width=system_obj.kernel_width,
+        )
+        if self.verbosity:
+            logging.info(
+                "Estimated nnz(G) = {}, nnz(A) = {}".format(nnz_gram, system_obj.A.nnz)
+            )
+        return nnz_gram < _GRAM_NNZ_RATIO * system_obj.A.nnz
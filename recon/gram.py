@@ -0,0 +1,126 @@
+"""Gram matrix of the system model.
+
+The Gram matrix G = A * A^T is a sparse (K, K) matrix whose entries are the overlaps
+of the gridding kernels of two samples. Two samples only overlap if they are closer
+than the kernel width on the overgridded matrix, so the sparsity pattern of G is
+found with a k-d tree on the trajectory instead of a sparse matrix-matrix product.
+"""
+import logging
+import sys
+
+import numpy as np
+import scipy.sparse as sps
+from numba import njit
+from scipy.spatial import cKDTree
+
+sys.path.append("..")
+
+
+@njit(cache=True, nogil=True)
+def _row_overlaps(
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    values: np.ndarray,
+    rows: np.ndarray,
+    cols: np.ndarray,
+) -> np.ndarray:
+    """Calculate the dot products of pairs of rows of a CSR matrix.
+
+    Args:
+        indptr (np.ndarray): CSR index pointer.
+        indices (np.ndarray): CSR column indices, sorted within each row.
+        values (np.ndarray): CSR values.
+        rows (np.ndarray): first row index of each pair.
+        cols (np.ndarray): second row index of each pair.
+    Returns:
+        np.ndarray: dot product of each pair of rows.
+    """
+    out = np.zeros(rows.shape[0])
+    for p in range(rows.shape[0]):
+        i = indptr[rows[p]]
+        i_end = indptr[rows[p] + 1]
+        j = indptr[cols[p]]
+        j_end = indptr[cols[p] + 1]
+        total = 0.0
+        while i < i_end and j < j_end:
+            if indices[i] == indices[j]:
+                total += values[i] * values[j]
+                i += 1
+                j += 1
+            elif indices[i] < indices[j]:
+                i += 1
+            else:
+                j += 1
+        out[p] = total
+    return out
+
+
+def _get_grid_coords(traj: np.ndarray, matrix_size: np.ndarray) -> np.ndarray:
+    """Convert the trajectory to coordinates in units of gridding matrix voxels.
+
+    Args:
+        traj (np.ndarray): trajectory of shape (K, 3).
+        matrix_size (np.ndarray): the gridding matrix size.
+    Returns:
+        np.ndarray: trajectory in units of voxels of shape (K, 3).
+    """
+    return traj * np.asarray(matrix_size).astype(float)
+
+
+def estimate_gram_nnz(
+    traj: np.ndarray, matrix_size: np.ndarray, kernel_width: float
+) -> int:
+    """Estimate the number of nonzero entries of the Gram matrix.
+
+    Counts the pairs of samples, including each sample with itself, that are closer
+    than the kernel width. This is an upper bound of the number of nonzeros.
+
+    Args:
+        traj (np.ndarray): trajectory of shape (K, 3).
+        matrix_size (np.ndarray): the gridding matrix size.
+        kernel_width (float): kernel width in units of gridding matrix voxels.
+    Returns:
+        int: estimated number of nonzero entries of G.
+    """
+    tree = cKDTree(_get_grid_coords(traj, matrix_size))
+    return int(tree.count_neighbors(tree, kernel_width))
+
+
+def gram_matrix(
+    A: sps.csr_matrix,
+    traj: np.ndarray,
+    matrix_size: np.ndarray,
+    kernel_width: float,
+    verbosity: bool = True,
+) -> sps.csr_matrix:
+    """Build the Gram matrix A * A^T from the trajectory neighbourhoods.
+
+    Args:
+        A (sps.csr_matrix): system matrix of shape (K, N) with rows in the same
+            order as traj.
+        traj (np.ndarray): trajectory of shape (K, 3).
+        matrix_size (np.ndarray): the gridding matrix size.
+        kernel_width (float): kernel width in units of gridding matrix voxels.
+        verbosity (bool): Log output messages.
+    Returns:
+        sps.csr_matrix: symmetric Gram matrix of shape (K, K).
+    """
+    if verbosity:
+        logging.info("Calculating Gram matrix from trajectory neighbourhoods ...")
+    A = sps.csr_matrix(A)
+    A.sort_indices()
+    n_samples = A.shape[0]
+    tree = cKDTree(_get_grid_coords(traj, matrix_size))
+    pairs = tree.query_pairs(r=kernel_width, output_type="ndarray")
+    overlaps = _row_overlaps(
+        A.indptr, A.indices, A.data, pairs[:, 0].copy(), pairs[:, 1].copy()
+    )
+    diagonal = np.asarray(A.multiply(A).sum(axis=1)).flatten()
+    rows = np.concatenate((pairs[:, 0], pairs[:, 1], np.arange(n_samples)))
+    cols = np.concatenate((pairs[:, 1], pairs[:, 0], np.arange(n_samples)))
+    vals = np.concatenate((overlaps, overlaps, diagonal))
+    G = sps.csr_matrix((vals, (rows, cols)), shape=(n_samples, n_samples))
+    G.eliminate_zeros()
+    if verbosity:
+        logging.info("Finished Gram matrix with {} nonzeros.".format(G.nnz))
+    return G
@@ -0,0 +1,228 @@
+"""Incremental gridding reconstruction of projections as they are acquired.
+
+The gridded k-space of LSQgridded is A^T (dcf * d), a sum over the samples. Once the
+density compensation of the protocol trajectory is known, each block of projections
+can be gridded into a running k-space accumulator when it arrives, and an image of
+the projections received so far costs a single FFT. The iterative DCF only depends
+on the trajectory and the reconstruction parameters, so it is computed once per
+protocol and stored in the cache directory.
+"""
+import inspect
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import scipy.fft
+
+sys.path.append("..")
+from recon import dcf, kernel, proximity, system_model
+from utils import checkpoint_utils, constants
+
+_DTYPES = {
+    constants.Precision.DOUBLE: np.float64,
+    constants.Precision.SINGLE: np.float32,
+}
+
+
+def get_dcf_cache_dir() -> str:
+    """Get the directory of the cached protocol density compensation functions."""
+    return os.path.join(constants.CACHE_DIR, "dcf")
+
+
+def _get_proximity(
+    kernel_sharpness: float, kernel_extent: float, verbosity: bool
+) -> proximity.L2Proximity:
+    """Get the proximity object of the gaussian gridding kernel.
+
+    Args:
+        kernel_sharpness (float): kernel sharpness.
+        kernel_extent (float): kernel extent.
+        verbosity (bool): Log output messages
+    Returns:
+        proximity.L2Proximity: proximity object as used by reconstruction.reconstruct.
+    """
+    return proximity.L2Proximity(
+        kernel_obj=kernel.Gaussian(
+            kernel_extent=kernel_extent,
+            kernel_sigma=kernel_sharpness,
+            verbosity=verbosity,
+        ),
+        verbosity=verbosity,
+    )
+
+
+def get_protocol_dcf(
+    traj: np.ndarray,
+    kernel_sharpness: float = 0.32,
+    kernel_extent: float = 0.32 * 9,
+    overgrid_factor: int = 3,
+    image_size: int = 128,
+    n_dcf_iter: int = 15,
+    precision: str = constants.Precision.DOUBLE,
+    verbosity: bool = True,
+) -> np.ndarray:
+    """Get the iterative DCF of a trajectory, computed once and then cached.
+
+    Args:
+        traj (np.ndarray): k space trajectory of shape (K, 3)
+        kernel_sharpness (float): kernel sharpness.
+        kernel_extent (float): kernel extent.
+        overgrid_factor (int): overgridding factor
+        image_size (int): target reconstructed image size
+        n_dcf_iter (int): number of dcf iterations
+        precision (str): floating point precision, see constants.Precision.
+        verbosity (bool): Log output messages
+    Returns:
+        np.ndarray: density compensation of shape (K, 1) in acquisition order.
+    """
+    key = checkpoint_utils.fingerprint(
+        [
+            inspect.getsource(dcf.IterativeDCF),
+            np.asarray(traj, dtype=np.float64),
+            kernel_sharpness,
+            kernel_extent,
+            overgrid_factor,
+            image_size,
+            n_dcf_iter,
+            precision,
+        ]
+    )
+    path = os.path.join(get_dcf_cache_dir(), key + ".npy")
+    if os.path.exists(path):
+        logging.info("Loading protocol DCF from cache.")
+        return np.load(path)
+    system_obj = system_model.MatrixSystemModel(
+        proximity_obj=_get_proximity(kernel_sharpness, kernel_extent, verbosity),
+        overgrid_factor=overgrid_factor,
+        image_size=np.array([image_size, image_size, image_size]),
+        traj=traj,
+        verbosity=verbosity,
+        dtype=_DTYPES[precision],
+    )
+    dcf_obj = dcf.IterativeDCF(
+        system_obj=system_obj, dcf_iterations=n_dcf_iter, verbosity=verbosity
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, dcf_obj.dcf)
+    os.replace(path + ".tmp", path)
+    return dcf_obj.dcf
+
+
+class IncrementalRecon(object):
+    """Running gridded reconstruction of the projections of a protocol.
+
+    Projections are identified by their index in the protocol trajectory, so they
+    can arrive in any order, and a projection added twice counts twice. The image
+    matches reconstruction.reconstruct of the added projections when the DCF was
+    computed on the same projections.
+
+    Attributes:
+        traj (np.ndarray): protocol trajectory of shape (n_projections, n_points, 3)
+        dcf (np.ndarray): density compensation of shape (n_projections, n_points)
+        overgrid_factor (int): overgridding factor
+        crop_size (np.ndarray): reconstructed image size.
+        full_size (np.ndarray): size of the overgridded k-space.
+        n_threads (int): number of threads used for the FFT.
+        n_projections (int): number of projections gridded so far.
+        verbosity (bool): Log output messages
+    """
+
+    def __init__(
+        self,
+        traj: np.ndarray,
+        dcf: np.ndarray,
+        kernel_sharpness: float = 0.32,
+        kernel_extent: float = 0.32 * 9,
+        overgrid_factor: int = 3,
+        image_size: int = 128,
+        precision: str = constants.Precision.DOUBLE,
+        n_threads: int = 1,
+        verbosity: bool = False,
+    ):
+        """Initialize the incremental reconstruction.
+
+        Args:
+            traj (np.ndarray): protocol trajectory of shape
+                (n_projections, n_points, 3)
+            dcf (np.ndarray): density compensation of the flattened protocol
+                trajectory of shape (n_projections * n_points, 1), see
+                get_protocol_dcf.
+            kernel_sharpness (float): kernel sharpness.
+            kernel_extent (float): kernel extent.
+            overgrid_factor (int): overgridding factor
+            image_size (int): target reconstructed image size
+            precision (str): floating point precision, see constants.Precision.
+            n_threads (int): number of threads used for the FFT.
+            verbosity (bool): Log output messages
+        """
+        self.traj = traj
+        self.dcf = np.reshape(dcf, traj.shape[:2])
+        self.overgrid_factor = overgrid_factor
+        self.crop_size = np.array([image_size, image_size, image_size])
+        self.full_size = np.ceil(overgrid_factor * self.crop_size).astype(int)
+        self.n_threads = n_threads
+        self.n_projections = 0
+        self.verbosity = verbosity
+        self._proximity_obj = _get_proximity(kernel_sharpness, kernel_extent, False)
+        self._grid = np.zeros(
+            np.prod(self.full_size),
+            dtype=np.result_type(_DTYPES[precision], np.complex64),
+        )
+
+    def add(self, data: np.ndarray, indices: np.ndarray):
+        """Grid a block of projections into the k-space accumulator.
+
+        Args:
+            data (np.ndarray): k space data of shape (n, n_points)
+            indices (np.ndarray): indices of the projections in the protocol
+                trajectory of shape (n,)
+        """
+        indices = np.atleast_1d(indices)
+        if indices.size == 0:
+            return
+        sample_idx, voxel_idx, kernel_vals = self._proximity_obj.evaluate(
+            traj=np.reshape(self.traj[indices], (-1, 3)),
+            overgrid_factor=self.overgrid_factor,
+            matrix_size=self.full_size,
+        )
+        weighted = (self.dcf[indices] * data).flatten()
+        np.add.at(self._grid, voxel_idx - 1, kernel_vals * weighted[sample_idx - 1])
+        self.n_projections += indices.size
+
+    def crop(self, uncrop: np.ndarray) -> np.ndarray:
+        """Crop the overgridded image, as system_model.SystemModel.crop.
+
+        Args:
+            uncrop (np.ndarray): Uncropped image volume of shape (N, N, N)
+        Returns:
+            np.ndarray: Cropped image volume. A copy, so the uncropped volume can be
+                freed.
+        """
+        s_lim = np.round(0.5 * (self.full_size - self.crop_size)).astype(int)
+        l_lim = np.round(0.5 * (self.full_size + self.crop_size)).astype(int)
+        return uncrop[
+            s_lim[0] : l_lim[0], s_lim[1] : l_lim[1], s_lim[2] : l_lim[2]
+        ].copy()
+
+    def get_image(self) -> np.ndarray:
+        """Get the image of the projections gridded so far.
+
+        Returns:
+            np.ndarray: reconstructed image volume (complex datatype)
+        """
+        time_start = time.time()
+        image = np.fft.fftshift(
+            scipy.fft.ifftn(
+                np.reshape(self._grid, self.full_size), workers=self.n_threads
+            )
+        )
+        if self.verbosity:
+            logging.info(
+                "Image of {} projections in {:.2f} s".format(
+                    self.n_projections, time.time() - time_start
+                )
+            )
+        return self.crop(image)
@@ -6,6 +6,7 @@ import time
 from abc import ABC, abstractmethod
 
 import numpy as np
+import scipy.fft
 
 sys.path.append("..")
 
@@ -42,6 +43,7 @@ class LSQgridded(GriddedReconModel):
 
     Attributes:
         dcf_obj (IterativeDCF): A density compensation function object.
+        n_threads (int): number of threads used for the FFT.
         unique_string (str): A unique string defining this class
     """
 
@@ -50,6 +52,7 @@ class LSQgridded(GriddedReconModel):
         system_obj: system_model.MatrixSystemModel,
         dcf_obj: dcf.DCF,
         verbosity: int,
+        n_threads: int = 1,
     ):
         """Initialize the LSQ gridding model.
 
@@ -57,9 +60,11 @@ class LSQgridded(GriddedReconModel):
             system_obj (MatrixSystemModel): A subclass of the System Object
             dcf_obj (IterativeDCF): A density compensation function object
             verbosity (int): either 0 or 1 whether to log output messages
+            n_threads (int): number of threads used for the FFT.
         """
         super().__init__(system_obj=system_obj, verbosity=verbosity)
         self.dcf_obj = dcf_obj
+        self.n_threads = n_threads
         self.unique_string = (
             "grid_" + system_obj.unique_string + "_" + dcf_obj.unique_string
         )
@@ -69,7 +74,8 @@ class LSQgridded(GriddedReconModel):
 
         Currently supports only MatrixSystemModel
         Args:
-            data (np.ndarray): complex kspace data of shape (K, 1)
+            data (np.ndarray): complex kspace data of shape (K, 1) in acquisition
+                order.
 
         Raises:
             Exception: DCF string not recognized
@@ -77,10 +83,19 @@ class LSQgridded(GriddedReconModel):
         Returns:
             np.ndarray: gridded data.
         """
+        # keep the data in the precision of the system matrix
+        data = data.astype(
+            np.result_type(self.system_obj.A.dtype, np.complex64), copy=False
+        )
         if self.dcf_obj.space == constants.DCFSpace.GRIDSPACE:
-            gridVol = np.multiply(self.system_obj.ATrans.dot(data), self.dcf_obj.dcf)
+            gridVol = np.multiply(
+                self.system_obj.ATrans.dot(self.system_obj.to_model_order(data)),
+                self.dcf_obj.dcf,
+            )
         elif self.dcf_obj.space == constants.DCFSpace.DATASPACE:
-            gridVol = self.system_obj.ATrans.dot(np.multiply(self.dcf_obj.dcf, data))
+            gridVol = self.system_obj.ATrans.dot(
+                self.system_obj.to_model_order(np.multiply(self.dcf_obj.dcf, data))
+            )
         else:
             raise Exception("DCF space type not recognized")
         return gridVol
@@ -106,7 +121,7 @@ class LSQgridded(GriddedReconModel):
         if self.verbosity:
             logging.info("-- Calculating IFFT ...")
         time_start = time.time()
-        reconVol = np.fft.fftshift(np.fft.ifftn(reconVol))
+        reconVol = np.fft.fftshift(scipy.fft.ifftn(reconVol, workers=self.n_threads))
         # reconVol = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(reconVol)))
         time_end = time.time()
         logging.info("The runtime for iFFT: " + str(time_end - time_start))
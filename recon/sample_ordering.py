@@ -0,0 +1,99 @@
+"""Sample ordering for cache-friendly gridding.
+
+Samples are ordered along a space-filling curve so that neighbouring rows of the
+system matrix touch neighbouring regions of the (overgridded) k-space grid. This
+keeps the scatter/gather of the sparse matrix products inside the cache instead of
+jumping across the full grid for every sample.
+
+Background reading:
+    1. A computer oriented geodetic data base and a new technique in file
+    sequencing. Morton. 1966.
+"""
+import sys
+
+import numpy as np
+
+sys.path.append("..")
+from utils import constants
+
+# number of bits per dimension in the morton key. 21 bits * 3 dimensions fits
+# into a 64 bit integer and supports grids of up to 2**21 voxels per dimension.
+_MORTON_BITS = 21
+
+
+def _part1by2(x: np.ndarray) -> np.ndarray:
+    """Spread the bits of x such that there are two zero bits between each bit.
+
+    Args:
+        x (np.ndarray): unsigned integer array with values below 2**21.
+    Returns:
+        np.ndarray: uint64 array with the bits of x spread out.
+    """
+    x = x.astype(np.uint64) & np.uint64(0x1FFFFF)
+    x = (x | (x << np.uint64(32))) & np.uint64(0x1F00000000FFFF)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x1F0000FF0000FF)
+    x = (x | (x << np.uint64(8))) & np.uint64(0x100F00F00F00F00F)
+    x = (x | (x << np.uint64(4))) & np.uint64(0x10C30C30C30C30C3)
+    x = (x | (x << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return x
+
+
+def morton_keys(traj: np.ndarray, matrix_size: np.ndarray) -> np.ndarray:
+    """Calculate the morton (z-order) key of each sample on the gridding matrix.
+
+    The trajectory is quantized to the voxel it falls in on the gridding matrix,
+    following the same coordinate convention as the sparse gridding distance
+    calculation.
+
+    Args:
+        traj (np.ndarray): trajectory of shape (K, 3) in units of the reconstructed
+            field of view, i.e. in the range [-0.5, 0.5].
+        matrix_size (np.ndarray): the gridding matrix size of shape (3,).
+    Returns:
+        np.ndarray: uint64 morton key of each sample of shape (K,).
+    """
+    assert traj.ndim == 2 and traj.shape[1] == 3, "Trajectory must be of shape (K, 3)"
+    matrix_size = np.asarray(matrix_size).astype(int)
+    voxel = np.floor(traj * matrix_size + np.ceil(0.5 * matrix_size))
+    voxel = np.clip(voxel, 0, matrix_size - 1).astype(np.uint64)
+    return (
+        _part1by2(voxel[:, 0])
+        | (_part1by2(voxel[:, 1]) << np.uint64(1))
+        | (_part1by2(voxel[:, 2]) << np.uint64(2))
+    )
+
+
+def get_sample_order(
+    traj: np.ndarray,
+    matrix_size: np.ndarray,
+    sample_order: str = constants.SampleOrder.MORTON,
+) -> np.ndarray:
+    """Get the permutation that puts the samples into the requested order.
+
+    Args:
+        traj (np.ndarray): trajectory of shape (K, 3).
+        matrix_size (np.ndarray): the gridding matrix size of shape (3,).
+        sample_order (str): sample ordering, see constants.SampleOrder.
+    Returns:
+        np.ndarray: permutation indices of shape (K,) such that traj[order] is in the
+            requested order.
+    """
+    if sample_order == constants.SampleOrder.ACQUISITION:
+        return np.arange(traj.shape[0])
+    elif sample_order == constants.SampleOrder.MORTON:
+        return np.argsort(morton_keys(traj, matrix_size), kind="stable")
+    else:
+        raise ValueError("Invalid sample order: {}.".format(sample_order))
+
+
+def invert_order(order: np.ndarray) -> np.ndarray:
+    """Get the inverse of a permutation.
+
+    Args:
+        order (np.ndarray): permutation indices of shape (K,).
+    Returns:
+        np.ndarray: inverse permutation indices of shape (K,).
+    """
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(order.shape[0])
+    return inverse
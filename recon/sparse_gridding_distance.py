@@ -27,7 +27,7 @@ DEBUG = False
 DEBUG_GRID = False
 
 
-@njit
+@njit(cache=True, nogil=True)
 def grid_point(
     sample_loc: np.ndarray,
     idx_convert: np.ndarray,
@@ -47,17 +47,21 @@ def grid_point(
 ):
     """Convolve ungridded data with a kernel.
 
-    Recursive function that loops through a bounded section of the output grid,
-    convolving the ungriddent point's data according to the convolution kernel,
-    density compensation value, and the ungridded point's vlaue. The recursion allows
-    for n-dimensional data reconstruction.
+    Loops through a bounded section of the output grid, convolving the ungridded
+    point's data according to the convolution kernel, density compensation value,
+    and the ungridded point's value. The section is traversed like nested loops with
+    dimension cur_dim outermost and dimension 0 innermost, which allows for
+    n-dimensional data reconstruction. The partial squared distance of each loop
+    level is kept so that only the levels below the one that changed are updated.
+    The loops are unrolled instead of recursing so that numba can cache the
+    compiled function.
 
     Args:
         sample_loc (np.ndarray): The location of the ungridded point in the output
         idx_convert (np.ndarray): The conversion factor for converting the output
         kernel_halfwidth_sqr (float): The kernel halfwidth squared
         ndims (int): The number of dimensions
-        cur_dim (int): The current dimension
+        cur_dim (int): The current (outermost) dimension
         bounds (np.ndarray): The minimum and maximum bounds of the subarray.
         seed_pt (np.ndarray): The seed point
         kern_dist_sq (float): The kernel distance squared
@@ -69,100 +73,65 @@ def grid_point(
         sparse_distances (np.ndarray): The sparse distances
         force_dim (int): The force dimension. If -1, then no dimension is forced.
     """
-    lower = int(bounds[2 * cur_dim])
-    upper = int(bounds[2 * cur_dim + 1])
+    for dim in range(cur_dim + 1):
+        if bounds[2 * dim] > bounds[2 * dim + 1]:
+            return
+        seed_pt[dim] = bounds[2 * dim]
+
+    # dist_sq[dim] is the squared distance accumulated over dimensions >= dim
+    dist_sq = np.zeros(cur_dim + 2)
+    dist_sq[cur_dim + 1] = kern_dist_sq
+    changed_dim = cur_dim
+    while True:
+        for dim in range(changed_dim, -1, -1):
+            if (dim == force_dim) or force_dim == -1:
+                new_kern_dist_sq = float(seed_pt[dim] - sample_loc[dim])
+                dist_sq[dim] = new_kern_dist_sq * new_kern_dist_sq + dist_sq[dim + 1]
+            else:
+                dist_sq[dim] = dist_sq[dim + 1]
 
-    for i in range(lower, upper + 1):
-        seed_pt[cur_dim] = i
-        if (cur_dim == force_dim) or force_dim == -1:
-            new_kern_dist_sq = float(i - sample_loc[cur_dim])
-            if DEBUG_GRID:
-                logging.info(
-                    "\tSaving distance for dim %u = %f (adding %f to %f)"
-                    % (
-                        cur_dim + 1,
-                        new_kern_dist_sq,
-                        new_kern_dist_sq * new_kern_dist_sq,
-                        kern_dist_sq,
-                    )
-                )
-            new_kern_dist_sq *= new_kern_dist_sq
-            new_kern_dist_sq += kern_dist_sq
+        if dist_sq[0] <= kernel_halfwidth_sqr:
+            idx_ = 0
+            for j in range(ndims):
+                idx_ += seed_pt[j] * idx_convert[j]
+
+            sparse_sample_indices[n_nonsparse_entries[0]] = sample_index + 1
+            sparse_voxel_indices[n_nonsparse_entries[0]] = int(idx_) + 1
+            sparse_distances[n_nonsparse_entries[0]] = math.sqrt(dist_sq[0])
+            n_nonsparse_entries[0] += 1
         else:
             if DEBUG_GRID:
-                logging.info(
-                    "\t\tWrong dimension dim %u, maintaining distance %f"
-                    % (cur_dim + 1, kern_dist_sq)
+                debug_string = "\tVoxel [[{}, {}, {}] is too far ".format(
+                    seed_pt[0],
+                    seed_pt[1],
+                    seed_pt[2],
+                )
+                debug_string += "({} > {}) from sample point ".format(
+                    dist_sq[0],
+                    kernel_halfwidth_sqr,
+                )
+                debug_string += "[{}, {}, {}] (index {})!".format(
+                    sample_loc[0],
+                    sample_loc[1],
+                    sample_loc[2],
+                    sample_index,
                 )
-
-            new_kern_dist_sq = kern_dist_sq
-
-        if cur_dim > 0:
-            if DEBUG_GRID:
-                debug_string = "\t Recursing dim {} - gridding [".format(cur_dim + 1)
-                for j in range(ndims):
-                    if j < cur_dim:
-                        debug_string += "%u:%u" % (bounds[2 * j], bounds[2 * j + 1])
-                    else:
-                        debug_string += "%u" % seed_pt[j]
-                    if j < ndims - 1:
-                        debug_string += ","
-                debug_string += "]"
                 logging.info(debug_string)
 
-            grid_point(
-                sample_loc,
-                idx_convert,
-                kernel_halfwidth_sqr,
-                ndims,
-                cur_dim - 1,
-                bounds,
-                seed_pt,
-                new_kern_dist_sq,
-                output_dims,
-                sample_index,
-                n_nonsparse_entries,
-                sparse_sample_indices,
-                sparse_voxel_indices,
-                sparse_distances,
-                force_dim,
-            )
-        else:
-            if new_kern_dist_sq <= kernel_halfwidth_sqr:
-                idx_ = 0
-                for j in range(ndims):
-                    idx_ += seed_pt[j] * idx_convert[j]
-
-                # logging.info(sample_index, n_nonsparse_entries)
-                sparse_sample_indices[n_nonsparse_entries[0]] = sample_index + 1
-                sparse_voxel_indices[n_nonsparse_entries[0]] = float(idx_ + 1)
-                sparse_distances[n_nonsparse_entries[0]] = math.sqrt(new_kern_dist_sq)
-                # print(sparse_distances[n_nonsparse_entries[0]], n_nonsparse_entries[0])
-                n_nonsparse_entries[0] += 1
-
-            else:
-                if DEBUG_GRID:
-                    debug_string = "\tVoxel [[{}, {}, {}] is too far ".format(
-                        seed_pt[0],
-                        seed_pt[1],
-                        seed_pt[2],
-                    )
-                    debug_string += "({} > {}) from sample point ".format(
-                        new_kern_dist_sq,
-                        kernel_halfwidth_sqr,
-                    )
-                    debug_string += "[{}, {}, {}] (index {})!".format(
-                        sample_loc[0],
-                        sample_loc[1],
-                        sample_loc[2],
-                        sample_index,
-                    )
-                    logging.info(debug_string)
-
-        seed_pt[cur_dim] = lower
+        # advance to the next voxel, dimension 0 fastest
+        changed_dim = 0
+        while (
+            changed_dim <= cur_dim
+            and seed_pt[changed_dim] >= bounds[2 * changed_dim + 1]
+        ):
+            seed_pt[changed_dim] = bounds[2 * changed_dim]
+            changed_dim += 1
+        if changed_dim > cur_dim:
+            return
+        seed_pt[changed_dim] += 1
 
 
-@njit
+@njit(cache=True, nogil=True)
 def sparse_gridding_distance(
     coords: np.ndarray,
     kernel_width: float,
@@ -189,8 +158,8 @@ def sparse_gridding_distance(
         force_dim: Force a dimension to be gridded.
 
     Returns:
-        nonsparse_sample_indices: Array of sample indices.
-        nonsparse_voxel_indices: Array of voxel indices.
+        nonsparse_sample_indices: Array of one-based sample indices.
+        nonsparse_voxel_indices: Array of one-based voxel indices.
         nonsparse_distances: Array of distances.
     """
     # define constants
@@ -199,8 +168,8 @@ def sparse_gridding_distance(
     output_halfwidth = np.zeros(n_dims)
 
     # initialize output arrays
-    nonsparse_sample_indices = np.zeros(max_size)
-    nonsparse_voxel_indices = np.zeros(max_size)
+    nonsparse_sample_indices = np.zeros(max_size, dtype=np.int64)
+    nonsparse_voxel_indices = np.zeros(max_size, dtype=np.int64)
     nonsparse_distances = np.zeros(max_size)
 
     # intialize bounds
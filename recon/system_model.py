@@ -1,5 +1,6 @@
 """Gridding kernels."""
 
+import copy
 import logging
 import pdb
 import sys
@@ -9,7 +10,8 @@ import numpy as np
 import scipy.sparse as sps
 
 sys.path.append("..")
-from recon import proximity
+from recon import proximity, sample_ordering
+from utils import constants
 
 
 class SystemModel(ABC):
@@ -50,13 +52,16 @@ class SystemModel(ABC):
         Args:
             uncrop (np.ndarray): Uncropped image volume of shape (N, N, N)
         Returns:
-            np.ndarray: Cropped image volume
+            np.ndarray: Cropped image volume. A copy, so the uncropped volume can be
+                freed.
         """
         s_lim = np.round(0.5 * (np.subtract(self.full_size, self.crop_size))).astype(
             int
         )
         l_lim = np.round(0.5 * np.add(self.full_size, self.crop_size)).astype(int)
-        return uncrop[s_lim[0] : l_lim[0], s_lim[1] : l_lim[1], s_lim[2] : l_lim[2]]
+        return uncrop[
+            s_lim[0] : l_lim[0], s_lim[1] : l_lim[1], s_lim[2] : l_lim[2]
+        ].copy()
 
     @abstractmethod
     def multiply(self, b) -> np.ndarray:
@@ -80,12 +85,23 @@ class MatrixSystemModel(SystemModel):
     is that they compute slower in itterative applications, where interpolation
     coefficients are calculated twice each iteration (once togrid, and once to ungrid)
 
+    The rows of the system matrix are stored in the order given by sample_order,
+    e.g. along a space-filling curve so that neighbouring rows touch neighbouring
+    grid regions. Data in acquisition order must be permuted with to_model_order
+    before multiplying with A or ATrans, and data space results can be returned
+    to acquisition order with to_sample_order.
+
     Attributes:
         unique_string (str): a unique string describing the matrix system model.
         is_supersparse (bool): if A is a super sparse matrix.
         is_transpose (bool): if transpose of A is used.
         A: The sparse matrix storing interpolation coefficients.
         ATrans: The transpose of the sparse matrix storing interpolation coefficients.
+        order (np.ndarray): permutation from acquisition order to model order.
+        traj (np.ndarray): trajectories of shape (K, 3) in model order.
+        inverse_order (np.ndarray): permutation from model order to acquisition
+            order.
+        kernel_width (float): kernel width in units of gridding matrix voxels.
     """
 
     def __init__(
@@ -95,6 +111,8 @@ class MatrixSystemModel(SystemModel):
         image_size: np.ndarray,
         traj: np.ndarray,
         verbosity: int,
+        sample_order: str = constants.SampleOrder.MORTON,
+        dtype: type = np.float64,
     ):
         """Initialize the matrix system model class.
 
@@ -106,6 +124,9 @@ class MatrixSystemModel(SystemModel):
             image_size (tuple): reconstructed image size
             traj (np.ndarray): trajectories of shape (K, 3)
             verbosity (int): either 0 or 1 whether to log output messages
+            sample_order (str): order of the rows of the system matrix, see
+                constants.SampleOrder.
+            dtype (type): floating point type of the system matrix.
         """
         super().__init__(
             proximity_obj=proximity_obj,
@@ -117,11 +138,19 @@ class MatrixSystemModel(SystemModel):
         self.is_supersparse = False
         self.is_transpose = False
 
+        self.order = sample_ordering.get_sample_order(
+            traj=traj, matrix_size=self.full_size, sample_order=sample_order
+        )
+        self.inverse_order = sample_ordering.invert_order(self.order)
+
         if verbosity:
             logging.info("Calculating Matrix interpolation coefficients...")
 
+        self.traj = traj[self.order]
         sample_idx, voxel_idx, kernel_vals = self.proximity_obj.evaluate(
-            traj=traj, overgrid_factor=self.overgrid_factor, matrix_size=self.full_size
+            traj=self.traj,
+            overgrid_factor=self.overgrid_factor,
+            matrix_size=self.full_size,
         )
         if verbosity:
             logging.info("Finished calculating Matrix interpolation coefficients)")
@@ -129,10 +158,56 @@ class MatrixSystemModel(SystemModel):
         self.A = sps.csr_matrix(
             (kernel_vals, (sample_idx - 1, voxel_idx - 1)),
             shape=(np.shape(traj)[0], np.prod(self.full_size)),
-            dtype=np.float64,
+            dtype=dtype,
         )
         self.A.eliminate_zeros()
         self.ATrans = self.A.transpose()
+        self.kernel_width = self.overgrid_factor * self.proximity_obj.kernel_obj.extent
+
+    def to_model_order(self, b: np.ndarray) -> np.ndarray:
+        """Permute a data space array from acquisition order to model order.
+
+        Args:
+            b (np.ndarray): data space array of shape (K, ...) in acquisition order.
+        Returns:
+            np.ndarray: array in the row order of the system matrix.
+        """
+        return b[self.order]
+
+    def to_sample_order(self, b: np.ndarray) -> np.ndarray:
+        """Permute a data space array from model order back to acquisition order.
+
+        Args:
+            b (np.ndarray): data space array of shape (K, ...) in model order.
+        Returns:
+            np.ndarray: array in acquisition order.
+        """
+        return b[self.inverse_order]
+
+    def subset(self, mask: np.ndarray) -> "MatrixSystemModel":
+        """Get the system model of a subset of the samples.
+
+        The rows of the subset are taken from the system matrix, so the
+        interpolation coefficients are not calculated again. They keep the model
+        order of the full trajectory.
+
+        Args:
+            mask (np.ndarray): boolean mask of the samples to keep of shape (K,) in
+                acquisition order.
+        Returns:
+            MatrixSystemModel: system model of the masked samples, in acquisition
+                order of the masked samples.
+        """
+        mask = np.asarray(mask, dtype=bool).flatten()
+        model_mask = self.to_model_order(mask)
+        subset_obj = copy.copy(self)
+        subset_obj.A = self.A[model_mask]
+        subset_obj.ATrans = subset_obj.A.transpose()
+        subset_obj.traj = self.traj[model_mask]
+        # position of each kept sample among the kept samples in acquisition order
+        subset_obj.order = (np.cumsum(mask) - 1)[self.order[model_mask]]
+        subset_obj.inverse_order = sample_ordering.invert_order(subset_obj.order)
+        return subset_obj
 
     def makeSuperSparse(self):
         """Return 1."""
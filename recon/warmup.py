@@ -0,0 +1,68 @@
+"""Ahead-of-time compilation of the numba kernels.
+
+The numba kernels in recon and spect are compiled with cache=True, so the machine code is
+written to the numba cache (next to the sources, or NUMBA_CACHE_DIR if set) the
+first time they run and reloaded by every later process. warmup() compiles the
+signatures used by the pipeline so that this happens once after installation or at
+the start of a worker process, not inside the first reconstruction. Run
+
+    python -m recon.warmup
+
+from the repository root after installing.
+"""
+import logging
+import sys
+import time
+
+import numpy as np
+import scipy.sparse as sps
+
+sys.path.append("..")
+from recon import gram, sparse_gridding_distance
+from spect import voigt
+
+# coordinate types of the trajectories passed to the gridding kernel
+_COORD_DTYPES = [np.float64, np.float32]
+# value types of the system matrix passed to the gram kernel
+_VALUE_DTYPES = [np.float64, np.float32]
+
+
+def warmup(verbosity: bool = False) -> float:
+    """Compile or load from cache all numba kernels for the signatures we use.
+
+    Args:
+        verbosity (bool): Log output messages.
+    Returns:
+        float: time spent in seconds.
+    """
+    time_start = time.time()
+    for dtype in _COORD_DTYPES:
+        sparse_gridding_distance.sparse_gridding_distance(
+            coords=np.zeros(3, dtype=dtype),
+            kernel_width=1.0,
+            n_points=1,
+            n_dims=3,
+            output_dims=np.array([4, 4, 4]).astype(int),
+            n_nonsparse_entries=np.array([0]).astype(int),
+            max_size=64,
+            force_dim=-1,
+        )
+    for dtype in _VALUE_DTYPES:
+        A = sps.identity(2, dtype=dtype, format="csr")
+        pairs = np.array([[0, 1]], dtype=np.intp)
+        gram._row_overlaps(
+            A.indptr, A.indices, A.data, pairs[:, 0].copy(), pairs[:, 1].copy()
+        )
+    x = np.zeros(voigt.N_PARAMS * voigt.N_COMPONENTS)
+    tdata = np.zeros(1)
+    voigt.get_residual(x, tdata, np.zeros(1, dtype=np.complex128))
+    voigt.get_jacobian(x, tdata)
+    runtime = time.time() - time_start
+    if verbosity:
+        logging.info("Numba kernels ready in {:.2f} s".format(runtime))
+    return runtime
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    warmup(verbosity=True)
@@ -2,12 +2,26 @@
 
 
 import pdb
+from typing import Optional
 
 import numpy as np
 from absl import app, logging
 
-from recon import dcf, kernel, proximity, recon_model, system_model
-from utils import io_utils
+from recon import (
+    autotune,
+    dcf,
+    incremental,
+    kernel,
+    proximity,
+    recon_model,
+    system_model,
+)
+from utils import constants, io_utils
+
+_DTYPES = {
+    constants.Precision.DOUBLE: np.float64,
+    constants.Precision.SINGLE: np.float32,
+}
 
 
 def reconstruct(
@@ -18,6 +32,10 @@ def reconstruct(
     overgrid_factor: int = 3,
     image_size: int = 128,
     n_dcf_iter: int = 15,
+    dcf_use_gram: Optional[bool] = None,
+    sample_order: str = constants.SampleOrder.MORTON,
+    precision: str = constants.Precision.DOUBLE,
+    n_threads: int = 1,
     verbosity: bool = True,
 ) -> np.ndarray:
     """Reconstruct k-space data and trajectory.
@@ -32,11 +50,67 @@ def reconstruct(
         image_size (int): target reconstructed image size
             (image_size, image_size, image_size)
         n_pipe_iter (int): number of dcf iterations
+        dcf_use_gram (bool, optional): iterate the dcf with the precomputed Gram
+            matrix. If None, decide automatically.
+        sample_order (str): order of the samples inside the system model. The
+            output does not depend on the order, only the gridding speed does.
+        precision (str): floating point precision, see constants.Precision.
+        n_threads (int): number of threads used for the FFT.
         verbosity (bool): Log output messages
 
     Returns:
         np.ndarray: reconstructed image volume
     """
+    system_obj = get_system_model(
+        traj=traj,
+        kernel_sharpness=kernel_sharpness,
+        kernel_extent=kernel_extent,
+        overgrid_factor=overgrid_factor,
+        image_size=image_size,
+        sample_order=sample_order,
+        precision=precision,
+        verbosity=verbosity,
+    )
+    image = reconstruct_system_model(
+        data=data,
+        system_obj=system_obj,
+        n_dcf_iter=n_dcf_iter,
+        dcf_use_gram=dcf_use_gram,
+        n_threads=n_threads,
+        verbosity=verbosity,
+    )
+    del system_obj
+    return image
+
+
+def get_system_model(
+    traj: np.ndarray,
+    kernel_sharpness: float = 0.32,
+    kernel_extent: float = 0.32 * 9,
+    overgrid_factor: int = 3,
+    image_size: int = 128,
+    sample_order: str = constants.SampleOrder.MORTON,
+    precision: str = constants.Precision.DOUBLE,
+    verbosity: bool = True,
+) -> system_model.MatrixSystemModel:
+    """Calculate the system model of a trajectory.
+
+    The system model can be reused for the reconstruction of subsets of the
+    trajectory, see MatrixSystemModel.subset.
+
+    Args:
+        traj (np.ndarray): k space trajectory of shape (K, 3)
+        kernel_sharpness (float): kernel sharpness.
+        kernel_extent (float): kernel extent.
+        overgrid_factor (int): overgridding factor
+        image_size (int): target reconstructed image size
+        sample_order (str): order of the samples inside the system model.
+        precision (str): floating point precision, see constants.Precision.
+        verbosity (bool): Log output messages
+
+    Returns:
+        system_model.MatrixSystemModel: system model of the trajectory.
+    """
     prox_obj = proximity.L2Proximity(
         kernel_obj=kernel.Gaussian(
             kernel_extent=kernel_extent,
@@ -45,24 +119,156 @@ def reconstruct(
         ),
         verbosity=verbosity,
     )
-    system_obj = system_model.MatrixSystemModel(
+    return system_model.MatrixSystemModel(
         proximity_obj=prox_obj,
         overgrid_factor=overgrid_factor,
         image_size=np.array([image_size, image_size, image_size]),
         traj=traj,
         verbosity=verbosity,
+        sample_order=sample_order,
+        dtype=_DTYPES[precision],
     )
+
+
+def reconstruct_system_model(
+    data: np.ndarray,
+    system_obj: system_model.MatrixSystemModel,
+    n_dcf_iter: int = 15,
+    dcf_use_gram: Optional[bool] = None,
+    n_threads: int = 1,
+    verbosity: bool = True,
+) -> np.ndarray:
+    """Reconstruct k-space data with a precomputed system model.
+
+    Args:
+        data (np.ndarray): k space data of shape (K, 1)
+        system_obj (system_model.MatrixSystemModel): system model of the
+            trajectory of the data, see get_system_model.
+        n_dcf_iter (int): number of dcf iterations
+        dcf_use_gram (bool, optional): iterate the dcf with the precomputed Gram
+            matrix. If None, decide automatically.
+        n_threads (int): number of threads used for the FFT.
+        verbosity (bool): Log output messages
+
+    Returns:
+        np.ndarray: reconstructed image volume
+    """
     dcf_obj = dcf.IterativeDCF(
-        system_obj=system_obj, dcf_iterations=n_dcf_iter, verbosity=verbosity
+        system_obj=system_obj,
+        dcf_iterations=n_dcf_iter,
+        verbosity=verbosity,
+        use_gram=dcf_use_gram,
     )
     recon_obj = recon_model.LSQgridded(
-        system_obj=system_obj, dcf_obj=dcf_obj, verbosity=verbosity
+        system_obj=system_obj,
+        dcf_obj=dcf_obj,
+        verbosity=verbosity,
+        n_threads=n_threads,
+    )
+    image = recon_obj.reconstruct(
+        data=data, traj=system_obj.to_sample_order(system_obj.traj)
     )
-    image = recon_obj.reconstruct(data=data, traj=traj)
-    del recon_obj, dcf_obj, system_obj, prox_obj
+    del recon_obj, dcf_obj
     return image
 
 
+def reconstruct_autotuned(
+    data: np.ndarray,
+    traj: np.ndarray,
+    kernel_sharpness: float = 0.32,
+    kernel_extent: float = 0.32 * 9,
+    image_size: int = 128,
+    n_dcf_iter: int = 15,
+    tolerance: float = 0.01,
+    verbosity: bool = True,
+) -> np.ndarray:
+    """Reconstruct k-space data with the fastest engine for this machine.
+
+    The engine (overgridding factor, precision and number of FFT threads) is tuned
+    once per machine and problem size, see recon.autotune.
+
+    Args:
+        data (np.ndarray): k space data of shape (K, 1)
+        traj (np.ndarray): k space trajectory of shape (K, 3)
+        kernel_sharpness (float): kernel sharpness.
+        kernel_extent (float): kernel extent.
+        image_size (int): target reconstructed image size
+        n_dcf_iter (int): number of dcf iterations
+        tolerance (float): maximum relative error of the engine to the reference
+            engine.
+        verbosity (bool): Log output messages
+
+    Returns:
+        np.ndarray: reconstructed image volume
+    """
+    recon_kwargs = {
+        "kernel_sharpness": kernel_sharpness,
+        "kernel_extent": kernel_extent,
+        "n_dcf_iter": n_dcf_iter,
+    }
+    engine = autotune.autotune(
+        reconstruct_fn=reconstruct,
+        traj=traj,
+        image_size=image_size,
+        recon_kwargs=recon_kwargs,
+        tolerance=tolerance,
+    )
+    return reconstruct(
+        data=data,
+        traj=traj,
+        image_size=image_size,
+        verbosity=verbosity,
+        **recon_kwargs,
+        **engine,
+    )
+
+
+def get_incremental_recon(
+    traj: np.ndarray,
+    kernel_sharpness: float = 0.32,
+    kernel_extent: float = 0.32 * 9,
+    overgrid_factor: int = 3,
+    image_size: int = 128,
+    n_dcf_iter: int = 15,
+    precision: str = constants.Precision.DOUBLE,
+    n_threads: int = 1,
+    verbosity: bool = True,
+) -> incremental.IncrementalRecon:
+    """Prepare the incremental reconstruction of the projections of a protocol.
+
+    The DCF of the protocol trajectory is loaded from the cache, or computed once,
+    so the projections can be gridded as they are acquired, see recon.incremental.
+
+    Args:
+        traj (np.ndarray): protocol trajectory of shape (n_projections, n_points, 3)
+        kernel_sharpness (float): kernel sharpness.
+        kernel_extent (float): kernel extent.
+        overgrid_factor (int): overgridding factor
+        image_size (int): target reconstructed image size
+        n_dcf_iter (int): number of dcf iterations
+        precision (str): floating point precision, see constants.Precision.
+        n_threads (int): number of threads used for the FFT.
+        verbosity (bool): Log output messages
+
+    Returns:
+        incremental.IncrementalRecon: reconstruction without gridded projections.
+    """
+    recon_kwargs = {
+        "kernel_sharpness": kernel_sharpness,
+        "kernel_extent": kernel_extent,
+        "overgrid_factor": overgrid_factor,
+        "image_size": image_size,
+        "precision": precision,
+        "verbosity": verbosity,
+    }
+    protocol_dcf = incremental.get_protocol_dcf(
+        traj=np.reshape(traj, (-1, 3)), n_dcf_iter=n_dcf_iter, **recon_kwargs
+    )
+    return incremental.IncrementalRecon(
+        traj=traj, dcf=protocol_dcf, n_threads=n_threads, **recon_kwargs
+    )
+
+
 def main(argv):
     """Demonstrate non-cartesian reconstruction.
 
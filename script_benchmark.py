@@ -0,0 +1,268 @@
+"""Benchmarks for the reconstruction pipeline.
+
+Run a single benchmark with e.g.
+
+    python script_benchmark.py --benchmark=sample_order
+"""
+import logging
+import subprocess
+import sys
+import time
+from typing import Callable, Dict
+
+import numpy as np
+from absl import app, flags
+
+from scipy.optimize import least_squares
+
+from recon import kernel, proximity, system_model, warmup
+from spect import nmr_mix, nmr_timefit
+from utils import constants, spect_utils, traj_utils
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("benchmark", "sample_order", "name of the benchmark to run.")
+flags.DEFINE_integer("n_frames", 1000, "number of radial projections.")
+flags.DEFINE_integer("n_points", 64, "number of points per projection.")
+flags.DEFINE_integer("image_size", 128, "reconstructed image size.")
+flags.DEFINE_integer("n_repeat", 10, "number of repetitions per timing.")
+flags.DEFINE_string("module", "main", "module imported by the startup benchmark.")
+flags.DEFINE_float("noise", 0.02, "noise level of the synthetic spectroscopy FID.")
+
+
+def _get_synthetic_traj(n_frames: int, n_points: int, image_size: int) -> np.ndarray:
+    """Generate a scaled radial trajectory like the one used by the pipeline.
+
+    Args:
+        n_frames (int): number of radial projections.
+        n_points (int): number of points per projection.
+        image_size (int): reconstructed image size.
+    Returns:
+        np.ndarray: trajectory of shape (n_frames * n_points, 3)
+    """
+    traj_x, traj_y, traj_z = traj_utils.generate_trajectory(
+        n_frames=n_frames, n_points=n_points
+    )
+    traj = np.stack([traj_x, traj_y, traj_z], axis=-1).reshape((-1, 3))
+    return traj * traj_utils.get_scaling_factor(
+        recon_size=image_size, n_points=n_points, scale=True
+    )
+
+
+def _time(fun: Callable, n_repeat: int) -> float:
+    """Get the mean runtime of a function in seconds.
+
+    Args:
+        fun (Callable): function without arguments to time.
+        n_repeat (int): number of repetitions.
+    Returns:
+        float: mean runtime in seconds.
+    """
+    fun()
+    time_start = time.time()
+    for _ in range(n_repeat):
+        fun()
+    return (time.time() - time_start) / n_repeat
+
+
+def benchmark_sample_order():
+    """Benchmark SpMV (gather) and scatter throughput for different sample orders.
+
+    The keyhole reconstruction passes the samples sorted by their magnitude, which
+    is emulated by a random permutation of the acquisition order.
+    """
+    traj = _get_synthetic_traj(FLAGS.n_frames, FLAGS.n_points, FLAGS.image_size)
+    n_samples = traj.shape[0]
+    image_size = np.array([FLAGS.image_size] * 3)
+    prox_obj = proximity.L2Proximity(
+        kernel_obj=kernel.Gaussian(
+            kernel_extent=9 * 0.14, kernel_sigma=0.14, verbosity=False
+        ),
+        verbosity=False,
+    )
+    shuffled = np.random.default_rng(0).permutation(n_samples)
+    cases = {
+        "acquisition": (traj, constants.SampleOrder.ACQUISITION),
+        "magnitude sorted": (traj[shuffled], constants.SampleOrder.ACQUISITION),
+        "morton": (traj[shuffled], constants.SampleOrder.MORTON),
+    }
+    for name, (traj_case, sample_order) in cases.items():
+        system_obj = system_model.MatrixSystemModel(
+            proximity_obj=prox_obj,
+            overgrid_factor=3,
+            image_size=image_size,
+            traj=traj_case,
+            verbosity=False,
+            sample_order=sample_order,
+        )
+        data = np.ones((n_samples, 1), dtype=np.complex128)
+        grid = np.ones((system_obj.A.shape[1], 1), dtype=np.complex128)
+        time_gather = _time(lambda: system_obj.A.dot(grid), FLAGS.n_repeat)
+        time_scatter = _time(lambda: system_obj.ATrans.dot(data), FLAGS.n_repeat)
+        logging.info(
+            "%s order: SpMV %.1f Msamples/s, scatter %.1f Msamples/s (nnz %d)",
+            name,
+            1e-6 * n_samples / time_gather,
+            1e-6 * n_samples / time_scatter,
+            system_obj.A.nnz,
+        )
+
+
+def benchmark_jit_startup():
+    """Benchmark the startup cost of the numba kernels in a fresh process.
+
+    Reports the wall time of a new interpreter that imports and warms up the
+    kernels, and the time spent inside warmup. With a populated numba cache the
+    kernels are loaded instead of compiled.
+    """
+    command = [
+        sys.executable,
+        "-c",
+        "from recon import warmup; print(warmup.warmup())",
+    ]
+    for i in range(FLAGS.n_repeat):
+        time_start = time.time()
+        output = subprocess.run(command, capture_output=True, check=True, text=True)
+        logging.info(
+            "run %d: process %.2f s, warmup %.2f s",
+            i,
+            time.time() - time_start,
+            float(output.stdout.strip().splitlines()[-1]),
+        )
+
+
+def benchmark_import_startup():
+    """Benchmark the time and memory of importing the pipeline in a fresh process.
+
+    Heavy dependencies (TensorFlow, OpenCV, ISMRMRD, mapVBVD, pyplot, ...) are
+    imported lazily, so they should not show up here.
+    """
+    command = [
+        sys.executable,
+        "-c",
+        "import resource, sys, time\n"
+        "time_start = time.time()\n"
+        "import {}\n".format(FLAGS.module)
+        + "print(time.time() - time_start)\n"
+        "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n"
+        "print(len(sys.modules))",
+    ]
+    for i in range(FLAGS.n_repeat):
+        output = subprocess.run(command, capture_output=True, check=True, text=True)
+        runtime, max_rss, n_modules = output.stdout.strip().splitlines()[-3:]
+        logging.info(
+            "run %d: import %s %.2f s, max rss %.0f MB, %s modules",
+            i,
+            FLAGS.module,
+            float(runtime),
+            float(max_rss) / 1024,
+            n_modules,
+        )
+
+
+def _get_synthetic_fit(noise: float, seed: int) -> nmr_timefit.NMR_TimeFit:
+    """Generate a noisy 3-peak FID and its fit object with the pipeline guesses.
+
+    Args:
+        noise (float): standard deviation of the complex noise.
+        seed (int): seed of the noise.
+    Returns:
+        nmr_timefit.NMR_TimeFit: fit object that is not fitted yet.
+    """
+    center_freq = 34.09
+    tdata = np.arange(512) * 2e-5
+    truth = nmr_mix.NMR_Mix(
+        area=np.array([0.4, 1.0, 0.3]),
+        freq=np.array([0, -21.7, -218.0]) * center_freq + 30,
+        fwhmL=np.array([8.0, 5.5, 2.2]) * center_freq,
+        fwhmG=np.array([0, 6.0, 0]) * center_freq,
+        phase=np.array([10.0, -30.0, 5.0]),
+    )
+    rng = np.random.default_rng(seed)
+    ydata = truth.get_time_function(tdata) + noise * (
+        rng.standard_normal(tdata.size) + 1j * rng.standard_normal(tdata.size)
+    )
+    return nmr_timefit.NMR_TimeFit(
+        ydata=ydata,
+        tdata=tdata,
+        area=spect_utils.get_area_guess(None, center_freq, 218),
+        freq=spect_utils.get_frequency_guess(None, center_freq, 218),
+        fwhmL=np.array([8.8, 5.0, 2.0]) * center_freq,
+        fwhmG=np.array([0, 6.1, 0]) * center_freq,
+        phase=np.array([0, 0, 0]),
+    )
+
+
+def _fit_finite_differences(fit_obj: nmr_timefit.NMR_TimeFit) -> np.ndarray:
+    """Fit with the NMR_Mix model and a finite difference Jacobian.
+
+    This is the fit before the compiled model, for the parity check.
+
+    Args:
+        fit_obj (nmr_timefit.NMR_TimeFit): fit object that is not fitted yet.
+    Returns:
+        np.ndarray: fitted parameters of shape (5, 3).
+    """
+
+    def residual(x: np.ndarray) -> np.ndarray:
+        x = np.reshape(x, (5, 3))
+        signal = nmr_mix.NMR_Mix(
+            area=x[0], freq=x[1], fwhmL=x[2], fwhmG=x[3], phase=x[4]
+        ).get_time_function(fit_obj.tdata)
+        diff = fit_obj.ydata - signal
+        return np.concatenate([diff.real, diff.imag])
+
+    x0 = np.array(
+        [fit_obj.area, fit_obj.freq, fit_obj.fwhmL, fit_obj.fwhmG, fit_obj.phase]
+    ).flatten()
+    fit_result = least_squares(fun=residual, x0=x0, method="lm", ftol=1e-15, xtol=1e-09)
+    return fit_result["x"].reshape((5, 3))
+
+
+def benchmark_voigt_fit():
+    """Benchmark the static spectroscopy fit against the finite difference fit.
+
+    Reports the runtime of both fits of the same synthetic FIDs, the largest
+    relative difference of the fitted areas and the resulting RBC:M ratios.
+    """
+    warmup.warmup()
+    for i in range(FLAGS.n_repeat):
+        fit_obj = _get_synthetic_fit(FLAGS.noise, seed=i)
+        time_start = time.time()
+        param_reference = _fit_finite_differences(fit_obj)
+        time_reference = time.time() - time_start
+        time_start = time.time()
+        param = fit_obj.calc_time_fit_residual(bounds=(-np.inf, np.inf))
+        time_analytic = time.time() - time_start
+        area_diff = np.max(
+            np.abs(param[0] - param_reference[0]) / np.abs(param_reference[0])
+        )
+        logging.info(
+            "fit %d: finite differences %.1f ms, analytic %.1f ms, "
+            "max area difference %.1e, RBC:M %.5f vs %.5f",
+            i,
+            1e3 * time_reference,
+            1e3 * time_analytic,
+            area_diff,
+            abs(param_reference[0, 0]) / abs(param_reference[0, 1]),
+            abs(param[0, 0]) / abs(param[0, 1]),
+        )
+
+
+_BENCHMARKS: Dict[str, Callable] = {
+    "import_startup": benchmark_import_startup,
+    "jit_startup": benchmark_jit_startup,
+    "sample_order": benchmark_sample_order,
+    "voigt_fit": benchmark_voigt_fit,
+}
+
+
+def main(argv):
+    """Run the benchmark selected by the benchmark flag."""
+    if FLAGS.benchmark not in _BENCHMARKS:
+        raise ValueError("Invalid benchmark: {}".format(FLAGS.benchmark))
+    _BENCHMARKS[FLAGS.benchmark]()
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,125 @@
+"""Script to reconstruct the gas exchange images while the projections are acquired.
+
+Follows the gas exchange MRD file of a subject with mrd_utils.iter_gx_blocks and
+grids each block of projections into incremental reconstructions of the gas and
+dissolved phase, see recon.incremental. The protocol trajectory, and with it the
+cached DCF, is read from a complete MRD file of the same protocol, by default the
+followed file itself, so a finished scan can be replayed as well. The images of the
+projections received so far are written to the tmp directory after every block.
+"""
+import logging
+import os
+from typing import Any, Tuple
+
+import numpy as np
+from absl import app, flags
+from ml_collections import config_flags
+
+import reconstruction
+from config import base_config
+from utils import constants, img_utils, io_utils, mrd_utils, traj_utils
+from utils.lazy_import import lazy_import
+
+ismrmrd = lazy_import("ismrmrd")
+
+FLAGS = flags.FLAGS
+
+_CONFIG = config_flags.DEFINE_config_file("config", None, "config file.")
+flags.DEFINE_string(
+    "protocol_path",
+    "",
+    "complete MRD file of the same protocol. Defaults to the followed file.",
+)
+flags.DEFINE_integer("block_size", 100, "number of projections of each block.")
+
+
+def _open_dataset(path: str) -> Tuple[Any, Any]:
+    """Open an MRD dataset and parse its header.
+
+    Args:
+        path (str): path of the MRD file.
+    Returns:
+        Tuple of the dataset and its header.
+    """
+    dataset = ismrmrd.Dataset(path, "dataset", create_if_needed=False)
+    return dataset, ismrmrd.xsd.CreateFromDocument(dataset.read_xml_header())
+
+
+def get_protocol_traj(path: str, recon_size: int) -> np.ndarray:
+    """Get the scaled trajectory of a gas exchange protocol, as Subject.preprocess.
+
+    Args:
+        path (str): path of a complete MRD file of the protocol.
+        recon_size (int): reconstructed image size.
+    Returns:
+        np.ndarray: trajectory of shape (n_projections, n_points, 3).
+    """
+    dataset, header = _open_dataset(path)
+    try:
+        traj = mrd_utils.get_gx_data(dataset, header)[constants.IOFields.TRAJ]
+    finally:
+        dataset.close()
+    return traj * traj_utils.get_scaling_factor(
+        recon_size=recon_size, n_points=traj.shape[1], scale=True
+    )
+
+
+def incremental_recon(config: base_config.Config):
+    """Reconstruct the gas exchange images block by block.
+
+    Args:
+        config (config_dict.ConfigDict): config dict
+    """
+    path = io_utils.get_dis_mrd_files(str(config.data_dir))
+    traj = get_protocol_traj(
+        FLAGS.protocol_path or path, recon_size=int(config.recon.recon_size)
+    )
+    kernel_sharpness = float(config.recon.kernel_sharpness_lr)
+    recons = {
+        name: reconstruction.get_incremental_recon(
+            traj=traj,
+            kernel_sharpness=kernel_sharpness,
+            kernel_extent=9 * kernel_sharpness,
+            image_size=int(config.recon.recon_size),
+        )
+        for name in ["gas", "dissolved"]
+    }
+    os.makedirs(str(config.tmp_dir), exist_ok=True)
+    dataset, header = _open_dataset(path)
+    orientation = mrd_utils.get_orientation(header)
+    try:
+        for start, data_gas, data_dissolved in mrd_utils.iter_gx_blocks(
+            dataset, block_size=FLAGS.block_size
+        ):
+            indices = np.arange(start, start + data_gas.shape[0])
+            if indices[-1] >= traj.shape[0]:
+                raise ValueError(
+                    "Projection {} is not in the protocol trajectory of {} "
+                    "projections.".format(indices[-1], traj.shape[0])
+                )
+            recons["gas"].add(data_gas, indices)
+            recons["dissolved"].add(data_dissolved, indices)
+            for name, recon_obj in recons.items():
+                image = img_utils.flip_and_rotate_image(
+                    recon_obj.get_image(), orientation=orientation
+                )
+                filename = "incremental_{}.nii".format(name)
+                io_utils.export_nii(
+                    np.abs(image), os.path.join(str(config.tmp_dir), filename)
+                )
+            logging.info(
+                "Reconstructed {} of {} projections.".format(
+                    recons["gas"].n_projections, traj.shape[0]
+                )
+            )
+    finally:
+        dataset.close()
+
+
+def main(argv):
+    """Reconstruct the gas exchange images of a subject while it is acquired."""
+    incremental_recon(_CONFIG.value)
+
+
+if __name__ == "__main__":
+    app.run(main)
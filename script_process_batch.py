@@ -4,16 +4,304 @@ import importlib
 import logging
 import os
 import pdb
+import resource
+import time
+import traceback
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Tuple
 
 from absl import app, flags
 
 from main import oscillation_mapping_readin, oscillation_mapping_reconstruction
+from utils import io_utils, recon_utils
 
 FLAGS = flags.FLAGS
 
 flags.DEFINE_string("cohort", "healthy", "cohort folder name in config folder")
+flags.DEFINE_integer("n_workers", os.cpu_count(), "number of worker processes.")
+flags.DEFINE_float(
+    "memory_limit_gb",
+    0.0,
+    "memory budget of the batch in GB. Defaults to 80% of the physical memory.",
+)
+flags.DEFINE_string(
+    "record_path", "batch_record.csv", "csv file of the per-subject batch record."
+)
 
 CONFIG_PATH = "config/"
+# csv file of the statistics of all subjects, as written by Subject.write_stats_to_csv
+STATS_PATH = "data/stats_all.csv"
+
+# job modes
+_RECON = "recon"
+_READIN = "readin"
+# estimated peak memory of the baseline process and the read-in pipeline in bytes
+_BASE_MEMORY = 1.0e9
+# maximum number of reconstructions of a subject that can run at the same time
+_MAX_CONCURRENT_RECONS = 4
+
+
+def _get_physical_memory() -> float:
+    """Get the physical memory of the machine in bytes."""
+    return float(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"))
+
+
+def _get_job_mode(config: Any, force_recon: bool, force_readin: bool) -> str:
+    """Get the pipeline to run for a subject.
+
+    Args:
+        config (config_dict.ConfigDict): subject config.
+        force_recon (bool): run the reconstruction for every subject.
+        force_readin (bool): read in the subject file of every subject.
+    Returns:
+        str: job mode, or an empty string if the subject is not processed.
+    """
+    if force_recon:
+        return _RECON
+    elif force_readin:
+        return _READIN
+    elif config.processes.oscillation_mapping_recon:
+        return _RECON
+    elif config.processes.oscillation_mapping_readin:
+        return _READIN
+    return ""
+
+
+def estimate_peak_memory(config: Any, mode: str, n_stage_workers: int) -> float:
+    """Estimate the peak memory of a subject job.
+
+    The reconstruction is dominated by copies of the overgridded k-space volume for
+    each reconstruction running at the same time, the read-in pipeline only holds
+    images of the reconstructed size.
+
+    Args:
+        config (config_dict.ConfigDict): subject config.
+        mode (str): job mode.
+        n_stage_workers (int): number of stages of the subject run at once.
+    Returns:
+        float: estimated peak memory in bytes.
+    """
+    if mode == _RECON:
+        n_recons = min(n_stage_workers, _MAX_CONCURRENT_RECONS)
+        return _BASE_MEMORY + n_recons * recon_utils.estimate_recon_memory(
+            int(config.recon.recon_size)
+        )
+    return _BASE_MEMORY
+
+
+def _init_worker():
+    """Load the compiled numba kernels once per worker process."""
+    from recon import warmup
+
+    warmup.warmup()
+
+
+def _get_config(config_path: str) -> Any:
+    """Import the config of a subject.
+
+    Args:
+        config_path (str): path to the config python file.
+    Returns:
+        config_dict.ConfigDict: subject config.
+    """
+    config_obj = importlib.import_module(
+        name=config_path[:-3].replace("/", "."), package=None
+    )
+    return config_obj.get_config()
+
+
+def _get_failure_record(config_path: str, mode: str, error: str) -> Dict[str, Any]:
+    """Get the record of a job that failed.
+
+    Args:
+        config_path (str): path to the config python file.
+        mode (str): job mode.
+        error (str): error message.
+    Returns:
+        Dict[str, Any]: record of the job, with the fields of _run_subject.
+    """
+    return {
+        "config": config_path,
+        "subject_id": "",
+        "mode": mode,
+        "status": "failure",
+        "error": error,
+        "start_time": "",
+        "runtime_s": 0.0,
+        "worker_pid": 0,
+        "worker_max_rss_gb": 0.0,
+    }
+
+
+def _run_subject(
+    config_path: str,
+    mode: str,
+    n_stage_workers: int,
+    force_segmentation: bool,
+    n_subject_workers: int = 1,
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Run the pipeline of a single subject and record the outcome.
+
+    The arguments are passed explicitly, as the flags are only parsed in the parent
+    process. The figures and images of the report are written to a tmp directory in
+    the data directory of the subject, and the statistics are returned instead of
+    appended to the csv of all subjects, so subjects can run at the same time.
+
+    Args:
+        config_path (str): path to the config python file.
+        mode (str): job mode.
+        n_stage_workers (int): number of stages of the subject run at once.
+        force_segmentation (bool): segment the proton mask again in the read-in
+            pipeline.
+        n_subject_workers (int): number of subjects run at once, which share the
+            cpus of the dynamic spectroscopy fit.
+    Returns:
+        Tuple of the record of the job and the statistics of the subject, empty if
+        the job failed.
+    """
+    stats_dict = {}
+    record = {
+        "config": config_path,
+        "subject_id": "",
+        "mode": mode,
+        "status": "success",
+        "error": "",
+        "start_time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "runtime_s": 0.0,
+        "worker_pid": os.getpid(),
+        "worker_max_rss_gb": 0.0,
+    }
+    time_start = time.time()
+    try:
+        config = _get_config(config_path)
+        record["subject_id"] = config.subject_id
+        config.tmp_dir = os.path.join(config.data_dir, "tmp")
+        logging.info("Processing subject: %s", config.subject_id)
+        if mode == _RECON:
+            stats_dict = oscillation_mapping_reconstruction(
+                config,
+                n_stage_workers=n_stage_workers,
+                write_stats=False,
+                n_subject_workers=n_subject_workers,
+            )
+        else:
+            stats_dict = oscillation_mapping_readin(
+                config,
+                n_stage_workers=n_stage_workers,
+                force_segmentation=force_segmentation,
+                write_stats=False,
+            )
+    except Exception as e:
+        logging.warning(
+            "Failed to process subject: %s\n%s", config_path, traceback.format_exc()
+        )
+        record["status"] = "failure"
+        record["error"] = "{}: {}".format(type(e).__name__, e)
+    record["runtime_s"] = round(time.time() - time_start, 2)
+    # ru_maxrss is in kilobytes and the maximum over the lifetime of the worker
+    record["worker_max_rss_gb"] = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2, 2
+    )
+    return record, stats_dict
+
+
+def run_batch(
+    jobs: List[Tuple[str, str, float]],
+    n_workers: int,
+    memory_limit: float,
+    record_path: str,
+    n_stage_workers: int = 1,
+    force_segmentation: bool = False,
+    stats_path: str = STATS_PATH,
+) -> List[Dict[str, Any]]:
+    """Run subject jobs on a process pool without exceeding a memory budget.
+
+    Jobs are admitted strictly in order, largest first, while the sum of the
+    estimated peak memory of the running jobs stays within the budget. A job that
+    does not fit waits for running jobs to finish, and the smaller jobs queue behind
+    it, so a large job cannot be starved. A job that exceeds the budget on its own
+    is run alone. Each finished job is appended to the batch record, and the
+    statistics of each successful job to the csv of all subjects, both from this
+    process only. If a worker dies, e.g. killed for running out of memory, the jobs
+    of the pool are recorded as failed and the remaining jobs run on a new pool.
+
+    Args:
+        jobs (List[Tuple[str, str, float]]): config path, mode and estimated peak
+            memory in bytes of each job.
+        n_workers (int): number of worker processes.
+        memory_limit (float): memory budget in bytes.
+        record_path (str): csv file of the batch record.
+        n_stage_workers (int): number of stages of a subject run at once.
+        force_segmentation (bool): segment the proton mask again in the read-in
+            pipeline.
+        stats_path (str): csv file of the statistics of all subjects.
+    Returns:
+        List[Dict[str, Any]]: records of all jobs in order of completion.
+    """
+    pending = sorted(jobs, key=lambda job: job[2], reverse=True)
+    running = {}
+    records = []
+    executor = futures.ProcessPoolExecutor(
+        max_workers=n_workers, initializer=_init_worker
+    )
+    try:
+        while pending or running:
+            memory_in_use = sum(memory for _, _, memory in running.values())
+            while pending and len(running) < n_workers:
+                job = pending[0]
+                config_path, mode, memory = job
+                if running and memory_in_use + memory > memory_limit:
+                    break
+                future = executor.submit(
+                    _run_subject,
+                    config_path,
+                    mode,
+                    n_stage_workers,
+                    force_segmentation,
+                    n_workers,
+                )
+                running[future] = job
+                memory_in_use += memory
+                pending.pop(0)
+            done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            broken = any(
+                isinstance(future.exception(), BrokenProcessPool) for future in done
+            )
+            if broken:
+                # the other jobs of a broken pool fail as well
+                done, _ = futures.wait(running)
+            for future in done:
+                config_path, mode, memory = running.pop(future)
+                try:
+                    record, stats_dict = future.result()
+                except Exception as e:
+                    logging.warning("Worker of %s failed: %s", config_path, repr(e))
+                    record = _get_failure_record(
+                        config_path, mode, "{}: {}".format(type(e).__name__, e)
+                    )
+                    stats_dict = {}
+                if stats_dict:
+                    io_utils.export_subject_csv(stats_dict, path=stats_path)
+                record["estimated_memory_gb"] = round(memory / 1024**3, 2)
+                io_utils.export_subject_csv(record, path=record_path)
+                records.append(record)
+                logging.info(
+                    "%s %s in %.1f s (%d left)",
+                    record["subject_id"] or record["config"],
+                    record["status"],
+                    record["runtime_s"],
+                    len(pending) + len(running),
+                )
+            if broken:
+                logging.warning("Process pool broke, starting a new one.")
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = futures.ProcessPoolExecutor(
+                    max_workers=n_workers, initializer=_init_worker
+                )
+    finally:
+        executor.shutdown()
+    return records
 
 
 def main(argv):
@@ -54,25 +342,37 @@ def main(argv):
     else:
         raise ValueError("Invalid cohort name")
 
+    # parallelize across subjects instead of across the stages of a subject
+    n_stage_workers = max(FLAGS.n_stage_workers, 1)
+    jobs = []
     for subject in subjects:
         try:
-            config_obj = importlib.import_module(
-                name=subject[:-3].replace("/", "."), package=None
+            config = _get_config(subject)
+        except Exception:
+            logging.warning("Failed to import config: %s", subject)
+            continue
+        mode = _get_job_mode(config, FLAGS.force_recon, FLAGS.force_readin)
+        if mode:
+            jobs.append(
+                (subject, mode, estimate_peak_memory(config, mode, n_stage_workers))
             )
-            config = config_obj.get_config()
-            logging.info("Processing subject: %s", config.subject_id)
-            if FLAGS.force_recon:
-                oscillation_mapping_reconstruction(config)
-            elif FLAGS.force_readin:
-                oscillation_mapping_readin(config)
-            elif config.processes.oscillation_mapping_reconstruction:
-                oscillation_mapping_reconstruction(config)
-            elif config.processes.oscillation_mapping_readin:
-                oscillation_mapping_readin(config)
-            else:
-                pass
-        except:
-            logging.warning("Failed to process subject: %s", subject)
+
+    memory_limit = FLAGS.memory_limit_gb * 1024**3 or 0.8 * _get_physical_memory()
+    records = run_batch(
+        jobs=jobs,
+        n_workers=FLAGS.n_workers,
+        memory_limit=memory_limit,
+        record_path=FLAGS.record_path,
+        n_stage_workers=n_stage_workers,
+        force_segmentation=FLAGS.force_segmentation,
+    )
+    n_failed = sum(record["status"] != "success" for record in records)
+    logging.info(
+        "Processed %d subjects, %d failed. Record: %s",
+        len(records),
+        n_failed,
+        FLAGS.record_path,
+    )
 
 
 if __name__ == "__main__":
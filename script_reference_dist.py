@@ -28,7 +28,7 @@ def oscillation_mapping_analysis(config: base_config.Config) -> np.ndarray:
         image_rbc_osc (np.ndarray): RBC amplitude oscillation image
     """
     subject = Subject(config)
-    subject.read_mat_file()
+    subject.read_subject_file()
     if FLAGS.segmentation:
         subject.segmentation()
     subject.dixon_decomposition()
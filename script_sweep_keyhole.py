@@ -0,0 +1,198 @@
+"""Script to sweep the keyhole and binning settings of the oscillation mapping.
+
+Reads and preprocesses one subject once, then evaluates every combination of key
+radius, binning method, distance threshold and bin selection. All keyhole reconstructions share the
+system model of the full dissolved-phase trajectory. The oscillation statistics of
+each setting are written as one row of a csv file.
+"""
+import copy
+import csv
+import itertools
+import logging
+import os
+import pdb
+from concurrent import futures
+from typing import Any, Dict, List
+
+from absl import app, flags
+from ml_collections import config_flags
+
+from config import base_config
+from recon import system_model
+from subject_classmap import Subject
+from utils import constants, recon_utils
+
+FLAGS = flags.FLAGS
+
+_CONFIG = config_flags.DEFINE_config_file("config", None, "config file.")
+flags.DEFINE_list("key_radii", ["5", "7", "9", "11"], "key radii to evaluate.")
+flags.DEFINE_list(
+    "binning_methods",
+    [constants.BinningMethods.BANDPASS, constants.BinningMethods.FIT_SINE],
+    "binning methods to evaluate.",
+)
+flags.DEFINE_list(
+    "distance_thresholds", ["0.1", "0.2", "0.3"], "distance thresholds to evaluate."
+)
+flags.DEFINE_list(
+    "bin_selections",
+    [constants.BinningMethods.PEAKS, constants.BinningMethods.PHASE],
+    "methods to select the high and low bins to evaluate.",
+)
+flags.DEFINE_bool("readin", False, "read the subject file instead of the raw data.")
+flags.DEFINE_integer(
+    "n_workers",
+    0,
+    "number of settings evaluated at once. 0 to choose from the number of cpus and "
+    "the memory of the machine.",
+)
+flags.DEFINE_string("output_path", "", "csv file of the sweep. Defaults to data_dir.")
+
+# stages after the keyhole reconstruction that the statistics depend on
+_SETTING_STAGES = [
+    "dixon_decomposition",
+    "oscillation_analysis",
+    "oscillation_binning",
+    "get_statistics",
+]
+
+# subject and system model shared by the settings of a worker process
+_SUBJECT = None
+_SYSTEM_OBJ = None
+
+
+def load_subject(config: base_config.Config) -> Subject:
+    """Prepare the subject up to the keyhole reconstruction.
+
+    Args:
+        config (config_dict.ConfigDict): config dict
+    Returns:
+        Subject: subject with the gas and dissolved images and the mask.
+    """
+    subject = Subject(config=config)
+    if FLAGS.readin:
+        subject.read_subject_file()
+        return subject
+    subject.read_files()
+    subject.preprocess()
+    subject.run_stages(
+        ["reconstruction_gas", "reconstruction_dissolved", "segmentation"]
+    )
+    return subject
+
+
+def _init_worker(subject: Subject, system_obj: system_model.MatrixSystemModel):
+    """Set the subject and system model of a worker process.
+
+    Args:
+        subject (Subject): subject prepared by load_subject.
+        system_obj (MatrixSystemModel): system model of the full dissolved-phase
+            trajectory.
+    """
+    global _SUBJECT, _SYSTEM_OBJ
+    _SUBJECT = subject
+    _SYSTEM_OBJ = system_obj
+
+
+def evaluate_setting(
+    key_radius: int, binning_method: str, distance_threshold: float, bin_selection: str
+) -> Dict[str, Any]:
+    """Calculate the oscillation statistics of a setting.
+
+    Args:
+        key_radius (int): key radius of the keyhole reconstruction.
+        binning_method (str): binning method, see constants.BinningMethods.
+        distance_threshold (float): fraction of the cardiac cycle around each peak
+            that is binned.
+        bin_selection (str): method to select the high and low bins, see
+            constants.BinningMethods.
+    Returns:
+        Dict[str, Any]: setting and statistics of the subject.
+    """
+    subject = copy.copy(_SUBJECT)
+    subject.config = copy.deepcopy(_SUBJECT.config)
+    subject.config.recon.key_radius = key_radius
+    subject.config.recon.binning_method = binning_method
+    subject.config.recon.distance_threshold = distance_threshold
+    subject.config.recon.bin_selection = bin_selection
+    subject.reconstruction_rbc_oscillation(system_obj=_SYSTEM_OBJ)
+    for stage in _SETTING_STAGES:
+        getattr(subject, stage)()
+    row = {
+        constants.StatsIOFields.BINNING_METHOD: binning_method,
+        constants.StatsIOFields.DISTANCE_THRESHOLD: distance_threshold,
+        constants.StatsIOFields.BIN_SELECTION: bin_selection,
+        constants.StatsIOFields.N_BINNED: len(subject.high_indices),
+        constants.StatsIOFields.RBC_M_RATIO_HIGH: subject.rbc_m_ratio_high,
+        constants.StatsIOFields.RBC_M_RATIO_LOW: subject.rbc_m_ratio_low,
+    }
+    row.update(subject.stats_dict)
+    return row
+
+
+def get_n_workers(config: base_config.Config, n_settings: int) -> int:
+    """Get the number of settings to evaluate at the same time.
+
+    Args:
+        config (config_dict.ConfigDict): config dict
+        n_settings (int): number of settings.
+    Returns:
+        int: number of worker processes.
+    """
+    if FLAGS.n_workers > 0:
+        return min(FLAGS.n_workers, n_settings)
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    n_recons = memory // recon_utils.estimate_recon_memory(config.recon.recon_size)
+    return int(max(1, min(os.cpu_count() or 1, n_settings, n_recons)))
+
+
+def sweep(config: base_config.Config) -> List[Dict[str, Any]]:
+    """Evaluate all settings of the sweep for a subject.
+
+    Args:
+        config (config_dict.ConfigDict): config dict
+    Returns:
+        List[Dict[str, Any]]: one row of settings and statistics per setting.
+    """
+    settings = list(
+        itertools.product(
+            [int(key_radius) for key_radius in FLAGS.key_radii],
+            FLAGS.binning_methods,
+            [float(threshold) for threshold in FLAGS.distance_thresholds],
+            FLAGS.bin_selections,
+        )
+    )
+    subject = load_subject(config)
+    logging.info("Calculating the system model of the dissolved-phase trajectory.")
+    system_obj = subject.get_dissolved_system_model()
+    n_workers = get_n_workers(config, len(settings))
+    logging.info(
+        "Evaluating {} settings on {} workers.".format(len(settings), n_workers)
+    )
+    if n_workers == 1:
+        _init_worker(subject, system_obj)
+        return [evaluate_setting(*setting) for setting in settings]
+    with futures.ProcessPoolExecutor(
+        max_workers=n_workers,
+        initializer=_init_worker,
+        initargs=(subject, system_obj),
+    ) as executor:
+        return list(executor.map(evaluate_setting, *zip(*settings)))
+
+
+def main(argv):
+    """Run the sweep and write the table of statistics."""
+    config = _CONFIG.value
+    rows = sweep(config)
+    path = FLAGS.output_path or os.path.join(
+        config.data_dir, "sweep_{}.csv".format(config.subject_id)
+    )
+    with open(path, "w", newline="") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    logging.info("Wrote {} settings to {}".format(len(rows), path))
+
+
+if __name__ == "__main__":
+    app.run(main)
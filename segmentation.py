@@ -8,7 +8,6 @@ import numpy as np
 from absl import app, flags
 from scipy.ndimage import zoom
 
-from models.model_vnet import vnet
 from utils import constants, img_utils, io_utils
 
 # define flags
@@ -17,6 +16,9 @@ FLAGS = flags.FLAGS
 flags.DEFINE_string("image_type", "vent", "either ute or vent for segmentation")
 flags.DEFINE_string("nii_filepath", "", "nii image file path")
 
+# weights of the ventilation image segmentation model
+WEIGHTS_PATH_VENT = "./models/weights/model_ANATOMY_VEN.h5"
+
 
 def predict(
     image: np.ndarray,
@@ -42,9 +44,12 @@ def predict(
     else:
         raise ValueError("Segmentation Image size should be 128 x 128 x n")
 
+    # tensorflow is only imported when a segmentation model is needed
+    from models.model_vnet import vnet
+
     if image_type == constants.ImageType.VENT.value:
         model = vnet(input_size=(128, 128, 128, 1))
-        weights_dir_current = "./models/weights/model_ANATOMY_VEN.h5"
+        weights_dir_current = WEIGHTS_PATH_VENT
     else:
         raise ValueError("image_type must be ute or vent")
 
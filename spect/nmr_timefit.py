@@ -5,14 +5,14 @@ import sys
 from typing import Optional
 
 sys.path.append("..")
-import matplotlib
-
-matplotlib.use("TkAgg")
 import numpy as np
-from matplotlib import pyplot as plt
 from scipy.optimize import least_squares
 
+from spect import voigt
 from spect.nmr_mix import NMR_Mix
+from utils.lazy_import import lazy_import
+
+plt = lazy_import("matplotlib.pyplot")
 
 
 class NMR_TimeFit(NMR_Mix):
@@ -32,6 +32,8 @@ class NMR_TimeFit(NMR_Mix):
         dwell_time (float): Dwell time in seconds.
         spectral_signal (np.ndarray): Spectral signal.
         f (np.ndarray): Frequency points in Hz.
+        nfev (int): Number of residual evaluations of the last fit.
+        n_alias_refits (int): Number of refits of aliased frequencies of the last fit.
     """
 
     def __init__(
@@ -88,16 +90,72 @@ class NMR_TimeFit(NMR_Mix):
         self.f = np.linspace(-0.5, 0.5, self.zeropad_size + 1) / self.dwell_time
         # take out last sample to have the right number of samples
         self.f = self.f[:-1]
+        self.nfev = 0
+        self.n_alias_refits = 0
         self.sort_freq()
 
+    def guess_components(self, oversample: int = 4):
+        """Refine the area, frequency and phase guesses from the data.
+
+        The frequency guesses are first shifted by the offset of the peak of the
+        most isolated component, the gas, in the magnitude of the zero-padded
+        spectrum. Then the peak of every other component is picked within a quarter
+        of the distance to the closest other component. Only local maxima are
+        accepted, a component that only shows as a shoulder keeps its shifted
+        frequency guess. The complex areas, i.e. the area and phase, of the
+        components at these frequencies and the guessed linewidths are then
+        integrated by a linear least squares fit to the data.
+
+        Args:
+            oversample (int): zero padding factor of the spectrum.
+        """
+        n_pad = oversample * self.zeropad_size
+        magnitude = np.abs(np.fft.fft(self.ydata, n_pad))
+        df = 1.0 / (n_pad * self.dwell_time)
+        centers = np.round(self.freq / df).astype(int)
+        # distance of each component to the closest other one on the circular
+        # frequency axis
+        distance = np.abs(centers[:, np.newaxis] - centers[np.newaxis, :]) % n_pad
+        distance = np.minimum(distance, n_pad - distance)
+        np.fill_diagonal(distance, n_pad)
+        distance = np.min(distance, axis=1)
+
+        def get_peak_offset(k: int, half_width: int) -> int:
+            window = np.arange(-half_width, half_width + 1)
+            i_peak = np.argmax(magnitude[(centers[k] + window) % n_pad])
+            return window[i_peak] if 0 < i_peak < window.size - 1 else 0
+
+        k_isolated = np.argmax(distance)
+        offset = get_peak_offset(k_isolated, max(1, distance[k_isolated] // 2))
+        centers += offset
+        freq = np.array(self.freq, dtype=float) + offset * df
+        for k in range(np.size(freq)):
+            if k != k_isolated:
+                freq[k] += get_peak_offset(k, max(1, distance[k] // 4)) * df
+        x = np.array(
+            [np.ones_like(freq), freq, self.fwhmL, self.fwhmG, np.zeros_like(freq)],
+            dtype=float,
+        ).flatten()
+        basis = voigt.get_basis(x, np.asarray(self.tdata, dtype=float))
+        coefs = np.linalg.lstsq(basis.T, self.ydata, rcond=None)[0]
+        self.set_components(
+            area=np.abs(coefs),
+            freq=freq,
+            fwhmL=self.fwhmL,
+            fwhmG=self.fwhmG,
+            phase=np.angle(coefs, deg=True),
+        )
+
     def calc_time_fit_residual(self, bounds):
         """Fit the time domain signal using least square curve fitting.
 
-        Running trust region reflection algorithm.
+        Running trust region reflection algorithm with the analytic Jacobian of the
+        compiled voigt model.
         Args:
             bounds (list): Bounds for the fitting parameters.
         """
         fun = self.get_residual_time_function
+        jac = self.get_residual_time_jacobian
         if self.method == "voigt":
             x0 = np.array(
                 [self.area, self.freq, self.fwhmL, self.fwhmG, self.phase]
@@ -108,11 +166,14 @@ class NMR_TimeFit(NMR_Mix):
         fit_result = least_squares(
             fun=fun,
             x0=x0,
+            jac=jac,
             method="lm",
             ftol=1e-15,
             xtol=1e-09,
             bounds=bounds,
         )
+        self.nfev = fit_result["nfev"]
+        self.n_alias_refits = 0
         # resolving the fitting results
         fit_param = fit_result["x"]
         n_fre = int(np.size(fit_param) / self.ncomp)
@@ -138,11 +199,13 @@ class NMR_TimeFit(NMR_Mix):
             fit_result = least_squares(
                 fun=fun,
                 x0=x0,
-                jac="3-point",
+                jac=jac,
                 bounds=(-np.inf, np.inf),
                 method="trf",
             )
 
+            self.nfev += fit_result["nfev"]
+            self.n_alias_refits += 1
             fit_param = fit_result["x"].reshape([5, 3])
             fit_freq = fit_param[1, :]
 
@@ -159,24 +222,26 @@ class NMR_TimeFit(NMR_Mix):
             x (np.ndarray): Fitting parameters of shape [area, freq, fwhmL, fwhmG,
              phase]
         """
-        if self.method == "voigt":
-            x = np.reshape(x, (5, int(np.size(x) / 5)))
-            tmpNMRMix = NMR_Mix(
-                area=x[0, :],
-                freq=x[1, :],
-                fwhmL=x[2, :],
-                fwhmG=x[3, :],
-                phase=x[4, :],
-                method="voigt",
-            )
-        else:
+        if self.method != "voigt":
             raise ValueError("Only voigt method is supported for time domain fitting.")
+        return voigt.get_residual(
+            np.asarray(x, dtype=float),
+            np.asarray(self.tdata, dtype=float),
+            np.asarray(self.ydata, dtype=complex),
+        )
+
+    def get_residual_time_jacobian(self, x: np.ndarray):
+        """Calculate the Jacobian of the residual of fitting.
 
-        complex_fit_time = tmpNMRMix.get_time_function(self.tdata)
-        fit_sig = np.array([np.real(complex_fit_time), np.imag(complex_fit_time)])
-        truth_sig = np.array([np.real(self.ydata), np.imag(self.ydata)])
-        residual = (truth_sig - fit_sig).flatten()
-        return residual
+        Args:
+            x (np.ndarray): Fitting parameters of shape [area, freq, fwhmL, fwhmG,
+             phase]
+        """
+        if self.method != "voigt":
+            raise ValueError("Only voigt method is supported for time domain fitting.")
+        return voigt.get_jacobian(
+            np.asarray(x, dtype=float), np.asarray(self.tdata, dtype=float)
+        )
 
     def fit_time_signal_residual(
         self,
@@ -0,0 +1,116 @@
+"""Compiled residual and Jacobian of the 3-component Voigt time domain model.
+
+The model is the one of NMR_Mix.get_time_function: each component k contributes
+
+    area_k * exp(1j * pi / 180 * phase_k + 1j * 2 * pi * t * freq_k)
+        * exp(-pi * t * fwhmL_k) * exp(-4 * log(2) * t**2 * fwhmG_k**2)
+
+where the first (gas) component has no Gaussian decay. The parameters are stacked
+like in NMR_TimeFit, x = [area, freq, fwhmL, fwhmG, phase].flatten(), and the
+residual is [real(y - s), imag(y - s)]. Since every partial derivative of a
+component is the component times a factor, the Jacobian costs about as much as one
+model evaluation, instead of one evaluation per parameter for finite differences.
+"""
+import math
+
+import numpy as np
+from numba import njit
+
+# number of components and of parameters per component
+N_COMPONENTS = 3
+N_PARAMS = 5
+
+
+@njit(cache=True, nogil=True)
+def get_basis(x: np.ndarray, tdata: np.ndarray) -> np.ndarray:
+    """Calculate the time signal of each component with unit area.
+
+    Args:
+        x (np.ndarray): parameters of shape (N_PARAMS * N_COMPONENTS,).
+        tdata (np.ndarray): time points in seconds.
+    Returns:
+        np.ndarray: unit area components of shape (N_COMPONENTS, n_points).
+    """
+    basis = np.empty((N_COMPONENTS, tdata.shape[0]), dtype=np.complex128)
+    log2x4 = 4.0 * math.log(2.0)
+    for k in range(N_COMPONENTS):
+        freq = x[N_COMPONENTS + k]
+        fwhmL = x[2 * N_COMPONENTS + k]
+        fwhmG = x[3 * N_COMPONENTS + k] if k > 0 else 0.0
+        phase = math.pi / 180.0 * x[4 * N_COMPONENTS + k]
+        for i in range(tdata.shape[0]):
+            t = tdata[i]
+            angle = phase + 2.0 * math.pi * t * freq
+            decay = math.exp(-math.pi * t * fwhmL - log2x4 * t * t * fwhmG * fwhmG)
+            basis[k, i] = complex(decay * math.cos(angle), decay * math.sin(angle))
+    return basis
+
+
+@njit(cache=True, nogil=True)
+def get_time_function(x: np.ndarray, tdata: np.ndarray) -> np.ndarray:
+    """Calculate the time domain signal of the model.
+
+    Args:
+        x (np.ndarray): parameters of shape (N_PARAMS * N_COMPONENTS,).
+        tdata (np.ndarray): time points in seconds.
+    Returns:
+        np.ndarray: complex time domain signal.
+    """
+    basis = get_basis(x, tdata)
+    signal = np.zeros(tdata.shape[0], dtype=np.complex128)
+    for k in range(N_COMPONENTS):
+        signal += x[k] * basis[k]
+    return signal
+
+
+@njit(cache=True, nogil=True)
+def get_residual(x: np.ndarray, tdata: np.ndarray, ydata: np.ndarray) -> np.ndarray:
+    """Calculate the residual of the model.
+
+    Args:
+        x (np.ndarray): parameters of shape (N_PARAMS * N_COMPONENTS,).
+        tdata (np.ndarray): time points in seconds.
+        ydata (np.ndarray): complex time domain data.
+    Returns:
+        np.ndarray: real and imaginary residual of shape (2 * n_points,).
+    """
+    n_points = tdata.shape[0]
+    diff = ydata - get_time_function(x, tdata)
+    residual = np.empty(2 * n_points)
+    residual[:n_points] = diff.real
+    residual[n_points:] = diff.imag
+    return residual
+
+
+@njit(cache=True, nogil=True)
+def get_jacobian(x: np.ndarray, tdata: np.ndarray) -> np.ndarray:
+    """Calculate the Jacobian of the residual.
+
+    Args:
+        x (np.ndarray): parameters of shape (N_PARAMS * N_COMPONENTS,).
+        tdata (np.ndarray): time points in seconds.
+    Returns:
+        np.ndarray: Jacobian of shape (2 * n_points, N_PARAMS * N_COMPONENTS).
+    """
+    n_points = tdata.shape[0]
+    basis = get_basis(x, tdata)
+    jac = np.zeros((2 * n_points, N_PARAMS * N_COMPONENTS))
+    log2x8 = 8.0 * math.log(2.0)
+    for k in range(N_COMPONENTS):
+        area = x[k]
+        fwhmG = x[3 * N_COMPONENTS + k]
+        for i in range(n_points):
+            t = tdata[i]
+            component = area * basis[k, i]
+            # derivatives of the model, the residual is data minus model
+            derivatives = (
+                basis[k, i],
+                2j * math.pi * t * component,
+                -math.pi * t * component,
+                -log2x8 * t * t * fwhmG * component if k > 0 else 0j,
+                1j * math.pi / 180.0 * component,
+            )
+            for p in range(N_PARAMS):
+                jac[i, p * N_COMPONENTS + k] = -derivatives[p].real
+                jac[n_points + i, p * N_COMPONENTS + k] = -derivatives[p].imag
+    return jac
@@ -1,8 +1,10 @@
 """Module for oscillation imaging subject."""
+import functools
 import glob
 import logging
 import os
 import pdb
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import nibabel as nib
 import numpy as np
@@ -12,6 +14,7 @@ import preprocessing as pp
 import reconstruction
 import segmentation
 from config import base_config
+from recon import system_model
 from utils import (
     binning,
     constants,
@@ -19,10 +22,14 @@ from utils import (
     io_utils,
     metrics,
     plot,
+    raw_cache,
     recon_utils,
+    checkpoint_utils,
     report,
     signal_utils,
     spect_utils,
+    stage_utils,
+    subject_store,
     traj_utils,
 )
 
@@ -42,6 +49,8 @@ class Subject(object):
         data_ute (np.array): UTE proton data of shape (n_projections, n_points)
         dict_dis (dict): dictionary of dissolved-phase data and metadata
         dict_dyn (dict): dictionary of dynamic spectroscopy data and metadata
+        dict_dyn_fit (dict): time series of the dynamic spectroscopy fit, see
+            constants.DynSpectFields
         dict_ute (dict): dictionary of UTE proton data and metadata
         high_indices (np.array): indices of high projections of shape (n, )
         low_indices (np.array): indices of low projections of shape (n, )
@@ -74,6 +83,96 @@ class Subject(object):
         traj_ute (np.array): UTE proton trajectory of shape
     """
 
+    # stages that run after preprocess and the stages whose outputs they read.
+    # Dependencies on stages that are not run are ignored.
+    STAGE_DEPENDENCIES = {
+        "reconstruction_ute": [],
+        "reconstruction_gas": [],
+        "reconstruction_dissolved": [],
+        "reconstruction_rbc_oscillation": [],
+        "segmentation": ["reconstruction_gas"],
+        "save_subject": [
+            "reconstruction_ute",
+            "reconstruction_gas",
+            "reconstruction_dissolved",
+            "reconstruction_rbc_oscillation",
+            "segmentation",
+        ],
+        # the store is a snapshot of all attributes, so nothing may modify the
+        # subject while it is written
+        "dixon_decomposition": ["save_subject"],
+        "dissolved_analysis": ["dixon_decomposition"],
+        "dissolved_binning": ["dissolved_analysis"],
+        "oscillation_analysis": ["dixon_decomposition"],
+        "oscillation_binning": ["oscillation_analysis"],
+        "get_statistics": ["dissolved_binning", "oscillation_binning"],
+        "write_stats_to_csv": ["get_statistics"],
+        "generate_figures": ["dissolved_binning", "oscillation_binning"],
+        "generate_pdf": ["get_statistics", "generate_figures"],
+        "save_files": ["dissolved_binning", "oscillation_binning"],
+    }
+    # config parameters read by each stage
+    STAGE_PARAMS = {
+        "reconstruction_ute": [
+            "recon.kernel_sharpness_hr",
+            "recon.autotune",
+            "recon.autotune_tolerance",
+        ],
+        "reconstruction_gas": [
+            "recon.kernel_sharpness_lr",
+            "recon.autotune",
+            "recon.autotune_tolerance",
+        ],
+        "reconstruction_dissolved": [
+            "recon.kernel_sharpness_lr",
+            "recon.autotune",
+            "recon.autotune_tolerance",
+        ],
+        "reconstruction_rbc_oscillation": [
+            "recon.kernel_sharpness_lr",
+            "recon.key_radius",
+            "recon.binning_method",
+            "recon.distance_threshold",
+            "recon.bin_selection",
+            "recon.autotune",
+            "recon.autotune_tolerance",
+        ],
+        "segmentation": ["segmentation_key", "manual_seg_filepath"],
+        "dissolved_binning": ["params.threshold_rbc"],
+        "oscillation_binning": ["params.threshold_oscillation"],
+        "get_statistics": ["subject_id"],
+    }
+    # attributes written by each stage, restored from checkpoints. Stages without
+    # outputs only write files and always run.
+    STAGE_OUTPUTS = {
+        "reconstruction_ute": ["image_ute"],
+        "reconstruction_gas": ["image_gas"],
+        "reconstruction_dissolved": ["image_dissolved_norm", "image_dissolved"],
+        "reconstruction_rbc_oscillation": [
+            "data_rbc_k0",
+            "high_indices",
+            "low_indices",
+            "rbc_m_ratio_high",
+            "rbc_m_ratio_low",
+            "key_radius",
+            "image_dissolved_high",
+            "image_dissolved_low",
+        ],
+        "segmentation": ["mask"],
+        "dixon_decomposition": [
+            "image_rbc",
+            "image_membrane",
+            "image_rbc_norm",
+            "image_rbc_high",
+            "image_rbc_low",
+        ],
+        "dissolved_analysis": ["image_rbc2gas", "image_membrane2gas"],
+        "dissolved_binning": ["image_rbc_binned"],
+        "oscillation_analysis": ["mask_rbc", "image_rbc_osc"],
+        "oscillation_binning": ["image_rbc_osc_binned"],
+        "get_statistics": ["stats_dict"],
+    }
+
     def __init__(self, config: base_config.Config):
         """Init object."""
         logging.info("Initializing oscillation imaging subject.")
@@ -84,6 +183,7 @@ class Subject(object):
         self.data_gas = np.array([])
         self.dict_dis = {}
         self.dict_dyn = {}
+        self.dict_dyn_fit = {}
         self.high_indices = np.array([0.0])
         self.image_dissolved = np.array([0.0])
         self.image_dissolved_norm = np.array([0.0])
@@ -110,67 +210,144 @@ class Subject(object):
         self.traj_dis_high = np.array([])
         self.traj_dis_low = np.array([])
         self.traj_gas = np.array([])
+        self._static_fit = None
+        self._store = None
+
+    def __getattr__(self, name: str):
+        """Load an attribute from the subject store on first access."""
+        store = self.__dict__.get("_store")
+        if store is None or name not in store:
+            raise AttributeError(
+                "'{}' object has no attribute '{}'".format(type(self).__name__, name)
+            )
+        value = store.load(name)
+        setattr(self, name, value)
+        return value
+
+    def read_files(self, max_workers: int = 3):
+        """Read in the raw files and calculate the RBC:M ratio.
 
-    def read_twix_files(self):
-        """Read in twix files to dictionary.
+        The file format is detected from the files in the data directory. The files
+        are read concurrently, and the static spectroscopy fit starts as soon as the
+        dynamic spectroscopy is read so that it overlaps the read of the other files.
+        The dynamic spectroscopy fit, if enabled, runs after all files are read.
 
-        Read in the dynamic spectroscopy (if it exists) and the dissolved-phase image
-        data.
+        Args:
+            max_workers (int): number of files to read at the same time.
         """
-        self.dict_dyn = io_utils.read_dyn_twix(
-            io_utils.get_dyn_twix_files(str(self.config.data_dir))
-        )
-        self.dict_dis = io_utils.read_dis_twix(
-            io_utils.get_dis_twix_files(str(self.config.data_dir))
+
+        def get_reader(name: str, read_fn: Callable, path: str) -> Callable:
+            def read():
+                setattr(self, name, self._read_raw_file(read_fn, path))
+
+            return read
+
+        stages = {
+            "read_" + name: get_reader(name, read_fn, path)
+            for name, (read_fn, path) in self._get_raw_files().items()
+        }
+        dependencies = {"calculate_rbc_m_ratio": ["read_dict_dyn"]}
+        if self.config.processes.dynamic_spectroscopy:
+            dependencies["calculate_dynamic_spectroscopy"] = list(stages) + [
+                "calculate_rbc_m_ratio"
+            ]
+            stages["calculate_dynamic_spectroscopy"] = (
+                self.calculate_dynamic_spectroscopy
+            )
+        stages["calculate_rbc_m_ratio"] = self.calculate_rbc_m_ratio
+        stage_utils.run_dag(
+            stages=stages, dependencies=dependencies, max_workers=max_workers
         )
+
+    def _get_raw_files(self) -> Dict[str, Tuple[Callable, str]]:
+        """Find the raw files in the data directory.
+
+        Twix files are used if they are found, MRD files otherwise.
+
+        Returns:
+            Dict[str, Tuple[Callable, str]]: attribute name, and the reader and path
+                of the raw file of the attribute.
+        """
+        data_dir = str(self.config.data_dir)
+        try:
+            files = {
+                "dict_dyn": (
+                    io_utils.read_dyn_twix,
+                    io_utils.get_dyn_twix_files(data_dir),
+                ),
+                "dict_dis": (
+                    io_utils.read_dis_twix,
+                    io_utils.get_dis_twix_files(data_dir),
+                ),
+            }
+        except ValueError:
+            logging.info("No twix files found, reading MRD files.")
+            return {
+                "dict_dyn": (
+                    io_utils.read_dyn_mrd,
+                    io_utils.get_dyn_mrd_files(data_dir),
+                ),
+                "dict_dis": (
+                    io_utils.read_dis_mrd,
+                    io_utils.get_dis_mrd_files(data_dir),
+                ),
+            }
         if self.config.recon.recon_proton:
-            self.dict_ute = io_utils.read_ute_twix(
-                io_utils.get_ute_twix_files(str(self.config.data_dir))
+            files["dict_ute"] = (
+                io_utils.read_ute_twix,
+                io_utils.get_ute_twix_files(data_dir),
             )
+        return files
 
-    def read_mrd_files(self):
-        """Read in mrd files to dictionary.
+    def _read_raw_file(self, read_fn: Callable, path: str) -> Dict[str, Any]:
+        """Read a raw file, through the raw data cache if enabled.
 
-        Read in the dynamic spectroscopy (if it exists) and the dissolved-phase image
-        data.
+        Args:
+            read_fn (Callable): reader of the raw file in io_utils.
+            path (str): path of the raw file.
+        Returns:
+            Dict[str, Any]: data and metadata of the scan.
         """
-        self.dict_dyn = io_utils.read_dyn_mrd(
-            io_utils.get_dyn_mrd_files(str(self.config.data_dir))
-        )
-        self.dict_dis = io_utils.read_dis_mrd(
-            io_utils.get_dis_mrd_files(str(self.config.data_dir))
-        )
+        if self.config.processes.cache_raw_data:
+            return raw_cache.read_cached(read_fn, path)
+        return read_fn(path)
 
     def read_mat_file(self):
-        """Read in mat file of reconstructed images.
+        """Read in mat file of reconstructed images."""
+        mdict = io_utils.import_subject_mat(
+            io_utils.get_mat_file(str(self.config.data_dir))
+        )
+        for key, value in mdict.items():
+            setattr(self, key, value)
+
+    def read_subject_store(self):
+        """Open the subject store of reconstructed images.
 
-        Note: The mat file variable names are matched to the instance variable names.
-        Thus, if the variable names are changed in the mat file, they must be changed.
+        The stored attributes are only read from disk on first access, so the
+        analysis only loads the arrays it uses.
         """
-        mdict = io_utils.import_mat(io_utils.get_mat_file(str(self.config.data_dir)))
-        self.dict_dis = io_utils.import_matstruct_to_dict(mdict["dict_dis"])
-        self.dict_dyn = io_utils.import_matstruct_to_dict(mdict["dict_dyn"])
-        if "dict_ute" in mdict.keys():
+        self._store = subject_store.SubjectStore(
+            io_utils.get_subject_store_file(str(self.config.data_dir))
+        )
+        for key in self._store.keys():
+            self.__dict__.pop(key, None)
+        if "dict_ute" in self._store:
             logging.info("UTE proton data found.")
-            self.dict_ute = io_utils.import_matstruct_to_dict(mdict["dict_ute"])
-        self.data_dissolved = mdict["data_dissolved"]
-        self.data_dissolved_norm = mdict["data_dissolved_norm"]
-        self.data_gas = mdict["data_gas"]
-        self.data_rbc_k0 = mdict["data_rbc_k0"].flatten()
-        self.high_indices = mdict["high_indices"].flatten()
-        self.image_dissolved = mdict["image_dissolved"]
-        self.image_dissolved_high = mdict["image_dissolved_high"]
-        self.image_dissolved_low = mdict["image_dissolved_low"]
-        self.image_dissolved_norm = mdict["image_dissolved_norm"]
-        self.image_gas = mdict["image_gas"]
-        self.key_radius = int(mdict["key_radius"])
-        self.low_indices = mdict["low_indices"].flatten()
-        self.mask = mdict["mask"].astype(bool)
-        self.rbc_m_ratio = float(mdict["rbc_m_ratio"])
-        self.rbc_m_ratio_high = float(mdict["rbc_m_ratio_high"])
-        self.rbc_m_ratio_low = float(mdict["rbc_m_ratio_low"])
-        self.traj_dissolved = mdict["traj_dissolved"]
-        self.traj_gas = mdict["traj_gas"]
+
+    def read_subject_file(self):
+        """Read in the subject store, or the mat file if there is no store."""
+        if io_utils.get_subject_store_file(str(self.config.data_dir)):
+            self.read_subject_store()
+        else:
+            self.read_mat_file()
+
+    def _get_attributes(self) -> Dict[str, Any]:
+        """Get the public instance variables other than the config."""
+        return {
+            key: value
+            for key, value in vars(self).items()
+            if key != "config" and not key.startswith("_")
+        }
 
     def calculate_rbc_m_ratio(self):
         """Calculate RBC:M ratio using static spectroscopy.
@@ -182,15 +359,34 @@ class Subject(object):
             logging.info("Using manual RBC:M ratio of {}".format(self.rbc_m_ratio))
         else:
             logging.info("Calculating RBC:M ratio from static spectroscopy.")
-            self.rbc_m_ratio, _ = spect_utils.calculate_static_spectroscopy(
-                fid=self.dict_dyn[constants.IOFields.FIDS_DIS],
-                dwell_time=self.dict_dyn[constants.IOFields.DWELL_TIME],
-                tr=self.dict_dyn[constants.IOFields.TR],
-                center_freq=self.dict_dyn[constants.IOFields.FREQ_CENTER],
-                rf_excitation=self.dict_dyn[constants.IOFields.FREQ_EXCITATION],
-                plot=False,
+            self.rbc_m_ratio, self._static_fit = (
+                spect_utils.calculate_static_spectroscopy(
+                    fid=self.dict_dyn[constants.IOFields.FIDS_DIS],
+                    dwell_time=self.dict_dyn[constants.IOFields.DWELL_TIME],
+                    tr=self.dict_dyn[constants.IOFields.TR],
+                    center_freq=self.dict_dyn[constants.IOFields.FREQ_CENTER],
+                    rf_excitation=self.dict_dyn[constants.IOFields.FREQ_EXCITATION],
+                    plot=False,
+                )
             )
 
+    def calculate_dynamic_spectroscopy(self):
+        """Fit every FID, or a sliding average of FIDs, of the dynamic spectroscopy.
+
+        The RBC:M ratio, frequencies and linewidths over the breath-hold are stored
+        in dict_dyn_fit.
+        """
+        logging.info("Fitting dynamic spectroscopy.")
+        self.dict_dyn_fit = spect_utils.calculate_dynamic_spectroscopy(
+            fid=self.dict_dyn[constants.IOFields.FIDS_DIS],
+            dwell_time=self.dict_dyn[constants.IOFields.DWELL_TIME],
+            tr=self.dict_dyn[constants.IOFields.TR],
+            center_freq=self.dict_dyn[constants.IOFields.FREQ_CENTER],
+            rf_excitation=self.dict_dyn[constants.IOFields.FREQ_EXCITATION],
+            n_avg=int(self.config.params.n_avg_dynamic_spectroscopy),
+            n_workers=int(self.config.params.n_workers_dynamic_spectroscopy),
+        )
+
     def preprocess(self):
         """Prepare data and trajectory for reconstruction.
 
@@ -198,7 +394,10 @@ class Subject(object):
         """
         generate_traj = not constants.IOFields.TRAJ in self.dict_dis.keys()
         if self.config.remove_contamination:
-            self.dict_dis = pp.remove_contamination(self.dict_dyn, self.dict_dis)
+            # reuse the static spectroscopy fit of the RBC:M ratio, if any
+            self.dict_dis = pp.remove_contamination(
+                self.dict_dyn, self.dict_dis, fit_obj=self._static_fit
+            )
         (
             self.data_dissolved,
             self.traj_dissolved,
@@ -240,14 +439,44 @@ class Subject(object):
                 n_skip_end=0,
             )
             self.traj_ute *= self.traj_scaling_factor
+        # divide the data by the gas phase k0 data.
+        self.data_dissolved_norm = pp.normalize_data(
+            data=self.data_dissolved, normalization=np.abs(self.data_gas[:, 0])
+        )
+
+    def _reconstruct(
+        self, data: np.ndarray, traj: np.ndarray, kernel_sharpness: float
+    ) -> np.ndarray:
+        """Reconstruct an image with the configured reconstruction engine.
+
+        Args:
+            data (np.ndarray): k space data of shape (K, 1)
+            traj (np.ndarray): k space trajectory of shape (K, 3)
+            kernel_sharpness (float): kernel sharpness.
+        Returns:
+            np.ndarray: reconstructed image volume
+        """
+        if self.config.recon.autotune:
+            return reconstruction.reconstruct_autotuned(
+                data=data,
+                traj=traj,
+                kernel_sharpness=kernel_sharpness,
+                kernel_extent=9 * kernel_sharpness,
+                tolerance=float(self.config.recon.autotune_tolerance),
+            )
+        return reconstruction.reconstruct(
+            data=data,
+            traj=traj,
+            kernel_sharpness=kernel_sharpness,
+            kernel_extent=9 * kernel_sharpness,
+        )
 
     def reconstruction_ute(self):
         """Reconstruct the UTE image."""
-        self.image_ute = reconstruction.reconstruct(
+        self.image_ute = self._reconstruct(
             data=(recon_utils.flatten_data(self.data_ute)),
             traj=recon_utils.flatten_traj(self.traj_ute),
             kernel_sharpness=float(self.config.recon.kernel_sharpness_hr),
-            kernel_extent=9 * float(self.config.recon.kernel_sharpness_hr),
         )
         self.image_ute = img_utils.flip_and_rotate_image(
             self.image_ute, orientation=self.dict_dis[constants.IOFields.ORIENTATION]
@@ -255,11 +484,10 @@ class Subject(object):
 
     def reconstruction_gas(self):
         """Reconstruct the gas phase image."""
-        self.image_gas = reconstruction.reconstruct(
+        self.image_gas = self._reconstruct(
             data=(recon_utils.flatten_data(self.data_gas)),
             traj=recon_utils.flatten_traj(self.traj_gas),
             kernel_sharpness=float(self.config.recon.kernel_sharpness_lr),
-            kernel_extent=9 * float(self.config.recon.kernel_sharpness_lr),
         )
         self.image_gas = img_utils.flip_and_rotate_image(
             self.image_gas, orientation=self.dict_dis[constants.IOFields.ORIENTATION]
@@ -267,21 +495,15 @@ class Subject(object):
 
     def reconstruction_dissolved(self):
         """Reconstruct the dissolved phase image."""
-        # divide the data by the gas phase k0 data.
-        self.data_dissolved_norm = pp.normalize_data(
-            data=self.data_dissolved, normalization=np.abs(self.data_gas[:, 0])
-        )
-        self.image_dissolved_norm = reconstruction.reconstruct(
+        self.image_dissolved_norm = self._reconstruct(
             data=(recon_utils.flatten_data(self.data_dissolved_norm)),
             traj=recon_utils.flatten_traj(self.traj_dissolved),
             kernel_sharpness=float(self.config.recon.kernel_sharpness_lr),
-            kernel_extent=9 * float(self.config.recon.kernel_sharpness_lr),
         )
-        self.image_dissolved = reconstruction.reconstruct(
+        self.image_dissolved = self._reconstruct(
             data=(recon_utils.flatten_data(self.data_dissolved)),
             traj=recon_utils.flatten_traj(self.traj_dissolved),
             kernel_sharpness=float(self.config.recon.kernel_sharpness_lr),
-            kernel_extent=9 * float(self.config.recon.kernel_sharpness_lr),
         )
         self.image_dissolved_norm = img_utils.flip_and_rotate_image(
             self.image_dissolved_norm,
@@ -292,8 +514,73 @@ class Subject(object):
             orientation=self.dict_dis[constants.IOFields.ORIENTATION],
         )
 
-    def reconstruction_rbc_oscillation(self):
-        """Reconstruct the RBC oscillation image."""
+    def get_dissolved_system_model(self) -> system_model.MatrixSystemModel:
+        """Calculate the system model of the full dissolved-phase trajectory.
+
+        The keyhole data of every bin keeps a subset of the samples of the full
+        trajectory, so one system model serves the keyhole reconstructions of any
+        key radius and binning.
+
+        Returns:
+            system_model.MatrixSystemModel: system model of the flattened
+                dissolved-phase trajectory.
+        """
+        kernel_sharpness = float(self.config.recon.kernel_sharpness_lr)
+        return reconstruction.get_system_model(
+            traj=recon_utils.flatten_traj(self.traj_dissolved),
+            kernel_sharpness=kernel_sharpness,
+            kernel_extent=9 * kernel_sharpness,
+        )
+
+    def _reconstruct_keyhole(
+        self,
+        bin_indices: np.ndarray,
+        system_obj: Optional[system_model.MatrixSystemModel] = None,
+    ) -> np.ndarray:
+        """Reconstruct the keyhole image of a bin.
+
+        Args:
+            bin_indices (np.ndarray): indices of the binned projections.
+            system_obj (MatrixSystemModel, optional): system model of the full
+                dissolved-phase trajectory, see get_dissolved_system_model.
+        Returns:
+            np.ndarray: reconstructed image volume
+        """
+        if system_obj is None:
+            data, traj = pp.prepare_data_and_traj_keyhole(
+                data=self.data_dissolved_norm,
+                traj=self.traj_dissolved,
+                bin_indices=bin_indices,
+                key_radius=self.key_radius,
+            )
+            return self._reconstruct(
+                data=data,
+                traj=traj,
+                kernel_sharpness=float(self.config.recon.kernel_sharpness_lr),
+            )
+        data = recon_utils.flatten_data(
+            pp.get_keyhole_data(
+                data=self.data_dissolved_norm,
+                bin_indices=bin_indices,
+                key_radius=self.key_radius,
+            )
+        )
+        # the keyhole samples outside of the bin are zero and not reconstructed
+        mask = data.flatten() != 0.0
+        return reconstruction.reconstruct_system_model(
+            data=data[mask], system_obj=system_obj.subset(mask)
+        )
+
+    def reconstruction_rbc_oscillation(
+        self, system_obj: Optional[system_model.MatrixSystemModel] = None
+    ):
+        """Reconstruct the RBC oscillation image.
+
+        Args:
+            system_obj (MatrixSystemModel, optional): system model of the full
+                dissolved-phase trajectory to reuse for the keyhole
+                reconstructions, see get_dissolved_system_model.
+        """
         # bin rbc oscillations
         (
             self.data_rbc_k0,
@@ -306,34 +593,18 @@ class Subject(object):
             data_dissolved=self.data_dissolved,
             rbc_m_ratio=self.rbc_m_ratio,
             TR=self.dict_dis[constants.IOFields.TR],
+            method=self.config.recon.binning_method,
+            distance_threshold=float(self.config.recon.distance_threshold),
+            bin_selection=self.config.recon.bin_selection,
         )
         # calculate the key radius
         self.key_radius = self.config.recon.key_radius
-        # prepare data and traj for reconstruction
-        data_dis_high, traj_dis_high = pp.prepare_data_and_traj_keyhole(
-            data=self.data_dissolved_norm,
-            traj=self.traj_dissolved,
-            bin_indices=self.high_indices,
-            key_radius=self.key_radius,
-        )
-        data_dis_low, traj_dis_low = pp.prepare_data_and_traj_keyhole(
-            data=self.data_dissolved_norm,
-            traj=self.traj_dissolved,
-            bin_indices=self.low_indices,
-            key_radius=self.key_radius,
-        )
-        # reconstruct data
-        self.image_dissolved_high = reconstruction.reconstruct(
-            data=data_dis_high,
-            traj=traj_dis_high,
-            kernel_sharpness=float(self.config.recon.kernel_sharpness_lr),
-            kernel_extent=9 * float(self.config.recon.kernel_sharpness_lr),
+        # reconstruct keyhole data
+        self.image_dissolved_high = self._reconstruct_keyhole(
+            bin_indices=self.high_indices, system_obj=system_obj
         )
-        self.image_dissolved_low = reconstruction.reconstruct(
-            data=data_dis_low,
-            traj=traj_dis_low,
-            kernel_sharpness=float(self.config.recon.kernel_sharpness_lr),
-            kernel_extent=9 * float(self.config.recon.kernel_sharpness_lr),
+        self.image_dissolved_low = self._reconstruct_keyhole(
+            bin_indices=self.low_indices, system_obj=system_obj
         )
         # flip and rotate images
         self.image_dissolved_high = img_utils.flip_and_rotate_image(
@@ -367,29 +638,26 @@ class Subject(object):
 
     def dixon_decomposition(self):
         """Perform Dixon decomposition on the dissolved-phase images."""
-        self.image_rbc, self.image_membrane = img_utils.dixon_decomposition(
-            image_gas=self.image_gas,
-            image_dissolved=self.image_dissolved,
-            mask=self.mask,
-            rbc_m_ratio=self.rbc_m_ratio,
-        )
-        self.image_rbc_norm, _ = img_utils.dixon_decomposition(
-            image_gas=self.image_gas,
-            image_dissolved=self.image_dissolved_norm,
-            mask=self.mask,
-            rbc_m_ratio=self.rbc_m_ratio,
-        )
-        self.image_rbc_high, _ = img_utils.dixon_decomposition(
-            image_gas=self.image_gas,
-            image_dissolved=self.image_dissolved_high,
-            mask=self.mask,
-            rbc_m_ratio=self.rbc_m_ratio_high,
-        )
-        self.image_rbc_low, _ = img_utils.dixon_decomposition(
+        (
+            (self.image_rbc, self.image_membrane),
+            (self.image_rbc_norm, _),
+            (self.image_rbc_high, _),
+            (self.image_rbc_low, _),
+        ) = img_utils.dixon_decomposition_many(
             image_gas=self.image_gas,
-            image_dissolved=self.image_dissolved_low,
+            images_dissolved=[
+                self.image_dissolved,
+                self.image_dissolved_norm,
+                self.image_dissolved_high,
+                self.image_dissolved_low,
+            ],
             mask=self.mask,
-            rbc_m_ratio=self.rbc_m_ratio_low,
+            rbc_m_ratios=[
+                self.rbc_m_ratio,
+                self.rbc_m_ratio,
+                self.rbc_m_ratio_high,
+                self.rbc_m_ratio_low,
+            ],
         )
 
     def dissolved_analysis(self):
@@ -431,6 +699,16 @@ class Subject(object):
 
     def get_statistics(self):
         """Calculate image statistics."""
+        snr_rbc, snr_rbc_high, snr_rbc_low, snr_dissolved, snr_gas = metrics.snr_many(
+            [
+                self.image_rbc,
+                self.image_rbc_high,
+                self.image_rbc_low,
+                np.abs(self.image_dissolved),
+                np.abs(self.image_gas),
+            ],
+            self.mask,
+        )
         self.stats_dict = {
             constants.StatsIOFields.SUBJECT_ID: self.config.subject_id,
             constants.StatsIOFields.INFLATION: metrics.inflation_volume(
@@ -441,19 +719,11 @@ class Subject(object):
                 constants.IOFields.SCAN_DATE
             ],
             constants.StatsIOFields.PROCESS_DATE: metrics.process_date(),
-            constants.StatsIOFields.SNR_RBC: metrics.snr(self.image_rbc, self.mask)[0],
-            constants.StatsIOFields.SNR_RBC_HIGH: metrics.snr(
-                self.image_rbc_high, self.mask
-            )[0],
-            constants.StatsIOFields.SNR_RBC_LOW: metrics.snr(
-                self.image_rbc_low, self.mask
-            )[0],
-            constants.StatsIOFields.SNR_DISSOLVED: metrics.snr(
-                np.abs(self.image_dissolved), self.mask
-            )[1],
-            constants.StatsIOFields.SNR_GAS: metrics.snr(
-                np.abs(self.image_gas), self.mask
-            )[1],
+            constants.StatsIOFields.SNR_RBC: snr_rbc[0],
+            constants.StatsIOFields.SNR_RBC_HIGH: snr_rbc_high[0],
+            constants.StatsIOFields.SNR_RBC_LOW: snr_rbc_low[0],
+            constants.StatsIOFields.SNR_DISSOLVED: snr_dissolved[1],
+            constants.StatsIOFields.SNR_GAS: snr_gas[1],
             constants.StatsIOFields.PCT_OSC_DEFECT: metrics.bin_percentage(
                 self.image_rbc_osc_binned, np.array([1])
             ),
@@ -476,24 +746,161 @@ class Subject(object):
             constants.StatsIOFields.N_POINTS: self.data_gas.shape[1],
         }
 
+    def run_stages(self, stages: List[str], max_workers: int = 1):
+        """Run stages concurrently where their dependencies allow.
+
+        See STAGE_DEPENDENCIES. Every stage writes its own attributes, so the result
+        does not depend on the number of workers. If checkpointing is enabled, stages
+        whose fingerprint did not change since the last run are restored from their
+        checkpoint instead of being recomputed.
+
+        Args:
+            stages (List[str]): names of the stages in their sequential order.
+            max_workers (int): number of stages to run at the same time.
+        """
+        stage_functions = {name: getattr(self, name) for name in stages}
+        if self.config.processes.checkpoint_stages:
+            fingerprints = self._get_stage_fingerprints(stages)
+            for name in stages:
+                if self.STAGE_OUTPUTS.get(name):
+                    stage_functions[name] = self._get_checkpointed_stage(
+                        name, fingerprints[name]
+                    )
+        stage_utils.run_dag(
+            stages=stage_functions,
+            dependencies=self.STAGE_DEPENDENCIES,
+            max_workers=max_workers,
+        )
+
+    def _get_stage_files(self, name: str) -> List[str]:
+        """Get the files other than the subject data that a stage reads.
+
+        Args:
+            name (str): stage name.
+        Returns:
+            List[str]: paths of the files.
+        """
+        if name != "segmentation":
+            return []
+        if self.config.segmentation_key == constants.SegmentationKey.CNN_VENT.value:
+            return [segmentation.WEIGHTS_PATH_VENT]
+        if self.config.segmentation_key == constants.SegmentationKey.MANUAL_VENT.value:
+            return [str(self.config.manual_seg_filepath)]
+        return []
+
+    def _get_stage_fingerprints(self, stages: List[str]) -> Dict[str, str]:
+        """Get the fingerprint of the inputs of each stage.
+
+        The fingerprint of a stage covers the pipeline code, see
+        checkpoint_utils.get_code_fingerprint, the config parameters and the content
+        of the files it reads, such as model weights or a manual mask, the content
+        of the subject attributes before the first stage and the fingerprints of
+        the stages it depends on.
+
+        Args:
+            stages (List[str]): names of the stages that are run.
+        Returns:
+            Dict[str, str]: fingerprint of each stage.
+        """
+        inputs = checkpoint_utils.fingerprint(
+            [sorted(self._get_attributes().items())]
+            + [self._store.fingerprint() if self._store else ""]
+        )
+        code = checkpoint_utils.get_code_fingerprint()
+        fingerprints = {}
+
+        def get_upstream(name: str) -> List[str]:
+            # stages that are not run pass on the stages they depend on
+            upstream = []
+            for dependency in self.STAGE_DEPENDENCIES.get(name, []):
+                if dependency in stages:
+                    upstream.append(get_fingerprint(dependency))
+                else:
+                    upstream += get_upstream(dependency)
+            return upstream
+
+        def get_fingerprint(name: str) -> str:
+            if name not in fingerprints:
+                params = [
+                    functools.reduce(getattr, param.split("."), self.config)
+                    for param in self.STAGE_PARAMS.get(name, [])
+                ]
+                files = [
+                    checkpoint_utils.get_file_fingerprint(path)
+                    for path in self._get_stage_files(name)
+                ]
+                upstream = get_upstream(name)
+                fingerprints[name] = checkpoint_utils.fingerprint(
+                    [
+                        name,
+                        code,
+                        params,
+                        files,
+                        inputs,
+                        upstream,
+                    ]
+                )
+            return fingerprints[name]
+
+        for name in stages:
+            get_fingerprint(name)
+        return fingerprints
+
+    def _get_checkpointed_stage(self, name: str, fingerprint: str) -> Callable:
+        """Wrap a stage to restore its outputs from a checkpoint if possible.
+
+        Args:
+            name (str): stage name.
+            fingerprint (str): fingerprint of the stage inputs.
+        Returns:
+            Callable: stage function without arguments.
+        """
+        path = checkpoint_utils.get_checkpoint_path(
+            os.path.join(self.config.data_dir, "checkpoints"), name, fingerprint
+        )
+
+        def stage():
+            if os.path.exists(path):
+                logging.info("Restoring stage {} from checkpoint.".format(name))
+                for key, value in checkpoint_utils.load_checkpoint(path).items():
+                    setattr(self, key, value)
+            else:
+                getattr(self, name)()
+                checkpoint_utils.save_checkpoint(
+                    {key: getattr(self, key) for key in self.STAGE_OUTPUTS[name]}, path
+                )
+
+        return stage
+
+    def _get_tmp_path(self, filename: str) -> str:
+        """Get the path of a figure or image of the report in config.tmp_dir.
+
+        Args:
+            filename (str): file name.
+        Returns:
+            str: path of the file. The directory is created if needed.
+        """
+        os.makedirs(self.config.tmp_dir, exist_ok=True)
+        return os.path.join(self.config.tmp_dir, filename)
+
     def generate_figures(self):
         """Export image figures."""
         index_start, index_skip = plot.get_plot_indices(self.mask)
         plot.plot_montage_grey(
             image=np.abs(self.image_gas),
-            path="tmp/montage_ven.png",
+            path=self._get_tmp_path("montage_ven.png"),
             index_start=index_start,
             index_skip=index_skip,
         )
         plot.plot_montage_grey(
             image=np.abs(self.image_membrane),
-            path="tmp/montage_membrane.png",
+            path=self._get_tmp_path("montage_membrane.png"),
             index_start=index_start,
             index_skip=index_skip,
         )
         plot.plot_montage_grey(
             image=np.abs(self.image_rbc),
-            path="tmp/montage_rbc.png",
+            path=self._get_tmp_path("montage_rbc.png"),
             index_start=index_start,
             index_skip=index_skip,
         )
@@ -501,22 +908,23 @@ class Subject(object):
             image=plot.map_grey_to_rgb(
                 self.image_rbc_osc_binned, constants.CMAP.RBC_OSC_BIN2COLOR
             ),
-            path="tmp/montage_rbc_rgb.png",
+            path=self._get_tmp_path("montage_rbc_rgb.png"),
             index_start=index_start,
             index_skip=index_skip,
         )
         plot.plot_histogram_ventilation(
-            data=np.abs(self.image_gas)[self.mask].flatten(), path="tmp/hist_ven.png"
+            data=np.abs(self.image_gas)[self.mask].flatten(),
+            path=self._get_tmp_path("hist_ven.png"),
         )
         plot.plot_histogram_rbc_osc(
             data=self.image_rbc_osc[self.mask_rbc],
-            path="tmp/hist_rbc_osc.png",
+            path=self._get_tmp_path("hist_rbc_osc.png"),
         )
         plot.plot_data_rbc_k0(
             t=np.arange(self.data_rbc_k0.shape[0])
             * self.dict_dis[constants.IOFields.TR],
             data=self.data_rbc_k0,
-            path="tmp/data_rbc_k0_proc.png",
+            path=self._get_tmp_path("data_rbc_k0_proc.png"),
             high=self.high_indices,
             low=self.low_indices,
         )
@@ -526,7 +934,7 @@ class Subject(object):
             data=signal_utils.dixon_decomposition(
                 self.data_dissolved, self.rbc_m_ratio
             )[0][:, 0],
-            path="tmp/data_rbc_k0.png",
+            path=self._get_tmp_path("data_rbc_k0.png"),
             high=self.high_indices,
             low=self.low_indices,
         )
@@ -537,27 +945,59 @@ class Subject(object):
             self.config.data_dir,
             "report_clinical_{}.pdf".format(self.config.subject_id),
         )
-        report.clinical(self.stats_dict, path=path)
+        report.clinical(self.stats_dict, path=path, tmp_dir=self.config.tmp_dir)
 
     def write_stats_to_csv(self):
         """Write statistics to file."""
         io_utils.export_subject_csv(self.stats_dict, path="data/stats_all.csv")
 
-    def save_subject_to_mat(self):
-        """Save the instance variables into a mat file."""
-        path = os.path.join(self.config.data_dir, self.config.subject_id + ".mat")
-        io_utils.export_subject_mat(self, path)
+    def _get_unread_store_values(self) -> Dict[str, Any]:
+        """Read the attributes of an opened store that were never accessed."""
+        if not self._store:
+            return {}
+        return {
+            key: self._store.load(key)
+            for key in self._store.keys()
+            if key not in self.__dict__
+        }
+
+    def save_subject(self):
+        """Save the instance variables into the subject store.
+
+        If the subject was read from the same store, only the attributes that
+        changed are rewritten. Otherwise attributes of an opened store that were
+        never accessed are copied over. With config.processes.export_mat, a mat file
+        is written as well for the tools that read it.
+        """
+        values = self._get_attributes()
+        path = os.path.join(
+            self.config.data_dir,
+            self.config.subject_id + constants.SUBJECT_STORE_SUFFIX,
+        )
+        if self._store and os.path.abspath(self._store.path) == os.path.abspath(path):
+            subject_store.update(values, path)
+        else:
+            subject_store.save(dict(self._get_unread_store_values(), **values), path)
+        if self.config.processes.export_mat:
+            io_utils.export_subject_mat(
+                dict(self._get_unread_store_values(), **values),
+                os.path.join(self.config.data_dir, self.config.subject_id + ".mat"),
+            )
 
     def save_files(self):
         """Save select images to nifti files and instance variable to mat."""
-        io_utils.export_nii(self.image_rbc_osc_binned, "tmp/osc_binned.nii")
-        io_utils.export_nii(self.image_rbc_binned, "tmp/rbc_binned.nii")
-        io_utils.export_nii(np.abs(self.image_gas), "tmp/gas.nii")
-        io_utils.export_nii(np.abs(self.image_rbc), "tmp/rbc.nii")
-        io_utils.export_nii(np.abs(self.image_membrane), "tmp/membrane.nii")
-        io_utils.export_nii(self.mask.astype(float), "tmp/mask.nii")
-        io_utils.export_nii(self.mask_rbc.astype(float), "tmp/mask_rbc.nii")
-        io_utils.export_nii(self.image_rbc_osc * self.mask, "tmp/osc.nii")
-        io_utils.export_nii(np.abs(self.image_dissolved), "tmp/dissolved.nii")
+        images = {
+            "osc_binned.nii": self.image_rbc_osc_binned,
+            "rbc_binned.nii": self.image_rbc_binned,
+            "gas.nii": np.abs(self.image_gas),
+            "rbc.nii": np.abs(self.image_rbc),
+            "membrane.nii": np.abs(self.image_membrane),
+            "mask.nii": self.mask.astype(float),
+            "mask_rbc.nii": self.mask_rbc.astype(float),
+            "osc.nii": self.image_rbc_osc * self.mask,
+            "dissolved.nii": np.abs(self.image_dissolved),
+        }
         if self.config.recon.recon_proton:
-            io_utils.export_nii(np.abs(self.image_ute), "tmp/proton.nii")
+            images["proton.nii"] = np.abs(self.image_ute)
+        for filename, image in images.items():
+            io_utils.export_nii(image, self._get_tmp_path(filename))
@@ -0,0 +1,244 @@
+"""Causal tracker of the cardiac cycle in the k0 of the dissolved-phase data.
+
+oscillation_binning.bin_rbc_oscillations bins the projections after the scan, with
+zero-phase filters and a heart rate from the FFT of the whole record. The tracker
+follows the same steps on k0 samples as they arrive: the dixon decomposition with
+the phase of the running sum of the dissolved k0, a trailing moving average,
+normalization by the gas k0 and a causal bandpass filter that keeps its state
+between calls. Peaks and troughs are confirmed once the filtered signal has been
+seen for the minimum peak distance after them, the heart rate is the median of the
+last peak to peak intervals, and the phase delay of the causal filters at the heart
+rate is subtracted to place the bins on the projections. Every projection gets its
+final label a fixed number of projections after it arrived.
+"""
+import math
+import sys
+from typing import List, Tuple
+
+import numpy as np
+import scipy.signal as signal
+
+sys.path.append("..")
+
+# number of peak to peak intervals of the running heart rate
+_N_INTERVALS = 5
+
+
+class CardiacTracker(object):
+    """Streaming high and low binning of the RBC k0 signal.
+
+    Attributes:
+        tr (float): repetition time in seconds.
+        rbc_m_ratio (float): RBC:M ratio of the dixon decomposition.
+        distance_threshold (float): fraction of the cardiac cycle around each peak
+            that is binned, as in signal_utils.find_high_low_indices.
+        heart_rate (float): current heart rate estimate in beats per minute.
+        latency (int): number of projections after which the label of a
+            projection is final.
+    """
+
+    HIGH = 1
+    LOW = -1
+    NONE = 0
+
+    def __init__(
+        self,
+        tr: float,
+        rbc_m_ratio: float,
+        distance_threshold: float = 0.2,
+        heart_rate: float = 60.0,
+        min_heart_rate: float = 40.0,
+        lowcut: float = 0.5,
+        highcut: float = 2.5,
+    ):
+        """Init object.
+
+        Args:
+            tr (float): repetition time in seconds.
+            rbc_m_ratio (float): RBC:M ratio of the dixon decomposition.
+            distance_threshold (float): fraction of the cardiac cycle around each
+                peak that is binned.
+            heart_rate (float): initial heart rate in beats per minute.
+            min_heart_rate (float): lowest heart rate tracked in beats per minute,
+                sets the latency.
+            lowcut (float): lowcut frequency of the bandpass filter in Hz.
+            highcut (float): highcut frequency of the bandpass filter in Hz.
+        """
+        self.tr = tr
+        self.rbc_m_ratio = rbc_m_ratio
+        self.distance_threshold = distance_threshold
+        self.heart_rate = heart_rate
+        self._heart_rate_range = (min_heart_rate, 60.0 * highcut)
+        window = int(1 / (5 * tr))
+        self._smooth_window = window if window % 2 == 1 else window + 1
+        nyq = 0.5 / tr
+        self._sos = signal.butter(
+            6, [lowcut / nyq, highcut / nyq], btype="bandpass", output="sos"
+        )
+        self._zi = None
+        self._dissolved_sum = 0j
+        self._rbc_sum = 0.0
+        self._rbc_tail = np.zeros(0)
+        self._filtered: List[float] = []
+        self._labels: List[int] = []
+        self._next_candidate = 0
+        self._last_peaks = {self.HIGH: -1, self.LOW: -1}
+        self._intervals: List[int] = []
+        self._n_final = 0
+        peak_distance = self._get_peak_distance(min_heart_rate)
+        self.latency = (
+            self._get_delay(min_heart_rate)
+            + self._get_half_window(peak_distance)
+            + int(0.6 * peak_distance)
+            + 1
+        )
+
+    def _get_peak_distance(self, heart_rate: float) -> float:
+        """Get the length of a cardiac cycle in projections."""
+        return 60.0 / heart_rate / self.tr
+
+    def _get_half_window(self, peak_distance: float) -> int:
+        """Get the half width of the bin around a peak in projections."""
+        return int(math.ceil(peak_distance * self.distance_threshold / 2))
+
+    def _get_delay(self, heart_rate: float) -> int:
+        """Get the delay of the causal filters at the heart rate in projections.
+
+        The peaks of the oscillation are shifted by the phase delay of the bandpass
+        filter, which is only defined up to whole cycles. The cycle is chosen to be
+        closest to the group delay of the filter.
+
+        Args:
+            heart_rate (float): heart rate in beats per minute.
+        Returns:
+            int: delay of the moving average and the bandpass filter.
+        """
+        freq = heart_rate / 60.0
+        period = self._get_peak_distance(heart_rate)
+        _, response = signal.sosfreqz(self._sos, worN=[freq], fs=1.0 / self.tr)
+        phase_delay = -np.angle(response[0]) / (2 * np.pi * freq * self.tr)
+        group_delay = 0.0
+        for section in self._sos:
+            _, section_delay = signal.group_delay(
+                (section[:3], section[3:]), w=[freq], fs=1.0 / self.tr
+            )
+            group_delay += section_delay[0]
+        delay = phase_delay + period * np.round((group_delay - phase_delay) / period)
+        return int(round(delay + (self._smooth_window - 1) / 2))
+
+    def _preprocess(self, data_gas_k0: np.ndarray, data_dissolved_k0: np.ndarray):
+        """Decompose, smooth, normalize and filter new k0 samples.
+
+        Args:
+            data_gas_k0 (np.ndarray): gas-phase k0 of shape (n,).
+            data_dissolved_k0 (np.ndarray): dissolved-phase k0 of shape (n,).
+        Returns:
+            np.ndarray: filtered RBC k0 of shape (n,).
+        """
+        dissolved_sum = self._dissolved_sum + np.cumsum(data_dissolved_k0)
+        self._dissolved_sum = dissolved_sum[-1]
+        delta_angle = np.arctan2(self.rbc_m_ratio, 1.0) - np.angle(dissolved_sum)
+        rbc = np.imag(data_dissolved_k0 * np.exp(1j * delta_angle))
+        # negate data if the running mean is negative
+        rbc_sum = self._rbc_sum + np.cumsum(rbc)
+        self._rbc_sum = rbc_sum[-1]
+        rbc = np.where(rbc_sum < 0, -rbc, rbc)
+        # trailing moving average
+        padded = np.concatenate([self._rbc_tail, rbc])
+        cumsum = np.concatenate([[0.0], np.cumsum(padded)])
+        end = np.arange(self._rbc_tail.size, padded.size) + 1
+        start = np.maximum(end - self._smooth_window, 0)
+        smoothed = (cumsum[end] - cumsum[start]) / (end - start)
+        self._rbc_tail = padded[padded.size - (self._smooth_window - 1) :]
+        normalized = smoothed / np.abs(data_gas_k0)
+        if self._zi is None:
+            self._zi = signal.sosfilt_zi(self._sos) * normalized[0]
+        filtered, self._zi = signal.sosfilt(self._sos, normalized, zi=self._zi)
+        return filtered
+
+    def _add_peak(self, index: int, label: int):
+        """Label the projections around a confirmed peak or trough.
+
+        Args:
+            index (int): index of the peak in the filtered signal.
+            label (int): HIGH for peaks, LOW for troughs.
+        """
+        if label == self.HIGH and self._last_peaks[label] >= 0:
+            self._intervals = (
+                self._intervals + [index - self._last_peaks[label]]
+            )[-_N_INTERVALS:]
+            self.heart_rate = float(
+                np.clip(
+                    60.0 / (np.median(self._intervals) * self.tr),
+                    *self._heart_rate_range,
+                )
+            )
+        self._last_peaks[label] = index
+        center = index - self._get_delay(self.heart_rate)
+        half_window = self._get_half_window(self._get_peak_distance(self.heart_rate))
+        for i in range(
+            max(center - half_window, self._n_final),
+            min(center + half_window + 1, len(self._labels)),
+        ):
+            if self._labels[i] == self.NONE:
+                self._labels[i] = label
+
+    def _find_peaks(self):
+        """Confirm the peaks and troughs that are followed by enough samples."""
+        while True:
+            distance = int(0.6 * self._get_peak_distance(self.heart_rate))
+            j = self._next_candidate
+            if j + distance >= len(self._filtered):
+                return
+            window = np.asarray(self._filtered[max(j - distance, 0) : j + distance + 1])
+            for label, extreme in ((self.HIGH, np.max), (self.LOW, np.min)):
+                if (
+                    self._filtered[j] == extreme(window)
+                    and j - self._last_peaks[label] >= distance
+                    and 0 < j
+                ):
+                    self._add_peak(j, label)
+            self._next_candidate += 1
+
+    def _emit(self, n_final: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Finalize the labels of the projections before n_final.
+
+        Args:
+            n_final (int): number of projections with a final label.
+        Returns:
+            Tuple of the indices and labels of the newly finalized projections.
+        """
+        n_final = max(n_final, self._n_final)
+        indices = np.arange(self._n_final, n_final)
+        labels = np.array(self._labels[self._n_final : n_final], dtype=int)
+        self._n_final = n_final
+        return indices, labels
+
+    def update(
+        self, data_gas_k0: np.ndarray, data_dissolved_k0: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Add the k0 of new projections.
+
+        Args:
+            data_gas_k0 (np.ndarray): gas-phase k0 of shape (n,).
+            data_dissolved_k0 (np.ndarray): dissolved-phase k0 of shape (n,).
+        Returns:
+            Tuple of the indices and labels (HIGH, LOW or NONE) of the projections
+                whose label became final, at most latency projections behind.
+        """
+        data_gas_k0 = np.atleast_1d(data_gas_k0)
+        data_dissolved_k0 = np.atleast_1d(data_dissolved_k0)
+        if data_dissolved_k0.size == 0:
+            return self._emit(self._n_final)
+        self._filtered.extend(self._preprocess(data_gas_k0, data_dissolved_k0))
+        self._labels.extend([self.NONE] * data_dissolved_k0.size)
+        self._find_peaks()
+        return self._emit(len(self._labels) - self.latency)
+
+    def flush(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Finalize the labels of all projections at the end of the acquisition.
+
+        Returns:
+            Tuple of the indices and labels of the remaining projections.
+        """
+        return self._emit(len(self._labels))
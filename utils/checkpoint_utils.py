@@ -0,0 +1,219 @@
+"""Content-hashed checkpoints of pipeline stage outputs.
+
+A stage is identified by a fingerprint of everything it depends on: the pipeline
+code, the config parameters it reads, and the fingerprints of its upstream stages
+or the content of the subject inputs. Its outputs are saved under that
+fingerprint, so a stage is only recomputed when one of its inputs changed.
+
+The code is the source of the modules imported by the pipeline, found from the
+import statements of subject_classmap, the config defaults and the versions of numpy
+and scipy. Files that a stage reads, such as model weights, are fingerprinted by
+their content. Bump CHECKPOINT_VERSION when a stage result changes for any other
+reason, e.g. another dependency.
+"""
+import ast
+import functools
+import glob
+import hashlib
+import logging
+import os
+import pickle
+from typing import Any, Dict, Iterable, List, Tuple
+
+import numpy as np
+import scipy
+
+# bump to invalidate all existing checkpoints
+CHECKPOINT_VERSION = 1
+
+# root of the repository, the module whose imports make up the pipeline code and
+# the directory of the config defaults
+_ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+_PIPELINE_MODULE = "subject_classmap"
+_CONFIG_DIR = "config"
+_HASH_CHUNK_BYTES = 1 << 24
+
+# content hashes of files by path, size and modification time
+_FILE_FINGERPRINTS: Dict[Tuple[str, int, int], str] = {}
+
+
+def _update_hash(hasher: Any, value: Any):
+    """Feed a value into a hash object.
+
+    Args:
+        hasher (Any): hashlib hash object.
+        value (Any): numpy array, dict, list, tuple or any value with a stable repr.
+    """
+    if isinstance(value, np.ndarray):
+        hasher.update(str((value.dtype.str, value.shape)).encode())
+        hasher.update(np.ascontiguousarray(value).view(np.uint8).data)
+    elif isinstance(value, dict):
+        hasher.update(b"dict")
+        for key in sorted(value, key=str):
+            _update_hash(hasher, str(key))
+            _update_hash(hasher, value[key])
+    elif isinstance(value, (list, tuple)):
+        hasher.update(type(value).__name__.encode())
+        for item in value:
+            _update_hash(hasher, item)
+    else:
+        hasher.update(repr(value).encode())
+
+
+def fingerprint(values: Iterable[Any]) -> str:
+    """Get the fingerprint of a sequence of values.
+
+    Args:
+        values (Iterable[Any]): values to fingerprint, see _update_hash.
+    Returns:
+        str: hex digest.
+    """
+    hasher = hashlib.sha1(str(CHECKPOINT_VERSION).encode())
+    for value in values:
+        _update_hash(hasher, value)
+    return hasher.hexdigest()
+
+
+def _get_module_path(name: str) -> str:
+    """Get the source file of a module of the repository.
+
+    Args:
+        name (str): dotted module name.
+    Returns:
+        str: path of the module or package source, empty if it is not part of the
+            repository.
+    """
+    path = os.path.join(_ROOT_DIR, *name.split("."))
+    if os.path.isfile(path + ".py"):
+        return path + ".py"
+    if os.path.isfile(os.path.join(path, "__init__.py")):
+        return os.path.join(path, "__init__.py")
+    return ""
+
+
+def _get_imports(path: str) -> List[str]:
+    """Get the names of the modules a source file imports anywhere in its code.
+
+    Args:
+        path (str): path of the source file.
+    Returns:
+        List[str]: dotted module names, including the candidates "module.name" of
+            "from module import name".
+    """
+    with open(path, "rb") as f:
+        tree = ast.parse(f.read(), filename=path)
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.append(node.module)
+            names += [node.module + "." + alias.name for alias in node.names]
+    return names
+
+
+def get_pipeline_files() -> List[str]:
+    """Get the source files of the repository modules that the pipeline imports.
+
+    Returns:
+        List[str]: sorted paths relative to the repository root.
+    """
+    paths = set()
+    names = [_PIPELINE_MODULE]
+    while names:
+        path = _get_module_path(names.pop())
+        if path and path not in paths:
+            paths.add(path)
+            names += _get_imports(path)
+    return sorted(os.path.relpath(path, _ROOT_DIR) for path in paths)
+
+
+@functools.lru_cache(maxsize=None)
+def get_code_fingerprint() -> str:
+    """Get the fingerprint of the pipeline code.
+
+    A change of a module that a stage calls, directly or not, or of the config
+    defaults invalidates the checkpoints. Scripts that are not imported by the
+    pipeline are not part of it. Computed once per process.
+
+    Returns:
+        str: hex digest of the module sources and the numpy and scipy versions.
+    """
+    config_paths = [
+        os.path.relpath(path, _ROOT_DIR)
+        for path in glob.glob(os.path.join(_ROOT_DIR, _CONFIG_DIR, "*.py"))
+    ]
+    paths = sorted(set(get_pipeline_files() + config_paths))
+    sources = []
+    for path in paths:
+        with open(os.path.join(_ROOT_DIR, path), "rb") as f:
+            sources.append((path, f.read()))
+    return fingerprint([sources, np.__version__, scipy.__version__])
+
+
+def get_file_fingerprint(path: str) -> str:
+    """Get the fingerprint of the content of a file read by a stage.
+
+    The hash is remembered with the size and modification time of the file, so
+    unchanged files are only read once per process.
+
+    Args:
+        path (str): path of the file.
+    Returns:
+        str: hex digest of the content, empty if the file does not exist.
+    """
+    if not os.path.isfile(path):
+        return ""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _FILE_FINGERPRINTS:
+        hasher = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(_HASH_CHUNK_BYTES), b""):
+                hasher.update(chunk)
+        _FILE_FINGERPRINTS[key] = hasher.hexdigest()
+    return _FILE_FINGERPRINTS[key]
+
+
+def get_checkpoint_path(checkpoint_dir: str, stage: str, stage_fingerprint: str):
+    """Get the path of the checkpoint of a stage.
+
+    Args:
+        checkpoint_dir (str): checkpoint directory.
+        stage (str): stage name.
+        stage_fingerprint (str): fingerprint of the stage inputs.
+    Returns:
+        str: path of the checkpoint file.
+    """
+    return os.path.join(checkpoint_dir, "{}_{}.pkl".format(stage, stage_fingerprint))
+
+
+def load_checkpoint(path: str) -> Dict[str, Any]:
+    """Load the outputs of a stage.
+
+    Args:
+        path (str): path of the checkpoint file.
+    Returns:
+        Dict[str, Any]: output attribute names and values.
+    """
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def save_checkpoint(outputs: Dict[str, Any], path: str):
+    """Save the outputs of a stage and remove older checkpoints of the stage.
+
+    Args:
+        outputs (Dict[str, Any]): output attribute names and values.
+        path (str): path of the checkpoint file.
+    """
+    checkpoint_dir = os.path.dirname(path)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    stage = os.path.basename(path).rsplit("_", 1)[0]
+    for old_path in glob.glob(os.path.join(checkpoint_dir, stage + "_*.pkl")):
+        if old_path != path and os.path.basename(old_path).rsplit("_", 1)[0] == stage:
+            os.remove(old_path)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(outputs, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+    logging.info("Saved checkpoint {}".format(path))
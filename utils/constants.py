@@ -1,8 +1,14 @@
 """Define important constants used throughout the pipeline."""
 import enum
+import os
 
 FOVINFLATIONSCALE3D = 1000.0
 
+# per-machine cache for tuning results and derived data
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "xenon_oscillation")
+# suffix of the subject store file, distinct from the MRD .h5 files
+SUBJECT_STORE_SUFFIX = "_subject.h5"
+
 _NUM_SLICE_GRE_MONTAGE = 14
 _NUM_ROWS_GRE_MONTAGE = 2
 _NUM_COLS_GRE_MONTAGE = 7
@@ -172,6 +178,20 @@ class DCFSpace(object):
     DATASPACE = "dataspace"
 
 
+class SampleOrder(object):
+    """Defines the order of the samples inside the system model."""
+
+    ACQUISITION = "acquisition"
+    MORTON = "morton"
+
+
+class Precision(object):
+    """Defines the floating point precision of the reconstruction."""
+
+    DOUBLE = "double"
+    SINGLE = "single"
+
+
 class Methods(object):
     """Defines the method to calculate the RBC oscillation image."""
 
@@ -193,6 +213,7 @@ class BinningMethods(object):
     WAVELET = "wavelet"
     MOVING_AVG = "movingavg"
     MEDIAN = "median"
+    PHASE = "phase"
 
 
 class MaskMethods(object):
@@ -224,6 +245,12 @@ class StatsIOFields(object):
     PCT_OSC_NEGATIVE = "osc_negative"
     KEY_RADIUS = "key_radius"
     N_POINTS = "n_points"
+    BINNING_METHOD = "binning_method"
+    BIN_SELECTION = "bin_selection"
+    DISTANCE_THRESHOLD = "distance_threshold"
+    N_BINNED = "n_binned"
+    RBC_M_RATIO_HIGH = "rbc_m_ratio_high"
+    RBC_M_RATIO_LOW = "rbc_m_ratio_low"
 
 
 class MatIOFields(object):
@@ -233,6 +260,20 @@ class MatIOFields(object):
     IMAGE_RBC_OSC = "image_rbc_osc"
 
 
+class DynSpectFields(object):
+    """Time series fields of the dynamic spectroscopy fit."""
+
+    T = "t"
+    RBC_M_RATIO = "rbc_m_ratio"
+    AREA = "area"
+    FREQ = "freq"
+    FWHML = "fwhmL"
+    FWHMG = "fwhmG"
+    PHASE = "phase"
+    NFEV = "nfev"
+    N_ALIAS_REFITS = "n_alias_refits"
+
+
 class VENHISTOGRAMFields(object):
     """Ventilation historam fields."""
 
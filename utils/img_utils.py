@@ -3,21 +3,17 @@
 import pdb
 import sys
 
-import cv2
-
 sys.path.append("..")
-from typing import Any, List, Optional, Tuple
-
-import matplotlib
+from typing import Any, List, Optional, Sequence, Tuple
 
-matplotlib.use("TkAgg")
-import matplotlib.pyplot as plt
 import numpy as np
 import scipy
-import skimage
 from scipy import interpolate, ndimage
 
-from utils import constants
+from utils import constants, filter_utils
+from utils.lazy_import import lazy_import
+
+skimage = lazy_import("skimage")
 
 
 def remove_small_objects(mask: np.ndarray, scale: float = 0.1):
@@ -111,17 +107,17 @@ def standardize_image(image: np.ndarray) -> np.ndarray:
 def erode_image(image: np.ndarray, erosion: int = 3) -> np.ndarray:
     """Erode image.
 
-    Erodes image slice by slice.
+    Erodes image slice by slice with a square kernel, as cv2.erode of each slice
+    with its default border. The square is separable, so the whole volume is eroded
+    one in-plane axis at a time.
 
     Args:
-        image (np.ndarray): 3-D image to erode.
+        image (np.ndarray): 3-D image to erode, eroded in place.
         erosion (int): size of erosion kernel.
     Returns:
         Eroded image.
     """
-    kernel = np.ones((erosion, erosion), np.uint8)
-    for i in range(image.shape[2]):
-        image[:, :, i] = cv2.erode(image[:, :, i], kernel, iterations=1)
+    image[...] = filter_utils.box_erode(image, erosion, axes=(0, 1))
     return image
 
 
@@ -152,12 +148,14 @@ def divide_images(
 def smooth_image(image: np.ndarray, kernel: int = 11) -> np.ndarray:
     """Smooth the image using a blurring kernel.
 
+    Matches ndimage.convolve with a normalized box and zero padding, computed as a
+    separable running mean.
+
     Args:
         image (np.ndarray): 3D image to smooth.
         kernel (int, optional): size of the kernel. Defaults to 11.
     """
-    kernel = np.ones((kernel, kernel, kernel)) / (kernel**3)  # type: ignore
-    return ndimage.convolve(image, kernel, mode="constant")
+    return filter_utils.box_mean(image, kernel, cval=0.0)
 
 
 def correct_B0(
@@ -165,6 +163,10 @@ def correct_B0(
 ) -> np.ndarray:
     """Correct B0 inhomogeneity.
 
+    Rotates the image until the mean of its wrapped phase in the mask is zero. The
+    wrapped mean has no closed form, but only the voxels in the mask take part in
+    the iterations, so the full volume is rotated once at the end.
+
     Args:
         image (np.ndarray): image to correct.
         mask (np.ndarray): mask of the image. must be same shape as image.
@@ -174,15 +176,17 @@ def correct_B0(
     """
     index = 0
     meanphase = 1
+    totalphase = 0.0
+    image_masked = image[mask]
 
     while abs(meanphase) > 1e-7:
         index = index + 1
-        diffphase = np.angle(image)
-        meanphase = np.mean(diffphase[mask])  # type: ignore
-        image = np.multiply(image, np.exp(-1j * meanphase))
+        meanphase = np.mean(np.angle(image_masked))
+        image_masked = np.multiply(image_masked, np.exp(-1j * meanphase))
+        totalphase += meanphase
         if index > max_iterations:
             break
-    return np.angle(image)  # type: ignore
+    return np.angle(np.multiply(image, np.exp(-1j * totalphase)))  # type: ignore
 
 
 def dixon_decomposition(
@@ -206,26 +210,62 @@ def dixon_decomposition(
     Returns:
         Tuple of decomposed RBC and membrane images respectively.
     """
+    return dixon_decomposition_many(
+        image_gas=image_gas,
+        images_dissolved=[image_dissolved],
+        mask=mask,
+        rbc_m_ratios=[rbc_m_ratio],
+    )[0]
+
+
+def dixon_decomposition_many(
+    image_gas: np.ndarray,
+    images_dissolved: Sequence[np.ndarray],
+    mask: np.ndarray,
+    rbc_m_ratios: Sequence[float],
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Apply 1-point dixon decomposition on several dissolved images.
+
+    Same as dixon_decomposition for each dissolved image, with the B0 phase of the
+    gas image computed once. The rotated images are written into the real RBC and
+    membrane outputs without complex intermediate volumes.
+
+    Args:
+        image_gas (np.ndarray): gas image
+        images_dissolved (Sequence[np.ndarray]): dissolved images
+        mask (np.ndarray): boolean mask of the lung, the same size as the images.
+        rbc_m_ratios (Sequence[float]): RBC:m ratio of each dissolved image
+    Returns:
+        List of the decomposed RBC and membrane images of each dissolved image.
+    """
     # correct for B0 inhomogeneity
     diffphase = correct_B0(image_gas, mask)
-    image_dissolved_B0 = np.multiply(image_dissolved, np.exp(1j * -diffphase))
-    # calculate phase shift to separate RBC and membrane
-    desired_angle = np.arctan2(rbc_m_ratio, 1.0)
-    current_angle = np.angle(np.sum(image_dissolved_B0[mask > 0]))
-    delta_angle = desired_angle - current_angle
-    image_dixon = np.multiply(image_dissolved, np.exp(1j * (delta_angle - diffphase)))
-    # separate RBC and membrane components
-    image_rbc = (
-        np.imag(image_dixon)
-        if np.mean(np.imag(image_dixon)[mask]) > 0
-        else -1 * np.imag(image_dixon)  # type: ignore
-    )
-    image_membrane = (
-        np.real(image_dixon)
-        if np.mean(np.real(image_dixon)[mask]) > 0
-        else -1 * np.real(image_dixon)  # type: ignore
-    )
-    return image_rbc, image_membrane
+    b0_masked = np.exp(1j * -diffphase[mask > 0])
+    angle = np.empty(diffphase.shape)
+    cos_angle = np.empty(diffphase.shape)
+    sin_angle = np.empty(diffphase.shape)
+    out = []
+    for image_dissolved, rbc_m_ratio in zip(images_dissolved, rbc_m_ratios):
+        # calculate phase shift to separate RBC and membrane
+        desired_angle = np.arctan2(rbc_m_ratio, 1.0)
+        current_angle = np.angle(np.sum(image_dissolved[mask > 0] * b0_masked))
+        delta_angle = desired_angle - current_angle
+        np.subtract(delta_angle, diffphase, out=angle)
+        np.cos(angle, out=cos_angle)
+        np.sin(angle, out=sin_angle)
+        # separate RBC and membrane components, the imaginary and real channel of
+        # the rotated image
+        real = np.real(image_dissolved)
+        imag = np.imag(image_dissolved)
+        image_rbc = np.multiply(real, sin_angle)
+        image_rbc += np.multiply(imag, cos_angle, out=angle)
+        image_membrane = np.multiply(real, cos_angle)
+        image_membrane -= np.multiply(imag, sin_angle, out=angle)
+        for image in (image_rbc, image_membrane):
+            if not np.mean(image[mask]) > 0:
+                np.negative(image, out=image)
+        out.append((image_rbc, image_membrane))
+    return out
 
 
 def calculate_rbc_oscillation(
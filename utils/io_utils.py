@@ -10,15 +10,15 @@ import glob
 import logging
 from typing import Any, Dict, List, Optional, Tuple
 
-import ismrmrd
-import mapvbvd
-import matplotlib
 import nibabel as nib
 import numpy as np
-import pandas as pd
 import scipy.io as sio
 
-from utils import constants, mrd_utils, twix_utils
+from utils import constants, mrd_utils, twix_reader, twix_utils
+from utils.lazy_import import lazy_import
+
+ismrmrd = lazy_import("ismrmrd")
+mapvbvd = lazy_import("mapvbvd")
 
 
 def import_np(path: str) -> np.ndarray:
@@ -77,6 +77,50 @@ def import_matstruct_to_dict(struct: np.ndarray) -> Dict[str, Any]:
     return out_dict
 
 
+def import_subject_mat(path: str) -> Dict[str, Any]:
+    """Import the subject instance variables from a mat file.
+
+    Note: The mat file variable names are matched to the instance variable names.
+    Thus, if the variable names are changed in the mat file, they must be changed.
+
+    Args:
+        path: str file path of mat file
+    Returns:
+        dictionary of the instance variables needed to rerun the analysis
+    """
+    mdict = import_mat(path)
+    out_dict = {
+        "dict_dis": import_matstruct_to_dict(mdict["dict_dis"]),
+        "dict_dyn": import_matstruct_to_dict(mdict["dict_dyn"]),
+    }
+    if "dict_ute" in mdict.keys():
+        logging.info("UTE proton data found.")
+        out_dict["dict_ute"] = import_matstruct_to_dict(mdict["dict_ute"])
+    out_dict.update(
+        {
+            "data_dissolved": mdict["data_dissolved"],
+            "data_dissolved_norm": mdict["data_dissolved_norm"],
+            "data_gas": mdict["data_gas"],
+            "data_rbc_k0": mdict["data_rbc_k0"].flatten(),
+            "high_indices": mdict["high_indices"].flatten(),
+            "image_dissolved": mdict["image_dissolved"],
+            "image_dissolved_high": mdict["image_dissolved_high"],
+            "image_dissolved_low": mdict["image_dissolved_low"],
+            "image_dissolved_norm": mdict["image_dissolved_norm"],
+            "image_gas": mdict["image_gas"],
+            "key_radius": int(mdict["key_radius"]),
+            "low_indices": mdict["low_indices"].flatten(),
+            "mask": mdict["mask"].astype(bool),
+            "rbc_m_ratio": float(mdict["rbc_m_ratio"]),
+            "rbc_m_ratio_high": float(mdict["rbc_m_ratio_high"]),
+            "rbc_m_ratio_low": float(mdict["rbc_m_ratio_low"]),
+            "traj_dissolved": mdict["traj_dissolved"],
+            "traj_gas": mdict["traj_gas"],
+        }
+    )
+    return out_dict
+
+
 def get_dyn_twix_files(path: str) -> str:
     """Get list of dynamic spectroscopy twix files.
 
@@ -179,6 +223,63 @@ def get_mat_file(path: str) -> str:
         raise ValueError("Can't find mat file in path.")
 
 
+def get_subject_store_file(path: str) -> str:
+    """Get the subject store file of reconstructed images.
+
+    Args:
+        path: str directory path of the subject store.
+    Returns:
+        str file path of the subject store, empty if there is none
+    """
+    files = glob.glob(os.path.join(path, "*" + constants.SUBJECT_STORE_SUFFIX))
+    return files[0] if files else ""
+
+
+def _read_twix(path: str, sort: bool = False) -> Tuple[Any, np.ndarray]:
+    """Read the header and the image data of a twix file.
+
+    The image data is read by the native twix_reader if it supports the file, and
+    by mapVBVD otherwise.
+
+    Args:
+        path: str file path of twix file
+        sort: bool whether to sort the image data by its loop counters like
+            twix_obj.image[""] instead of keeping the acquisition order like
+            twix_obj.image.unsorted()
+    Returns: tuple of the twix object and the image data in the layout of the
+    mapVBVD image object.
+    """
+    try:
+        twix_obj = mapvbvd.mapVBVD(path, quiet=True, bReadMDH=False)
+    except:
+        raise ValueError("Invalid twix file.")
+    if isinstance(twix_obj, list):
+        # older data has an adjustment measurement before the image measurement
+        twix_obj = twix_obj[-1]
+    try:
+        if twix_reader.needs_regrid(twix_obj):
+            raise ValueError("Regridding is not supported.")
+        lines, counters = twix_reader.read_image_lines(path)
+        if sort:
+            return twix_obj, twix_reader.get_sorted(lines, counters)
+        return twix_obj, twix_reader.get_unsorted(lines)
+    except ValueError as e:
+        logging.info("Reading {} with mapVBVD: {}".format(path, e))
+
+    twix_obj = mapvbvd.mapVBVD(path, quiet=True)
+    if isinstance(twix_obj, list):
+        twix_obj = twix_obj[-1]
+    try:
+        twix_obj.image.squeeze = True
+        twix_obj.image.flagIgnoreSeg = True
+        twix_obj.image.flagRemoveOS = False
+    except:
+        raise ValueError("Cannot get data from twix object.")
+    if sort:
+        return twix_obj, twix_obj.image[""]
+    return twix_obj, twix_obj.image.unsorted()
+
+
 def read_dyn_twix(path: str) -> Dict[str, Any]:
     """Read dynamic spectroscopy twix file.
 
@@ -193,17 +294,11 @@ def read_dyn_twix(path: str) -> Dict[str, Any]:
         5. excitation frequency in ppm.
         6. dissolved phase FIDs in format (n_points, n_projections).
     """
-    try:
-        twix_obj = mapvbvd.mapVBVD(path)
-    except:
-        raise ValueError("Invalid twix file.")
-    twix_obj.image.squeeze = True
-    twix_obj.image.flagIgnoreSeg = True
-    twix_obj.image.flagRemoveOS = False
+    twix_obj, raw_fids = _read_twix(path, sort=True)
 
     # Get scan information
     dwell_time = twix_utils.get_dwell_time(twix_obj=twix_obj)
-    fids_dis = twix_utils.get_dyn_fids(twix_obj)
+    fids_dis = twix_utils.get_dyn_fids(twix_obj, raw_fids=raw_fids)
     freq_center = twix_utils.get_center_freq(twix_obj=twix_obj)
     freq_excitation = twix_utils.get_excitation_freq(twix_obj=twix_obj)
     scan_date = twix_utils.get_scan_date(twix_obj=twix_obj)
@@ -246,15 +341,8 @@ def read_dis_twix(path: str) -> Dict[str, Any]:
         - TE90 in seconds.
         - TR in seconds.
     """
-    try:
-        twix_obj = mapvbvd.mapVBVD(path)
-    except:
-        raise ValueError("Invalid twix file.")
-    twix_obj.image.squeeze = True
-    twix_obj.image.flagIgnoreSeg = True
-    twix_obj.image.flagRemoveOS = False
-
-    data_dict = twix_utils.get_gx_data(twix_obj=twix_obj)
+    twix_obj, raw_fids = _read_twix(path)
+    data_dict = twix_utils.get_gx_data(twix_obj=twix_obj, raw_fids=raw_fids)
 
     return {
         constants.IOFields.DWELL_TIME: twix_utils.get_dwell_time(twix_obj),
@@ -291,22 +379,8 @@ def read_ute_twix(path: str) -> Dict[str, Any]:
     This includes:
         TODO
     """
-    try:
-        twix_obj = mapvbvd.mapVBVD(path)
-    except:
-        raise ValueError("Invalid twix file.")
-    try:
-        twix_obj.image.squeeze = True
-    except:
-        # this is old data, need to get the 2nd element
-        twix_obj = twix_obj[1]
-    try:
-        twix_obj.image.squeeze = True
-        twix_obj.image.flagIgnoreSeg = True
-        twix_obj.image.flagRemoveOS = False
-    except:
-        raise ValueError("Cannot get data from twix object.")
-    data_dict = twix_utils.get_ute_data(twix_obj=twix_obj)
+    twix_obj, raw_fids = _read_twix(path)
+    data_dict = twix_utils.get_ute_data(twix_obj=twix_obj, raw_fids=raw_fids)
 
     return {
         constants.IOFields.DWELL_TIME: twix_utils.get_dwell_time(twix_obj),
@@ -430,14 +504,14 @@ def export_nii(image: np.ndarray, path: str, fov: Optional[float] = None):
     nib.save(nii_imge, path)
 
 
-def export_subject_mat(subject: object, path: str):
+def export_subject_mat(values: Dict[str, Any], path: str):
     """Export select subject instance variables to mat file.
 
     Args:
-        subject: subject instance
+        values: dictionary of the subject instance variables
         path: str file path of mat file
     """
-    sio.savemat(path, vars(subject))
+    sio.savemat(path, values)
 
 
 def export_np(arr: np.ndarray, path: str):
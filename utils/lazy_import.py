@@ -0,0 +1,64 @@
+"""Lazy imports of heavy optional dependencies.
+
+Modules such as TensorFlow, OpenCV, ISMRMRD or mapVBVD take seconds and hundreds of
+megabytes to import but are only needed by some code paths. A lazily imported
+module is only imported on the first attribute access, so runs that never touch it
+do not pay for it.
+"""
+import importlib
+import importlib.util
+import sys
+import types
+
+
+class _LazyModule(types.ModuleType):
+    """Placeholder that imports the module it stands for on first attribute access.
+
+    Attributes:
+        _module (types.ModuleType): the imported module, None until first use.
+    """
+
+    def __init__(self, name: str):
+        """Initialize the placeholder.
+
+        Args:
+            name (str): absolute name of the module.
+        """
+        super().__init__(name)
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        """Import the module if needed and get one of its attributes."""
+        if attr == "_module":
+            raise AttributeError(attr)
+        if self._module is None:
+            self._module = importlib.import_module(self.__name__)
+        return getattr(self._module, attr)
+
+    def __dir__(self):
+        """List the attributes of the imported module."""
+        if self._module is None:
+            self._module = importlib.import_module(self.__name__)
+        return dir(self._module)
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """Import a module when one of its attributes is first accessed.
+
+    Only the top level package is looked up immediately so that a missing
+    dependency fails at import time and not in the middle of processing.
+
+    Args:
+        name (str): absolute name of the module, e.g. "matplotlib.pyplot".
+    Returns:
+        types.ModuleType: the module, or a placeholder that imports it on first
+            attribute access.
+    Raises:
+        ModuleNotFoundError: if the top level package is not installed.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    package = name.split(".")[0]
+    if package not in sys.modules and importlib.util.find_spec(package) is None:
+        raise ModuleNotFoundError("No module named '{}'".format(package), name=package)
+    return _LazyModule(name)
@@ -2,13 +2,19 @@
 
 import math
 import sys
+import threading
 from datetime import datetime
+from typing import Dict, List, Sequence, Tuple
 
 sys.path.append("..")
 import numpy as np
-from scipy.ndimage.morphology import binary_dilation
 
-from utils import constants
+from utils import checkpoint_utils, constants, filter_utils
+
+# noise cubes of the last mask, most callers compute the SNR of many images with
+# the same mask
+_NOISE_CUBES: Dict[str, np.ndarray] = {}
+_NOISE_CUBES_LOCK = threading.Lock()
 
 
 def _get_dilation_kernel(x: int) -> int:
@@ -16,6 +22,83 @@ def _get_dilation_kernel(x: int) -> int:
     return int((math.ceil(x * 0.025) * 2 + 1))
 
 
+def _to_cubes(image: np.ndarray, window_size: int) -> np.ndarray:
+    """Partition an image into cubes, dropping the remainder at the far edges.
+
+    Args:
+        image (np.ndarray): 3-D array.
+        window_size (int): edge length of the cubes.
+    Returns:
+        np.ndarray: voxels of each cube of shape (n_cubes, window_size**3), the
+            cubes in C order of their position.
+    """
+    n_cubes = [dim // window_size for dim in np.shape(image)]
+    cropped = image[tuple(slice(0, n * window_size) for n in n_cubes)]
+    cubes = cropped.reshape(
+        n_cubes[0], window_size, n_cubes[1], window_size, n_cubes[2], window_size
+    ).transpose(0, 2, 4, 1, 3, 5)
+    return cubes.reshape(-1, window_size**3)
+
+
+def get_noise_cubes(mask: np.ndarray, window_size: int = 8) -> np.ndarray:
+    """Get the noise voxels of each cube of the noise partition of a mask.
+
+    The noise region is the complement of the mask dilated by a box of about 5% of
+    the image size, dilated as scipy.ndimage.binary_dilation with a zero border.
+
+    Args:
+        mask (np.ndarray): 3-D array of mask data.
+        window_size (int): size of the cubes for noise calculation.
+    Returns:
+        np.ndarray: boolean array of shape (n_cubes, window_size**3), True for the
+            voxels of a cube that are in the noise region.
+    """
+    key = checkpoint_utils.fingerprint([mask, window_size])
+    with _NOISE_CUBES_LOCK:
+        if key in _NOISE_CUBES:
+            return _NOISE_CUBES[key]
+    noise_mask = filter_utils.box_dilate(
+        mask.astype(bool), [_get_dilation_kernel(dim) for dim in np.shape(mask)]
+    )
+    noise_cubes = _to_cubes(~noise_mask, window_size)
+    with _NOISE_CUBES_LOCK:
+        _NOISE_CUBES.clear()
+        _NOISE_CUBES[key] = noise_cubes
+    return noise_cubes
+
+
+def snr_many(
+    images: Sequence[np.ndarray], mask: np.ndarray, window_size: int = 8
+) -> List[Tuple[float, float, float]]:
+    """Calculate the SNR of several images with the same mask.
+
+    The noise is the median of the standard deviations of the noise voxels in the
+    cubes of the image that are mostly outside of the dilated mask.
+
+    Args:
+        images (Sequence[np.ndarray]): 3-D arrays of image data.
+        mask (np.ndarray): 3-D array of mask data.
+        window_size (int): size of the cubes for noise calculation. Defaults to 8.
+    Returns:
+        List of tuples of SNR, Rayleigh SNR and image noise of each image.
+    """
+    mask = mask.astype(bool)
+    noise_cubes = get_noise_cubes(mask, window_size)
+    # minimum number of noise voxels to calculate the std of a cube
+    min_voxels = 0.75 * window_size**3
+    out = []
+    for image in images:
+        cubes = _to_cubes(image, window_size)
+        valid = noise_cubes & ~np.isnan(cubes)
+        keep = np.count_nonzero(valid, axis=1) > min_voxels
+        cubes = np.where(valid[keep], cubes[keep], np.nan)
+        image_noise = np.median(np.nanstd(cubes, axis=1, ddof=1))
+        image_signal = np.average(image[mask])
+        SNR = image_signal / image_noise
+        out.append((SNR, SNR * 0.66, image_noise))
+    return out
+
+
 def snr(image: np.ndarray, mask: np.ndarray, window_size: int = 8):
     """Calculate SNR using sliding windows.
 
@@ -27,50 +110,7 @@ def snr(image: np.ndarray, mask: np.ndarray, window_size: int = 8):
     Returns:
         Tuple of SNR and Rayleigh SNR and image noise
     """
-    # convert mask to boolean
-    mask = mask.astype(bool)
-    shape = np.shape(image)
-    # dilate the mask to analyze noise area away from the signal
-    kernel_shape = (
-        _get_dilation_kernel(shape[0]),
-        _get_dilation_kernel(shape[1]),
-        _get_dilation_kernel(shape[2]),
-    )
-    dilate_struct = np.ones((kernel_shape))
-    noise_mask = binary_dilation(mask, dilate_struct).astype(bool)
-
-    noise_temp = np.copy(image)
-    noise_temp[noise_mask] = np.nan
-    # set up for using mini noise cubes through the image and calculate std for noise
-    n_noise_vox = window_size * window_size * window_size
-    mini_vox_std = 0.75 * n_noise_vox  # minimul number of voxels to calculate std
-
-    stepper = 0
-    total = 0
-    std_dev_mini_noise_vol = []
-
-    for ii in range(0, int(shape[0] / window_size)):
-        for jj in range(0, int(shape[1] / window_size)):
-            for kk in range(0, int(shape[2] / window_size)):
-                mini_cube_noise_dist = noise_temp[
-                    ii * window_size : (ii + 1) * window_size,
-                    jj * window_size : (jj + 1) * window_size,
-                    kk * window_size : (kk + 1) * window_size,
-                ]
-                mini_cube_noise_dist = mini_cube_noise_dist[
-                    ~np.isnan(mini_cube_noise_dist)
-                ]
-                # only calculate std for the noise when it is long enough
-                if len(mini_cube_noise_dist) > mini_vox_std:
-                    std_dev_mini_noise_vol.append(np.std(mini_cube_noise_dist, ddof=1))
-                    stepper = stepper + 1
-                total = total + 1
-
-    image_noise = np.median(std_dev_mini_noise_vol)
-    image_signal = np.average(image[mask])
-
-    SNR = image_signal / image_noise
-    return SNR, SNR * 0.66, image_noise
+    return snr_many([image], mask, window_size)[0]
 
 
 def mse(image1: np.ndarray, image2: np.ndarray) -> float:
@@ -1,12 +1,16 @@
 """MRD util functions."""
+from __future__ import annotations
+
 import logging
 import pdb
 import sys
-from typing import Any, Dict, List, Tuple
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Tuple
 
-import ismrmrd
 import numpy as np
 
+if TYPE_CHECKING:
+    import ismrmrd
+
 sys.path.append("..")
 from utils import constants
 
@@ -35,6 +39,52 @@ def get_dwell_time(header: ismrmrd.xsd.ismrmrdschema.ismrmrd.ismrmrdHeader) -> f
     return 1e-6 * header.encoding[0].trajectoryDescription.userParameterDouble[0].value
 
 
+def read_acquisitions(
+    dataset: ismrmrd.hdf5.Dataset, n_acquisitions: int = -1, start: int = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Read the data of the first channel and the trajectory of the acquisitions.
+
+    The acquisitions are read from the HDF5 file at once instead of constructing an
+    ismrmrd.Acquisition for each of them.
+
+    Args:
+        dataset (ismrmrd.hdf5.Dataset): MRD dataset
+        n_acquisitions (int): number of acquisitions to read, all remaining ones if
+            negative.
+        start (int): index of the first acquisition to read.
+    Returns:
+        Tuple of the data of shape (n_acquisitions, n_points) and the trajectory of
+        shape (n_acquisitions, n_points, n_dims), with n_dims = 0 for acquisitions
+        without a trajectory.
+    Raises:
+        ValueError: if the acquisitions differ in size.
+    """
+    stop = start + n_acquisitions if n_acquisitions >= 0 else None
+    # ismrmrd only reads the acquisition dataset element-wise
+    acquisitions = dataset._dataset["data"][start:stop]
+    head = acquisitions["head"]
+    sizes = np.stack(
+        [
+            head["active_channels"],
+            head["number_of_samples"],
+            head["trajectory_dimensions"],
+        ]
+    )
+    if np.ptp(sizes, axis=1).any():
+        raise ValueError("Acquisitions of different sizes.")
+    n_channels, n_points, n_dims = (int(size) for size in sizes[:, 0])
+    data = (
+        np.stack(acquisitions["data"])
+        .view(np.complex64)
+        .reshape(-1, n_channels, n_points)[:, 0, :]
+    )
+    if n_dims == 0:
+        # e.g. the FIDs of the dynamic spectroscopy
+        return data, np.zeros((data.shape[0], n_points, 0), dtype=np.float32)
+    traj = np.stack(acquisitions["traj"]).reshape(-1, n_points, n_dims)
+    return data, traj
+
+
 def get_dyn_fids(dataset: ismrmrd.hdf5.Dataset, n_skip_end: int = 20) -> np.ndarray:
     """Get the dissolved phase FIDS used for dyn. spectroscopy from mrd object.
 
@@ -45,11 +95,38 @@ def get_dyn_fids(dataset: ismrmrd.hdf5.Dataset, n_skip_end: int = 20) -> np.ndar
     Returns:
         dissolved phase FIDs in shape (number of points in ray, number of projections).
     """
-    raw_fids = []
     n_projections = dataset.number_of_acquisitions() - n_skip_end
-    for i in range(0, int(n_projections)):  # type: ignore
-        raw_fids.append(dataset.read_acquisition(i).data[0].flatten())
-    return np.transpose(np.asarray(raw_fids))
+    raw_fids, _ = read_acquisitions(dataset, n_acquisitions=int(n_projections))
+    return np.transpose(raw_fids)
+
+
+def iter_gx_blocks(
+    dataset: ismrmrd.hdf5.Dataset, block_size: int = 100
+) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+    """Iterate over the interleaved gas and dissolved phase FIDs in blocks.
+
+    The number of acquisitions is checked again before each block, so acquisitions
+    appended to the dataset while iterating are also read.
+
+    Args:
+        dataset (ismrmrd.hdf5.Dataset): MRD dataset
+        block_size (int): number of projections of each phase per block.
+    Yields:
+        Tuple of the index of the first projection of the block, the gas phase FIDs
+        and the dissolved phase FIDs of shape (n_projections, number of points in
+        ray), as in get_gx_data.
+    """
+    start = 0
+    while 2 * start + 1 < dataset.number_of_acquisitions():
+        n_acquisitions = min(
+            2 * block_size, dataset.number_of_acquisitions() - 2 * start
+        )
+        # only read complete pairs of gas and dissolved phase acquisitions
+        raw_fids, _ = read_acquisitions(
+            dataset, n_acquisitions=n_acquisitions - n_acquisitions % 2, start=2 * start
+        )
+        yield start, raw_fids[0::2, :], raw_fids[1::2, :]
+        start += raw_fids.shape[0] // 2
 
 
 def get_excitation_freq(
@@ -277,16 +354,15 @@ def get_gx_data(
         8. gradient delay z in microseconds.
     """
     institution = get_institution_name(header)
-    # get the raw FIDs
-    raw_fids = []
-    n_projections = dataset.number_of_acquisitions()
-    for i in range(0, int(n_projections)):  # type: ignore
-        raw_fids.append(dataset.read_acquisition(i).data[0].flatten())
-    raw_fids = np.asarray(raw_fids)
-    # get the trajectories
-    raw_traj = np.empty((raw_fids.shape[0], raw_fids.shape[1], 3))
-    for i in range(0, int(n_projections)):  # type: ignore
-        raw_traj[i, :, :] = dataset.read_acquisition(i).traj
+    # get the raw FIDs and trajectories
+    raw_fids, raw_traj = read_acquisitions(dataset)
+    if raw_traj.shape[2] != 3:
+        raise ValueError(
+            "Expected a 3-D trajectory, got {} dimensions.".format(raw_traj.shape[2])
+        )
+    raw_traj = raw_traj.reshape(raw_fids.shape[0], raw_fids.shape[1], 3).astype(
+        np.float64
+    )
 
     if institution == "CCHMC" and raw_fids.shape[1] == 128:
         raw_traj = 0.5 * raw_traj
@@ -5,12 +5,13 @@ import sys
 from typing import Dict, List, Tuple
 
 sys.path.append("..")
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
 import scipy.stats as stats
 
 from utils import constants, io_utils
+from utils.lazy_import import lazy_import
+
+plt = lazy_import("matplotlib.pyplot")
 
 
 def map_grey_to_rgb(image: np.ndarray, cmap: Dict[int, np.ndarray]) -> np.ndarray:
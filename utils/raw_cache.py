@@ -0,0 +1,189 @@
+"""Per-machine cache of the data read from raw TWIX and MRD files.
+
+Parsing a raw scan takes seconds, while the arrays and metadata fields that the
+pipeline uses fit in a few megabytes. The first read of a file stores the arrays as
+npy files in the dtype returned by the reader and the metadata as a JSON sidecar.
+Later reads of a file with the same content memory map the arrays copy-on-write, so
+only the pages that are used are read and writes stay private to the process.
+Entries are keyed by the content hash of the raw file and the name of the reader,
+so renamed or copied files share an entry and modified files get a new one. The
+least recently used entries are evicted once the cache exceeds MAX_CACHE_BYTES.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import Any, Callable, Dict
+
+import numpy as np
+
+from utils import constants
+
+# bump to invalidate all entries when a reader changes its output
+RAW_CACHE_VERSION = 2
+# size of the cache entries above which the least recently used ones are evicted
+MAX_CACHE_BYTES = 5 * 1024**3
+_META_FILE = "meta.json"
+_HASH_CHUNK_BYTES = 1 << 24
+
+
+def get_cache_dir() -> str:
+    """Get the directory of the raw data cache."""
+    return os.path.join(constants.CACHE_DIR, "raw")
+
+
+def get_file_hash(path: str, cache_dir: str) -> str:
+    """Get the content hash of a file.
+
+    The hash is remembered together with the size and modification time of the
+    file, so unchanged files are only hashed once.
+
+    Args:
+        path (str): path of the file.
+        cache_dir (str): cache directory.
+    Returns:
+        str: hex digest of the file content.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    memo_path = os.path.join(
+        cache_dir, "hashes", hashlib.sha1(path.encode()).hexdigest() + ".json"
+    )
+    if os.path.exists(memo_path):
+        with open(memo_path, "r") as f:
+            memo = json.load(f)
+        if memo["size"] == stat.st_size and memo["mtime_ns"] == stat.st_mtime_ns:
+            return memo["hash"]
+    hasher = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_BYTES), b""):
+            hasher.update(chunk)
+    memo = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "hash": hasher.hexdigest(),
+    }
+    os.makedirs(os.path.dirname(memo_path), exist_ok=True)
+    with open(memo_path + ".tmp", "w") as f:
+        json.dump(memo, f)
+    os.replace(memo_path + ".tmp", memo_path)
+    return memo["hash"]
+
+
+def _save_entry(out_dict: Dict[str, Any], entry_dir: str):
+    """Save the output of a reader into a cache entry.
+
+    The entry is written to a temporary directory and renamed, so concurrent
+    readers of the same file never see a partial entry.
+
+    Args:
+        out_dict (Dict[str, Any]): output of the reader.
+        entry_dir (str): directory of the cache entry.
+    """
+    parent_dir = os.path.dirname(entry_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir)
+    meta = {"keys": list(out_dict), "fields": {}, "arrays": []}
+    for key, value in out_dict.items():
+        if isinstance(value, np.ndarray):
+            np.save(os.path.join(tmp_dir, key + ".npy"), value)
+            meta["arrays"].append(key)
+        else:
+            if isinstance(value, np.generic):
+                value = value.item()
+            meta["fields"][key] = value
+    with open(os.path.join(tmp_dir, _META_FILE), "w") as f:
+        json.dump(meta, f, indent=2)
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # another process created the entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _load_entry(entry_dir: str) -> Dict[str, Any]:
+    """Load a cache entry.
+
+    Args:
+        entry_dir (str): directory of the cache entry.
+    Returns:
+        Dict[str, Any]: output of the reader, with the arrays as copy-on-write memory
+            maps.
+    """
+    meta_path = os.path.join(entry_dir, _META_FILE)
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+    # mark the entry as recently used for the eviction
+    os.utime(meta_path)
+    out_dict = {}
+    for key in meta["keys"]:
+        if key in meta["arrays"]:
+            out_dict[key] = np.load(
+                os.path.join(entry_dir, key + ".npy"), mmap_mode="c"
+            )
+        else:
+            out_dict[key] = meta["fields"][key]
+    return out_dict
+
+
+def _get_entry_size(entry_dir: str) -> int:
+    """Get the size of the files of a cache entry in bytes."""
+    return sum(
+        os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir)
+    )
+
+
+def evict(cache_dir: str, max_bytes: int = MAX_CACHE_BYTES):
+    """Remove the least recently used entries until the cache fits its size.
+
+    Args:
+        cache_dir (str): cache directory.
+        max_bytes (int): maximum size of the entries in bytes.
+    """
+    entries = []
+    for meta_path in glob.glob(os.path.join(cache_dir, "v*", "*", _META_FILE)):
+        entry_dir = os.path.dirname(meta_path)
+        try:
+            entries.append(
+                (os.path.getmtime(meta_path), _get_entry_size(entry_dir), entry_dir)
+            )
+        except OSError:
+            # removed by another process
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in sorted(entries):
+        if total <= max_bytes:
+            break
+        logging.info("Evicting {} from the raw data cache.".format(entry_dir))
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+
+
+def read_cached(
+    read_fn: Callable[[str], Dict[str, Any]], path: str, cache_dir: str = ""
+) -> Dict[str, Any]:
+    """Read a raw file through the cache.
+
+    Args:
+        read_fn (Callable): reader of the raw file, e.g. io_utils.read_dis_twix.
+        path (str): path of the raw file.
+        cache_dir (str): cache directory. Defaults to get_cache_dir().
+    Returns:
+        Dict[str, Any]: output of the reader.
+    """
+    cache_dir = cache_dir or get_cache_dir()
+    entry_dir = os.path.join(
+        cache_dir,
+        "v{}".format(RAW_CACHE_VERSION),
+        "{}_{}".format(read_fn.__name__, get_file_hash(path, cache_dir)),
+    )
+    if os.path.exists(os.path.join(entry_dir, _META_FILE)):
+        logging.info("Loading {} from the raw data cache.".format(path))
+        return _load_entry(entry_dir)
+    out_dict = read_fn(path)
+    _save_entry(out_dict, entry_dir)
+    evict(cache_dir)
+    return out_dict
@@ -4,7 +4,10 @@ import pdb
 import sys
 from typing import Any, Dict
 
-import pdfkit
+sys.path.append("..")
+from utils.lazy_import import lazy_import
+
+pdfkit = lazy_import("pdfkit")
 
 PDF_OPTIONS = {
     "page-width": 300,
@@ -34,24 +37,27 @@ def format_dict(stats_dict: Dict[str, Any]) -> Dict[str, Any]:
     return stats_dict
 
 
-def clinical(stats_dict: Dict[str, Any], path: str):
+def clinical(stats_dict: Dict[str, Any], path: str, tmp_dir: str = "tmp"):
     """Make clinical report.
 
     First converts dictionary to html format. Then saves to path.
     Args:
         stats_dict (Dict[str, Any]): dictionary of statistics
         path (str): path to save report
+        tmp_dir (str): directory of the figures of the report, the html file is
+            written there as well.
     """
     stats_dict = format_dict(stats_dict)
     current_path = os.path.dirname(__file__)
-    path_clinical = os.path.abspath(
-        os.path.join(current_path, os.pardir, "assets", "html", "clinical.html")
-    )
-    path_html = os.path.join("tmp", "clinical.html")
+    path_assets = os.path.abspath(os.path.join(current_path, os.pardir, "assets"))
+    path_clinical = os.path.join(path_assets, "html", "clinical.html")
+    path_html = os.path.join(tmp_dir, "clinical.html")
     # write report to html
     with open(path_clinical, "r") as f:
         file = f.read()
-        rendered = file.format(**stats_dict)
+        rendered = file.format(
+            tmp_dir=os.path.abspath(tmp_dir), assets_dir=path_assets, **stats_dict
+        )
     with open(path_html, "w") as o:
         o.write(rendered)
     # write clinical report to pdf
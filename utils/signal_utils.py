@@ -1,16 +1,18 @@
 """Signal processing util functions."""
 import pdb
 import sys
-from typing import Any, Literal, Tuple
+from typing import Any, Callable, Dict, List, Literal, Tuple
 
 sys.path.append("..")
 import numpy as np
-import pywt
 import scipy.optimize as optimize
 import scipy.signal as signal
 import scipy.stats as stats
 
 from utils import constants
+from utils.lazy_import import lazy_import
+
+pywt = lazy_import("pywt")
 
 
 def _movmean(x: np.ndarray, n: int) -> np.ndarray:
@@ -100,20 +102,61 @@ def _sinnstart(x: np.ndarray, y: np.ndarray, n: int) -> np.ndarray:
     return start
 
 
-def _sinbounds(n: int) -> Tuple[np.ndarray, np.ndarray]:
-    """Get bounds for sum of n sine functions.
+def _fit_separable(
+    basis: Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]],
+    y: np.ndarray,
+    p0: np.ndarray,
+    **kwargs,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Fit a model that is linear in some parameters by variable projection.
 
-    Upper bounds are inf. Lower bounds are [-inf, 0, -inf] repeated n times.
+    The model is basis(p) @ c. For fixed nonlinear parameters p, the linear
+    coefficients c are the least squares solution, so only p is optimized, on the
+    residual projected onto the orthogonal complement of the basis. The Jacobian is
+    Kaufman's approximation of the derivative of the projected residual. The data is
+    normalized so that the tolerances do not depend on its scale.
 
     Args:
-        n (int): number of sine functions
+        basis (Callable): function of the nonlinear parameters that returns the basis
+            of shape (n, m) and its derivative with respect to each nonlinear
+            parameter of shape (n_params, n, m).
+        y (np.ndarray): data of shape (n,).
+        p0 (np.ndarray): starting values of the nonlinear parameters.
+        kwargs: keyword arguments of scipy.optimize.least_squares.
     Returns:
-        Tuple of lower and upper bounds respectively of length n * 3
+        Tuple of the nonlinear parameters, the linear coefficients and the fitted
+            data of shape (n,).
     """
-    return (
-        np.tile([-np.inf, 0, -np.inf], n),
-        np.tile([np.inf, np.inf, np.inf], n),
+    scale = np.linalg.norm(y) or 1.0
+    y = y / scale
+    cache: Dict[str, Any] = {}
+
+    def solve(p: np.ndarray) -> Dict[str, Any]:
+        if cache.get("p") is None or not np.array_equal(cache["p"], p):
+            phi, dphi = basis(p)
+            u, s, vt = np.linalg.svd(phi, full_matrices=False)
+            # drop the directions of a rank deficient basis
+            rank = s > s[0] * max(phi.shape) * np.finfo(float).eps
+            u, s, vt = u[:, rank], s[rank], vt[rank]
+            uy = u.T @ y
+            coefs = vt.T @ (uy / s)
+            dmodel = dphi @ coefs
+            cache.update(
+                p=np.copy(p),
+                coefs=coefs,
+                model=u @ uy,
+                jac=-(dmodel - (dmodel @ u) @ u.T).T,
+            )
+        return cache
+
+    fit_result = optimize.least_squares(
+        fun=lambda p: y - solve(p)["model"],
+        x0=p0,
+        jac=lambda p: solve(p)["jac"],
+        **kwargs,
     )
+    result = solve(fit_result["x"])
+    return fit_result["x"], scale * result["coefs"], scale * result["model"]
 
 
 def boxcox(data: np.ndarray):
@@ -281,36 +324,34 @@ def lowpass(data: np.ndarray, highcut: float, fs: float) -> np.ndarray:
 def fit_sine(data: np.ndarray) -> np.ndarray:
     """Fit the data to a sum of 8 sine waves.
 
+    A sine a * sin(b * x + c) is a linear combination of sin(b * x) and cos(b * x),
+    so only the 8 frequencies are fitted by variable projection.
+
     Args:
         data (np.ndarray): 1-D array data to be fitted.
     Returns:
         Fitted data. Same shape as input data.
     """
+    n_sines = 8
     x = np.arange(data.shape[0])
-    y = data
-
-    def func(x, *args):
-        return (
-            args[0] * np.sin(args[1] * x + args[2])
-            + args[3] * np.sin(args[4] * x + args[5])
-            + args[6] * np.sin(args[7] * x + args[8])
-            + args[9] * np.sin(args[10] * x + args[11])
-            + args[12] * np.sin(args[13] * x + args[14])
-            + args[15] * np.sin(args[16] * x + args[17])
-            + args[18] * np.sin(args[19] * x + args[20])
-            + args[21] * np.sin(args[22] * x + args[23])
-        )
 
-    p0 = _sinnstart(x, y, 8)
-    bounds = _sinbounds(8)
-    popt, _ = optimize.curve_fit(
-        func,
-        x,
-        y,
-        p0=p0,
-        bounds=bounds,
+    def basis(freqs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        phi = np.empty((x.size, 2 * n_sines))
+        phi[:, 0::2] = np.sin(np.outer(x, freqs))
+        phi[:, 1::2] = np.cos(np.outer(x, freqs))
+        dphi = np.zeros((n_sines, x.size, 2 * n_sines))
+        for i in range(n_sines):
+            dphi[i, :, 2 * i] = x * phi[:, 2 * i + 1]
+            dphi[i, :, 2 * i + 1] = -x * phi[:, 2 * i]
+        return phi, dphi
+
+    _, _, fit = _fit_separable(
+        basis,
+        data,
+        p0=_sinnstart(x, data, n_sines)[1::3],
+        bounds=(0, np.inf),
     )
-    return func(x, *popt)
+    return fit
 
 
 def moving_average_filter(data: np.ndarray, window_size: int = 5) -> np.ndarray:
@@ -396,7 +437,9 @@ def wavelet_denoise(
 def detrend(data: np.ndarray) -> np.ndarray:
     """Remove bi-exponential trend along axis from data.
 
-    Fits the data to a bi-exponential decay function and removes the trend.
+    Fits the data to a bi-exponential decay function a * exp(-b * x) +
+    c * exp(-d * x) and removes the trend. Only the decay rates b and d are fitted
+    by variable projection.
 
     Args:
         data (np.ndarray): 1-D array data to be detrended.
@@ -404,22 +447,24 @@ def detrend(data: np.ndarray) -> np.ndarray:
         Detrended data. Same shape as input data.
     """
     x = np.arange(data.shape[0])
-    y = data
-
-    def func(x, a, b, c, d):
-        return a * np.exp(-b * x) + c * np.exp(-d * x)
 
-    popt, _ = optimize.curve_fit(
-        func,
-        x,
-        y,
-        p0=[1, 0.1, 1, 0.1],
+    def basis(rates: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        phi = np.exp(-np.outer(x, rates))
+        dphi = np.zeros((2, x.size, 2))
+        dphi[0, :, 0] = -x * phi[:, 0]
+        dphi[1, :, 1] = -x * phi[:, 1]
+        return phi, dphi
+
+    _, _, fit = _fit_separable(
+        basis,
+        data,
+        p0=np.array([10.0, 1.0]) / x.size,
         method="trf",
         ftol=1e-6,
         xtol=1e-6,
         max_nfev=600,
     )
-    return data - func(x, *popt)
+    return data - fit
 
 
 def find_peaks(data: np.ndarray, distance: int = 5) -> np.ndarray:
@@ -497,23 +542,27 @@ def find_high_low_indices(
             Value must be between 0 and 1 with 0 being taking only the found peaks and 1
             being taking all points between the peaks.
         same_length (bool): whether to force high and low bins are of the same length.
+        method (str): how to select the bins. PEAKS takes windows around the high
+            and low peaks, PHASE the bins of the cardiac phase at the high peaks and
+            half a cycle later, see find_bin_indices.
 
     Returns:
         Tuple of indices of high and low signal bins respectively.
     """
-    high_indices = np.array([])
-    low_indices = np.array([])
-
     if method == constants.BinningMethods.PEAKS:
         high_peaks = find_peaks(data=data, distance=int(0.6 * peak_distance))
         low_peaks = find_peaks(data=-data, distance=int(0.6 * peak_distance))
 
         left = np.ceil(peak_distance * distance_threshold / 2).astype(int)
-        right = left + 1
-        for peak in high_peaks:
-            high_indices = np.append(high_indices, np.arange(peak - left, peak + right))
-        for peak in low_peaks:
-            low_indices = np.append(low_indices, np.arange(peak - left, peak + right))
+        offsets = np.arange(-left, left + 1)
+        # windows around the peaks in peak order, overlapping windows repeat indices
+        high_indices = (high_peaks[:, np.newaxis] + offsets).ravel()
+        low_indices = (low_peaks[:, np.newaxis] + offsets).ravel()
+    elif method == constants.BinningMethods.PHASE:
+        # an even number of bins about as wide as the windows around the peaks
+        n_bins = 2 * max(int(0.5 / distance_threshold + 0.5), 1)
+        bins = find_bin_indices(data=data, peak_distance=peak_distance, n_bins=n_bins)
+        high_indices, low_indices = bins[0], bins[n_bins // 2]
     elif method == constants.BinningMethods.THRESHOLD:
         data_norm = (data - np.mean(data)) / np.std(data)
         high_indices = np.argwhere(data_norm > 0.7).flatten()
@@ -522,13 +571,44 @@ def find_high_low_indices(
         raise ValueError(f"Method {method} not implemented.")
 
     # remove indices that go are below zero and above length of the data
-    high_indices = np.delete(high_indices, np.argwhere(high_indices < 0))
-    low_indices = np.delete(low_indices, np.argwhere(low_indices < 0))
-    high_indices = np.delete(high_indices, np.argwhere(high_indices >= len(data)))
-    low_indices = np.delete(low_indices, np.argwhere(low_indices >= len(data)))
+    high_indices = high_indices[(high_indices >= 0) & (high_indices < len(data))]
+    low_indices = low_indices[(low_indices >= 0) & (low_indices < len(data))]
     if same_length:
         if len(high_indices) > len(low_indices):
             high_indices = high_indices[: len(low_indices)]
         elif len(low_indices) > len(high_indices):
             low_indices = low_indices[: len(high_indices)]
     return np.sort(high_indices).astype(int), np.sort(low_indices).astype(int)
+
+
+def find_bin_indices(
+    data: np.ndarray, peak_distance: int, n_bins: int
+) -> List[np.ndarray]:
+    """Find indices of n bins of the cardiac phase.
+
+    The phase of a point is its position between the high peaks before and after
+    it. The bins divide the cycle evenly, with bin 0 centered on the peaks. Points
+    before the first and after the last peak are not binned.
+
+    Args:
+        data (np.ndarray): RBC 1-D data of shape (n_projections,)
+        peak_distance (int): distance between peaks in number of points.
+        n_bins (int): number of bins.
+
+    Returns:
+        List of the sorted indices of each bin.
+    """
+    peaks = find_peaks(data=data, distance=int(0.6 * peak_distance))
+    bins = np.full(len(data), -1)
+    if peaks.size > 1:
+        indices = np.arange(peaks[0], peaks[-1] + 1)
+        # cycle of each point, the last peak closes the last cycle
+        is_peak = np.zeros(len(data), dtype=bool)
+        is_peak[peaks[:-1]] = True
+        cycle = np.cumsum(is_peak[indices]) - 1
+        offset = indices - peaks[cycle]
+        length = np.diff(peaks)[cycle]
+        bins[indices] = ((2 * n_bins * offset + length) // (2 * length)) % n_bins
+    order = np.argsort(bins, kind="stable")
+    counts = np.bincount(bins + 1, minlength=n_bins + 1)
+    return np.split(order, np.cumsum(counts)[:-1])[1:]
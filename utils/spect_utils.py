@@ -1,14 +1,30 @@
 """Spectroscopy util functions."""
+import copy
+import inspect
+import logging
 import math
+import multiprocessing
+import os
 import pdb
+import pickle
 import sys
+import threading
+import time
+from concurrent import futures
 
 sys.path.append("..")
-from typing import Any, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 
 import spect.nmr_timefit as fit
+from utils import checkpoint_utils, constants
+
+# static spectroscopy fits of this process by fingerprint of their inputs
+_STATIC_FITS: Dict[str, Tuple[float, Any]] = {}
+# guards the two dicts, while the lock of a key is held during its fit only
+_STATIC_FITS_LOCK = threading.Lock()
+_STATIC_FIT_KEY_LOCKS: Dict[str, threading.Lock] = {}
 
 
 def get_breathhold_indices(
@@ -59,7 +75,9 @@ def get_frequency_guess(
 ):
     """Get the three-peak initial frequency guess.
 
-    This can be modified in the future to include automated peak finding.
+    The guess is refined from the spectrum by NMR_TimeFit.guess_components. For
+    excitation frequencies other than 208 and 218 ppm, the nominal chemical shifts
+    of the RBC, membrane and gas resonances are used.
 
     Args:
         data (np.ndarray): FID data of shape (n_points, 1) or (n_points, ).
@@ -74,13 +92,13 @@ def get_frequency_guess(
     elif rf_excitation == 218:
         return np.array([0, -21.7, -218.0]) * center_freq
     else:
-        raise ValueError("Invalid excitation frequency {}".format(rf_excitation))
+        return (np.array([218.0, 196.3, 0.0]) - rf_excitation) * center_freq
 
 
 def get_area_guess(data: Optional[np.ndarray], center_freq: float, rf_excitation: int):
     """Get the three-peak initial area guess.
 
-    This can be modified in the future to include automated peak finding.
+    The guess is refined from the spectrum by NMR_TimeFit.guess_components.
 
     Args:
         data (np.ndarray): FID data of shape (n_points, 1) or (n_points, ).
@@ -90,12 +108,7 @@ def get_area_guess(data: Optional[np.ndarray], center_freq: float, rf_excitation
     Returns: 3-element array of initial area guesses corresponding to the RBC,
         membrane, and gas frequencys in MHz
     """
-    if rf_excitation == 208:
-        return np.array([1, 1, 1])
-    elif rf_excitation == 218:
-        return np.array([1, 1, 1])
-    else:
-        raise ValueError("Invalid excitation frequency {}".format(rf_excitation))
+    return np.array([1, 1, 1])
 
 
 def calculate_static_spectroscopy(
@@ -112,7 +125,9 @@ def calculate_static_spectroscopy(
     """Fit static spectroscopy data to Voigt model and extract RBC:M ratio.
 
     The RBC:M ratio is defined as the ratio of the fitted RBC peak area to the membrane
-    peak area.
+    peak area. The fit is memoised per process and persisted in the cache directory,
+    keyed by the FIDs, the fit parameters and the source of the fit model, so the
+    same spectroscopy is only fitted once.
     Args:
         fid (np.ndarray): Dissolved phase FIDs in format (n_points, n_frames).
         dwell_time (float): Dwell time in seconds.
@@ -125,8 +140,240 @@ def calculate_static_spectroscopy(
         plot (bool, optional): Plot the fit. Defaults to False.
 
     Returns:
-        Tuple of RBC:M ratio and fit object
+        Tuple of RBC:M ratio and fit object. The fit object is a copy of the
+        memoised fit, so callers may modify it.
+    """
+    key = checkpoint_utils.fingerprint(
+        [
+            inspect.getsource(fit),
+            inspect.getsource(sys.modules[fit.NMR_Mix.__module__]),
+            inspect.getsource(fit.voigt),
+            inspect.getsource(_fit_static_spectroscopy),
+            inspect.getsource(get_frequency_guess),
+            inspect.getsource(get_area_guess),
+            fid,
+            dwell_time,
+            tr,
+            center_freq,
+            rf_excitation,
+            n_avg,
+            n_avg_seconds,
+            method,
+        ]
+    )
+    path = os.path.join(get_static_fit_cache_dir(), key + ".pkl")
+    with _STATIC_FITS_LOCK:
+        key_lock = _STATIC_FIT_KEY_LOCKS.setdefault(key, threading.Lock())
+    # concurrent calls with the same inputs wait for the first fit, other fits run
+    with key_lock:
+        with _STATIC_FITS_LOCK:
+            result = _STATIC_FITS.get(key)
+        if result is None and os.path.exists(path):
+            logging.info("Loading static spectroscopy fit from cache.")
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+        elif result is None:
+            result = _fit_static_spectroscopy(
+                fid=fid,
+                dwell_time=dwell_time,
+                tr=tr,
+                center_freq=center_freq,
+                rf_excitation=rf_excitation,
+                n_avg=n_avg,
+                n_avg_seconds=n_avg_seconds,
+                method=method,
+            )
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                pickle.dump(result, f)
+            os.replace(tmp_path, path)
+        with _STATIC_FITS_LOCK:
+            _STATIC_FITS[key] = result
+    rbc_m_ratio, fit_obj = result[0], copy.deepcopy(result[1])
+    if plot:
+        fit_obj.plot_time_spect_fit()
+    return rbc_m_ratio, fit_obj
+
+
+def _fit_dynamic_windows(
+    ydata: np.ndarray,
+    tdata: np.ndarray,
+    initial_params: Dict[str, np.ndarray],
+    method: str,
+) -> Tuple[List[Dict[str, np.ndarray]], List[Tuple[int, int]]]:
+    """Fit consecutive FIDs, each starting from the fit of the previous one.
+
+    Args:
+        ydata (np.ndarray): FIDs of shape (n_points, n_fids).
+        tdata (np.ndarray): time points of the FIDs in seconds.
+        initial_params (Dict[str, np.ndarray]): initial guess of the first FID with
+            keys area, freq, fwhmL, fwhmG and phase.
+        method (str): fitting method.
+    Returns:
+        Tuple of the fitted parameters of each FID, and the number of residual
+        evaluations and alias refits of each FID.
+    """
+    params = []
+    stats = []
+    for i in range(ydata.shape[1]):
+        fit_obj = fit.NMR_TimeFit(
+            ydata=ydata[:, i],
+            tdata=tdata,
+            line_broadening=0,
+            zeropad_size=np.size(tdata),
+            method=method,
+            **(params[-1] if params else initial_params),
+        )
+        fit_obj.fit_time_signal_residual()
+        params.append(
+            {
+                constants.DynSpectFields.AREA: fit_obj.area,
+                constants.DynSpectFields.FREQ: fit_obj.freq,
+                constants.DynSpectFields.FWHML: fit_obj.fwhmL,
+                constants.DynSpectFields.FWHMG: fit_obj.fwhmG,
+                constants.DynSpectFields.PHASE: fit_obj.phase,
+            }
+        )
+        stats.append((fit_obj.nfev, fit_obj.n_alias_refits))
+    return params, stats
+
+
+def calculate_dynamic_spectroscopy(
+    fid: np.ndarray,
+    dwell_time: float,
+    tr: float,
+    center_freq: float,
+    rf_excitation: int,
+    n_avg: int = 1,
+    start_time: float = 2,
+    end_time: float = 10,
+    method: str = "voigt",
+    n_workers: int = 0,
+) -> Dict[str, np.ndarray]:
+    """Fit every FID, or a sliding average of FIDs, of the breath-hold.
+
+    The FIDs are split into contiguous chunks that are fitted in parallel processes.
+    The processes are spawned instead of forked, since the caller may be one of
+    several threads and a forked child could inherit a lock held by another thread.
+    The first FID of each chunk starts from the static spectroscopy fit and every
+    other FID from the fit of its predecessor, so consecutive fits only need a few
+    iterations.
+
+    Args:
+        fid (np.ndarray): dissolved phase FIDs in format (n_points, n_frames).
+        dwell_time (float): dwell time in seconds.
+        tr (float): repetition time in seconds.
+        center_freq (float): center frequency in MHz.
+        rf_excitation (int): excitation frequency in ppm.
+        n_avg (int): number of FIDs in the sliding average, 1 to fit each FID.
+        start_time (float): start of the breath-hold in seconds.
+        end_time (float): end of the breath-hold in seconds.
+        method (str): fitting method.
+        n_workers (int): number of processes. 0 to use all cpus.
+    Returns:
+        Dict[str, np.ndarray]: time series with the keys of constants.DynSpectFields.
+            The fitted parameters are of shape (n_windows, 3), the others of shape
+            (n_windows,).
+    Raises:
+        ValueError: if n_avg is not between 1 and the number of FIDs of the
+            breath-hold.
     """
+    t = np.arange(np.shape(fid)[0]) * dwell_time
+    t_tr = np.arange(np.shape(fid)[1]) * tr
+    start_ind, end_ind = get_breathhold_indices(
+        t=t_tr, start_time=start_time, end_time=end_time
+    )
+    n_fids = end_ind - start_ind
+    if not 1 <= n_avg <= n_fids:
+        raise ValueError(
+            "n_avg of the dynamic spectroscopy must be between 1 and the {} FIDs of "
+            "the breath-hold from {} s to {} s, got {}.".format(
+                n_fids, start_time, end_time, n_avg
+            )
+        )
+    # sliding average over n_avg FIDs, centered on the mean acquisition time
+    cumsum = np.cumsum(
+        np.pad(fid[:, start_ind:end_ind], ((0, 0), (1, 0))), axis=1, dtype=complex
+    )
+    ydata = (cumsum[:, n_avg:] - cumsum[:, :-n_avg]) / n_avg
+    t_windows = t_tr[start_ind : end_ind - n_avg + 1] + 0.5 * (n_avg - 1) * tr
+    n_windows = ydata.shape[1]
+
+    _, static_fit = calculate_static_spectroscopy(
+        fid=fid,
+        dwell_time=dwell_time,
+        tr=tr,
+        center_freq=center_freq,
+        rf_excitation=rf_excitation,
+        method=method,
+    )
+    initial_params = {
+        constants.DynSpectFields.AREA: static_fit.area,
+        constants.DynSpectFields.FREQ: static_fit.freq,
+        constants.DynSpectFields.FWHML: static_fit.fwhmL,
+        constants.DynSpectFields.FWHMG: static_fit.fwhmG,
+        constants.DynSpectFields.PHASE: static_fit.phase,
+    }
+    n_workers = max(1, min(n_workers or os.cpu_count() or 1, n_windows))
+    chunks = np.array_split(np.arange(n_windows), n_workers)
+    time_start = time.time()
+    if n_workers == 1:
+        results = [_fit_dynamic_windows(ydata, t, initial_params, method)]
+    else:
+        with futures.ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            results = list(
+                executor.map(
+                    _fit_dynamic_windows,
+                    [ydata[:, chunk] for chunk in chunks],
+                    [t] * n_workers,
+                    [initial_params] * n_workers,
+                    [method] * n_workers,
+                )
+            )
+    params = [param for result in results for param in result[0]]
+    stats = np.array([stat for result in results for stat in result[1]])
+    runtime = time.time() - time_start
+    logging.info(
+        "Fitted {} FIDs in {:.2f} s ({:.1f} FIDs/s), {:.1f} evaluations and {:.2f} "
+        "alias refits per FID.".format(
+            n_windows,
+            runtime,
+            n_windows / runtime,
+            np.mean(stats[:, 0]),
+            np.mean(stats[:, 1]),
+        )
+    )
+    out_dict = {
+        key: np.stack([param[key] for param in params])
+        for key in initial_params.keys()
+    }
+    area = out_dict[constants.DynSpectFields.AREA]
+    out_dict[constants.DynSpectFields.RBC_M_RATIO] = area[:, 0] / area[:, 1]
+    out_dict[constants.DynSpectFields.T] = t_windows
+    out_dict[constants.DynSpectFields.NFEV] = stats[:, 0]
+    out_dict[constants.DynSpectFields.N_ALIAS_REFITS] = stats[:, 1]
+    return out_dict
+
+
+def get_static_fit_cache_dir() -> str:
+    """Get the directory of the persisted static spectroscopy fits."""
+    return os.path.join(constants.CACHE_DIR, "spectroscopy")
+
+
+def _fit_static_spectroscopy(
+    fid: np.ndarray,
+    dwell_time: float,
+    tr: float,
+    center_freq: float,
+    rf_excitation: int,
+    n_avg: Optional[int],
+    n_avg_seconds: int,
+    method: str,
+) -> Tuple[float, Any]:
+    """Fit static spectroscopy data, see calculate_static_spectroscopy."""
     t = np.array(range(0, np.shape(fid)[0])) * dwell_time
     t_tr = np.array(range(0, np.shape(fid)[1])) * tr
 
@@ -155,6 +402,7 @@ def calculate_static_spectroscopy(
         zeropad_size=np.size(t),
         method=method,
     )
+    fit_obj.guess_components()
     lb = np.stack(
         (
             [-np.inf, -np.inf, -np.inf],
@@ -175,7 +423,10 @@ def calculate_static_spectroscopy(
     ).flatten()
     bounds = (lb, ub)
     fit_obj.fit_time_signal_residual(bounds=bounds)
-    if plot:
-        fit_obj.plot_time_spect_fit()
+    logging.info(
+        "Static spectroscopy fit in {} evaluations and {} alias refits.".format(
+            fit_obj.nfev, fit_obj.n_alias_refits
+        )
+    )
     rbc_m_ratio = fit_obj.area[0] / np.sum(fit_obj.area[1])
     return rbc_m_ratio, fit_obj
@@ -0,0 +1,68 @@
+"""Run pipeline stages as a dependency graph."""
+import logging
+import time
+from concurrent import futures
+from typing import Callable, Dict, List
+
+
+def run_dag(
+    stages: Dict[str, Callable],
+    dependencies: Dict[str, List[str]],
+    max_workers: int = 1,
+):
+    """Run stages concurrently on a thread pool, respecting their dependencies.
+
+    A stage is started as soon as all stages it depends on have finished.
+    Dependencies on stages that are not part of the run are ignored. Ready stages
+    are submitted in the order of the stages dict, so with max_workers=1 the stages
+    run sequentially in that order.
+
+    Args:
+        stages (Dict[str, Callable]): stage name and function without arguments, in
+            the preferred order of execution.
+        dependencies (Dict[str, List[str]]): names of the stages that each stage
+            depends on.
+        max_workers (int): number of stages to run at the same time.
+    Raises:
+        Exception: the exception of the first failed stage, in the order of the
+            stages dict. Stages that have not started yet are not run.
+    """
+    pending = {
+        name: set(dependencies.get(name, [])).intersection(stages) for name in stages
+    }
+    running = {}
+    done = set()
+    errors = {}
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if not errors:
+                for name in list(pending):
+                    if pending[name].issubset(done):
+                        running[executor.submit(_run_stage, name, stages[name])] = name
+                        del pending[name]
+            if not running:
+                break
+            finished, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    errors[name] = future.exception()
+                else:
+                    done.add(name)
+    if pending and not errors:
+        raise ValueError("Circular stage dependencies: {}".format(list(pending)))
+    for name in stages:
+        if name in errors:
+            raise errors[name]
+
+
+def _run_stage(name: str, stage: Callable):
+    """Run a single stage and log its runtime.
+
+    Args:
+        name (str): stage name.
+        stage (Callable): stage function without arguments.
+    """
+    time_start = time.time()
+    stage()
+    logging.info("Finished stage {} in {:.1f} s".format(name, time.time() - time_start))
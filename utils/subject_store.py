@@ -0,0 +1,265 @@
+"""Chunked, compressed HDF5 store of the subject attributes.
+
+Each array is written as its own gzip compressed, chunked dataset and each dict as
+a group, so a reader only decompresses the arrays it uses. Every dataset carries a
+content fingerprint, which lets the stage checkpoints fingerprint the store without
+reading it. Convert existing mat files with
+
+    python -m utils.subject_store path/to/subject.mat [...]
+"""
+import logging
+import os
+import sys
+from typing import Any, Dict, List
+
+import h5py
+import numpy as np
+
+sys.path.append("..")
+from utils import checkpoint_utils, constants, io_utils
+
+# arrays smaller than this are stored contiguous and uncompressed
+_MIN_COMPRESS_BYTES = 1024
+_COMPRESSION_LEVEL = 4
+_FINGERPRINT_ATTR = "fingerprint"
+
+
+def _to_array(value: Any) -> np.ndarray:
+    """Convert a value to an array that can be written to HDF5.
+
+    Args:
+        value (Any): array, number, string, bool or list of numbers or strings.
+    Returns:
+        np.ndarray: the value as an array, None if it cannot be stored.
+    """
+    if isinstance(value, str):
+        return np.array(value.encode(), dtype=h5py.string_dtype())
+    if isinstance(value, (np.ndarray, np.generic, int, float, complex, bool, list)):
+        array = np.asarray(value)
+        if array.dtype.kind == "U":
+            return np.char.encode(array).astype(h5py.string_dtype())
+        if array.dtype != object:
+            return array
+    return None
+
+
+def _write_group(group: h5py.Group, values: Dict[str, Any], prefix: str = ""):
+    """Write values into a group, one dataset or subgroup per key.
+
+    Args:
+        group (h5py.Group): group to write into.
+        values (Dict[str, Any]): names and values.
+        prefix (str): path of the group, for logging.
+    """
+    for key, value in values.items():
+        if isinstance(value, dict):
+            _write_group(group.create_group(key), value, prefix + key + "/")
+        else:
+            _write_dataset(group, key, value, prefix)
+
+
+def _write_dataset(group: h5py.Group, key: str, value: Any, prefix: str = ""):
+    """Write a value into a dataset of a group.
+
+    Args:
+        group (h5py.Group): group to write into.
+        key (str): name of the dataset.
+        value (Any): value, see _to_array.
+        prefix (str): path of the group, for logging.
+    """
+    array = _to_array(value)
+    if array is None:
+        logging.debug("Not storing {}{}".format(prefix, key))
+        return
+    if array.ndim > 0 and array.nbytes >= _MIN_COMPRESS_BYTES:
+        dataset = group.create_dataset(
+            key,
+            data=array,
+            chunks=True,
+            compression="gzip",
+            compression_opts=_COMPRESSION_LEVEL,
+            shuffle=True,
+        )
+    else:
+        dataset = group.create_dataset(key, data=array)
+    dataset.attrs[_FINGERPRINT_ATTR] = checkpoint_utils.fingerprint([value])
+
+
+def _update_group(group: h5py.Group, values: Dict[str, Any], prefix: str = ""):
+    """Rewrite the datasets of a group whose value changed.
+
+    Args:
+        group (h5py.Group): group to update.
+        values (Dict[str, Any]): names and values.
+        prefix (str): path of the group, for logging.
+    """
+    for key, value in values.items():
+        item = group.get(key)
+        if isinstance(value, dict):
+            if not isinstance(item, h5py.Group):
+                if item is not None:
+                    del group[key]
+                item = group.create_group(key)
+            _update_group(item, value, prefix + key + "/")
+            continue
+        if isinstance(item, h5py.Dataset) and item.attrs.get(
+            _FINGERPRINT_ATTR
+        ) == checkpoint_utils.fingerprint([value]):
+            continue
+        if item is not None:
+            del group[key]
+        logging.debug("Updating {}{}".format(prefix, key))
+        _write_dataset(group, key, value, prefix)
+
+
+def _read_dataset(dataset: h5py.Dataset) -> Any:
+    """Read a dataset into memory.
+
+    Args:
+        dataset (h5py.Dataset): dataset to read.
+    Returns:
+        Any: array, or a python scalar or string for scalar datasets.
+    """
+    if dataset.shape != () and h5py.check_string_dtype(dataset.dtype):
+        return np.array(dataset.asstr()[()], dtype=str)
+    value = dataset[()]
+    if isinstance(value, bytes):
+        return value.decode()
+    if dataset.shape == ():
+        return value.item()
+    return value
+
+
+def _read_group(group: h5py.Group) -> Dict[str, Any]:
+    """Read a group into a dict.
+
+    Args:
+        group (h5py.Group): group to read.
+    Returns:
+        Dict[str, Any]: names and values.
+    """
+    return {
+        key: _read_group(item) if isinstance(item, h5py.Group) else _read_dataset(item)
+        for key, item in group.items()
+    }
+
+
+def save(values: Dict[str, Any], path: str):
+    """Write values to a store, replacing the file atomically.
+
+    Values that are neither dicts, arrays, numbers nor strings, such as the config,
+    are skipped.
+
+    Args:
+        values (Dict[str, Any]): names and values.
+        path (str): path of the store file.
+    """
+    with h5py.File(path + ".tmp", "w") as f:
+        _write_group(f, values)
+    os.replace(path + ".tmp", path)
+
+
+def update(values: Dict[str, Any], path: str):
+    """Write the values that differ from the stored ones into a store in place.
+
+    Only changed datasets are rewritten, the others are neither read nor written.
+    Stored values that are not in values are kept.
+
+    Args:
+        values (Dict[str, Any]): names and values.
+        path (str): path of the store file.
+    """
+    with h5py.File(path, "a") as f:
+        _update_group(f, values)
+
+
+class SubjectStore(object):
+    """Read access to a subject store that loads one key at a time.
+
+    The file is only opened while a key is read, so the store can be rewritten
+    while it is in use.
+
+    Attributes:
+        path (str): path of the store file.
+    """
+
+    def __init__(self, path: str):
+        """Init object.
+
+        Args:
+            path (str): path of the store file.
+        """
+        self.path = path
+        with h5py.File(path, "r") as f:
+            self._keys = list(f.keys())
+
+    def keys(self) -> List[str]:
+        """Get the names of the stored values."""
+        return list(self._keys)
+
+    def __contains__(self, key: str) -> bool:
+        """Check whether a value is stored."""
+        return key in self._keys
+
+    def load(self, key: str) -> Any:
+        """Read a single value.
+
+        Args:
+            key (str): name of the value.
+        Returns:
+            Any: array, scalar, string, or dict for groups.
+        """
+        with h5py.File(self.path, "r") as f:
+            item = f[key]
+            if isinstance(item, h5py.Group):
+                return _read_group(item)
+            return _read_dataset(item)
+
+    def load_all(self) -> Dict[str, Any]:
+        """Read all values."""
+        with h5py.File(self.path, "r") as f:
+            return _read_group(f)
+
+    def fingerprint(self) -> str:
+        """Get the fingerprint of the store content without reading the data."""
+        fingerprints = []
+        with h5py.File(self.path, "r") as f:
+            f.visititems(
+                lambda name, item: fingerprints.append(
+                    (name, item.attrs.get(_FINGERPRINT_ATTR, ""))
+                )
+            )
+        return checkpoint_utils.fingerprint(sorted(fingerprints))
+
+
+def get_store_path(mat_path: str) -> str:
+    """Get the store path corresponding to a mat file.
+
+    Args:
+        mat_path (str): path of the mat file.
+    Returns:
+        str: path of the store file.
+    """
+    return os.path.splitext(mat_path)[0] + constants.SUBJECT_STORE_SUFFIX
+
+
+def convert_mat(mat_path: str, path: str = "") -> str:
+    """Convert the mat file of a subject to a store.
+
+    Args:
+        mat_path (str): path of the mat file.
+        path (str): path of the store file. Defaults to the mat file path with the
+            store suffix.
+    Returns:
+        str: path of the store file.
+    """
+    path = path or get_store_path(mat_path)
+    save(io_utils.import_subject_mat(mat_path), path)
+    logging.info("Converted {} to {}".format(mat_path, path))
+    return path
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for mat_path in sys.argv[1:]:
+        convert_mat(mat_path)
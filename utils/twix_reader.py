@@ -0,0 +1,189 @@
+"""Native reader of the image data of Siemens VD/VE twix files.
+
+mapVBVD parses every measurement data header into a table and then reads the ADC
+lines into a complex array through a generic sorting machinery. Our scans have a
+single image readout per line, so this reader walks the measurement data block of a
+memory mapped file directly: it decodes the 192 byte scan header of each line, skips
+non-image lines, and copies the samples behind each 32 byte channel header into a
+preallocated complex64 array. The XProtocol header is still parsed by mapVBVD.
+
+Files that need something this reader does not implement, such as VB files or
+ramp-sampling regridding, raise ValueError so the caller can fall back to mapVBVD.
+"""
+import struct
+from typing import Any, Tuple
+
+import numpy as np
+
+# layout of the VD/VE measurement data
+_SCAN_HEADER_BYTES = 192
+_CHANNEL_HEADER_BYTES = 32
+_RAID_ENTRY_BYTES = 152
+_EVAL_INFO_OFFSET = 40
+_SAMPLES_OFFSET = 48
+_COUNTERS_OFFSET = 52
+# loop counters in the scan header, in order
+N_COUNTERS = 14
+# bits of the low word of the eval info mask
+_ACQEND = 1 << 0
+_RTFEEDBACK = 1 << 1
+_HPFEEDBACK = 1 << 2
+_SYNCDATA = 1 << 5
+_REFPHASESTABSCAN = 1 << 14
+_PHASESTABSCAN = 1 << 15
+_PHASCOR = 1 << 21
+_PATREFSCAN = 1 << 22
+_PATREFANDIMASCAN = 1 << 23
+_REFLECT = 1 << 24
+_NOISEADJSCAN = 1 << 25
+_NOT_IMAGE = (
+    _ACQEND
+    | _RTFEEDBACK
+    | _HPFEEDBACK
+    | _SYNCDATA
+    | _REFPHASESTABSCAN
+    | _PHASESTABSCAN
+    | _PHASCOR
+    | _NOISEADJSCAN
+)
+
+
+def _is_image_scan(eval_info: int) -> bool:
+    """Check whether a line is an image line, following mapVBVD.
+
+    Args:
+        eval_info (int): low word of the eval info mask.
+    Returns:
+        bool: True if the line belongs to the image data.
+    """
+    if eval_info & _NOT_IMAGE:
+        return False
+    return not (eval_info & _PATREFSCAN and not eval_info & _PATREFANDIMASCAN)
+
+
+def needs_regrid(twix_obj: Any) -> bool:
+    """Check whether mapVBVD would regrid the ramp sampled readouts.
+
+    Args:
+        twix_obj: twix object returned from mapVBVD function, may be header only.
+    Returns:
+        bool: True if the protocol uses ramp-sampling regridding.
+    """
+    meas = twix_obj.hdr.Meas
+    return "alRegridMode" in meas and int(str(meas.alRegridMode).split(" ")[0]) > 1
+
+
+def read_image_lines(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Read the image lines of the last measurement in a VD/VE twix file.
+
+    Reflected lines are reversed, as mapVBVD does by default.
+
+    Args:
+        path (str): path of the twix file.
+    Returns:
+        Tuple of the lines of shape (n_lines, n_channels, n_points) in acquisition
+        order and their loop counters of shape (n_lines, N_COUNTERS).
+    Raises:
+        ValueError: if the file is not a VD/VE file or the lines differ in size in
+            a way that mapVBVD would not read consistently.
+    """
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    first_int, n_scans = struct.unpack_from("<II", data, 0)
+    if not (first_int < 10000 and n_scans <= 64):
+        raise ValueError("Not a VD/VE twix file.")
+    (meas_offset,) = struct.unpack_from(
+        "<Q", data, 16 + (n_scans - 1) * _RAID_ENTRY_BYTES
+    )
+    (header_length,) = struct.unpack_from("<I", data, meas_offset)
+    pos = meas_offset + header_length
+
+    positions = []
+    channel_strides = []
+    counters = []
+    reflected = []
+    shape = None
+    while pos + _SCAN_HEADER_BYTES <= data.size:
+        (flags_and_length,) = struct.unpack_from("<I", data, pos)
+        (eval_info,) = struct.unpack_from("<I", data, pos + _EVAL_INFO_OFFSET)
+        # the DMA length is stored in the lower 25 bits
+        dma_length = flags_and_length & 0x1FFFFFF
+        if eval_info & _ACQEND or dma_length == 0:
+            break
+        if eval_info & _SYNCDATA:
+            pos += dma_length
+            continue
+        n_points, n_channels = struct.unpack_from("<HH", data, pos + _SAMPLES_OFFSET)
+        if _is_image_scan(eval_info):
+            # like mapVBVD, read the number of points of the first line from every
+            # line, which only gives the same result for single channel data
+            if shape is None:
+                shape = (n_channels, n_points)
+            elif shape != (n_channels, n_points) and (
+                n_channels != 1 or shape[0] != 1 or n_points < shape[1]
+            ):
+                raise ValueError("Image lines of different sizes.")
+            positions.append(pos)
+            channel_strides.append(_CHANNEL_HEADER_BYTES + 8 * n_points)
+            counters.append(
+                struct.unpack_from(
+                    "<{}H".format(N_COUNTERS), data, pos + _COUNTERS_OFFSET
+                )
+            )
+            reflected.append(bool(eval_info & _REFLECT))
+        pos += _SCAN_HEADER_BYTES + (8 * n_points + _CHANNEL_HEADER_BYTES) * n_channels
+    if shape is None:
+        raise ValueError("No image lines found.")
+
+    n_channels, n_points = shape
+    lines = np.empty((len(positions), n_channels, n_points), dtype=np.complex64)
+    for i_line, (line_pos, channel_bytes) in enumerate(zip(positions, channel_strides)):
+        for i_channel in range(n_channels):
+            lines[i_line, i_channel] = np.frombuffer(
+                data,
+                dtype=np.complex64,
+                count=n_points,
+                offset=line_pos
+                + _SCAN_HEADER_BYTES
+                + i_channel * channel_bytes
+                + _CHANNEL_HEADER_BYTES,
+            )
+    reflected = np.array(reflected, dtype=bool)
+    lines[reflected] = lines[reflected][..., ::-1]
+    return lines, np.array(counters, dtype=np.uint16).reshape(-1, N_COUNTERS)
+
+
+def get_unsorted(lines: np.ndarray) -> np.ndarray:
+    """Arrange image lines like the squeezed mapVBVD image.unsorted().
+
+    Args:
+        lines (np.ndarray): lines of shape (n_lines, n_channels, n_points).
+    Returns:
+        np.ndarray: lines of shape (n_points, [n_channels,] n_lines).
+    """
+    return np.squeeze(np.transpose(lines))
+
+
+def get_sorted(lines: np.ndarray, counters: np.ndarray) -> np.ndarray:
+    """Arrange image lines like the squeezed mapVBVD image[""].
+
+    Only data with a single varying loop counter that enumerates the lines is
+    supported, such as the repetitions of the dynamic spectroscopy.
+
+    Args:
+        lines (np.ndarray): lines of shape (n_lines, n_channels, n_points).
+        counters (np.ndarray): loop counters of shape (n_lines, N_COUNTERS).
+    Returns:
+        np.ndarray: lines of shape (n_points, [n_channels,] n_lines) sorted by the
+            loop counter.
+    Raises:
+        ValueError: if the lines cannot be sorted by a single counter.
+    """
+    varying = np.flatnonzero(np.ptp(counters, axis=0))
+    if varying.size > 1:
+        raise ValueError("More than one loop counter varies.")
+    if varying.size == 1:
+        counter = counters[:, varying[0]]
+        if not np.array_equal(np.sort(counter), np.arange(len(lines))):
+            raise ValueError("Loop counter does not enumerate the lines.")
+        lines = lines[np.argsort(counter)]
+    return get_unsorted(lines)
@@ -1,4 +1,5 @@
 """Twix file util functions."""
+from __future__ import annotations
 
 import logging
 import pdb
@@ -6,13 +7,15 @@ import sys
 
 sys.path.append("..")
 import datetime
-from typing import Any, Dict
+from typing import TYPE_CHECKING, Any, Dict, Optional
 
-import mapvbvd
 import numpy as np
 
 from utils import constants
 
+if TYPE_CHECKING:
+    import mapvbvd
+
 
 def get_scan_date(twix_obj: mapvbvd._attrdict.AttrDict) -> str:
     """Get the scan date in MM-DD-YYYY format.
@@ -339,7 +342,9 @@ def get_protocol_name(twix_obj: mapvbvd._attrdict.AttrDict) -> str:
 
 
 def get_dyn_fids(
-    twix_obj: mapvbvd._attrdict.AttrDict, n_skip_end: int = 20
+    twix_obj: mapvbvd._attrdict.AttrDict,
+    n_skip_end: int = 20,
+    raw_fids: Optional[np.ndarray] = None,
 ) -> np.ndarray:
     """Get the dissolved phase FIDS used for dyn. spectroscopy from twix object.
 
@@ -347,14 +352,19 @@ def get_dyn_fids(
         twix_obj: twix object returned from mapVBVD function
         n_skip_end: number of fids to skip from the end. Usually they are calibration
             frames.
+        raw_fids: sorted image data in the layout of twix_obj.image[""], e.g. from
+            twix_reader. Read from the twix object if None.
     Returns:
         dissolved phase FIDs in shape (number of points in ray, number of projections).
     """
-    raw_fids = twix_obj.image[""].astype(np.cdouble)
-    return raw_fids[:, 0 : -(1 + n_skip_end)]
+    if raw_fids is None:
+        raw_fids = twix_obj.image[""]
+    return raw_fids[:, 0 : -(1 + n_skip_end)].astype(np.cdouble)
 
 
-def get_gx_data(twix_obj: mapvbvd._attrdict.AttrDict) -> Dict[str, Any]:
+def get_gx_data(
+    twix_obj: mapvbvd._attrdict.AttrDict, raw_fids: Optional[np.ndarray] = None
+) -> Dict[str, Any]:
     """Get the dissolved phase and gas phase FIDs from twix object.
 
     For reconstruction, we also need important information like the gradient delay,
@@ -363,6 +373,8 @@ def get_gx_data(twix_obj: mapvbvd._attrdict.AttrDict) -> Dict[str, Any]:
     is slightly different depending on the scanner.
     Args:
         twix_obj: twix object returned from mapVBVD function
+        raw_fids: image data in the layout of twix_obj.image.unsorted(), e.g. from
+            twix_reader. Read from the twix object if None.
     Returns:
         a dictionary containing
         1. dissolved phase FIDs in shape (number of projections,
@@ -376,7 +388,10 @@ def get_gx_data(twix_obj: mapvbvd._attrdict.AttrDict) -> Dict[str, Any]:
         7. gradient delay y in microseconds.
         8. gradient delay z in microseconds.
     """
-    raw_fids = np.transpose(twix_obj.image.unsorted().astype(np.cdouble))
+    if raw_fids is None:
+        raw_fids = twix_obj.image.unsorted()
+    # keep the single precision raw data until the FIDs are selected
+    raw_fids = np.transpose(raw_fids)
     flip_angle_dissolved = get_flipangle_dissolved(twix_obj)
     # get the scan date
     scan_date = get_scan_date(twix_obj=twix_obj)
@@ -449,8 +464,8 @@ def get_gx_data(twix_obj: mapvbvd._attrdict.AttrDict) -> Dict[str, Any]:
             grad_delay_x, grad_delay_y, grad_delay_z = 0, -4, -3
         elif raw_fids.shape[0] == 2000:
             logging.info("Reading in normal dixon on Siemens Trio 2007 or 2008.")
-            data_gas = raw_fids[0::2, :] * np.exp(1j * np.pi / 2)
-            data_dis = raw_fids[1::2, :] * np.exp(1j * np.pi / 2)
+            data_gas = raw_fids[0::2, :].astype(np.cdouble) * np.exp(1j * np.pi / 2)
+            data_dis = raw_fids[1::2, :].astype(np.cdouble) * np.exp(1j * np.pi / 2)
             n_frames = 1000
             n_skip_start = 0
             n_skip_end = 0
@@ -460,8 +475,8 @@ def get_gx_data(twix_obj: mapvbvd._attrdict.AttrDict) -> Dict[str, Any]:
     else:
         raise ValueError("Cannot get data from twix object.")
     return {
-        constants.IOFields.FIDS_GAS: data_gas,
-        constants.IOFields.FIDS_DIS: data_dis,
+        constants.IOFields.FIDS_GAS: np.ascontiguousarray(data_gas, dtype=np.cdouble),
+        constants.IOFields.FIDS_DIS: np.ascontiguousarray(data_dis, dtype=np.cdouble),
         constants.IOFields.N_FRAMES: n_frames,
         constants.IOFields.N_SKIP_START: n_skip_start,
         constants.IOFields.N_SKIP_END: n_skip_end,
@@ -471,7 +486,9 @@ def get_gx_data(twix_obj: mapvbvd._attrdict.AttrDict) -> Dict[str, Any]:
     }
 
 
-def get_ute_data(twix_obj: mapvbvd._attrdict.AttrDict) -> Dict[str, Any]:
+def get_ute_data(
+    twix_obj: mapvbvd._attrdict.AttrDict, raw_fids: Optional[np.ndarray] = None
+) -> Dict[str, Any]:
     """Get the UTE FIDs from twix object.
 
     For reconstruction, we also need important information like the gradient delay,
@@ -480,6 +497,8 @@ def get_ute_data(twix_obj: mapvbvd._attrdict.AttrDict) -> Dict[str, Any]:
     is slightly different depending on the scanner.
     Args:
         twix_obj: twix object returned from mapVBVD function
+        raw_fids: image data in the layout of twix_obj.image.unsorted(), e.g. from
+            twix_reader. Read from the twix object if None.
     Returns:
         a dictionary containing
         1. UTE FIDs in shape (number of projections,
@@ -489,13 +508,15 @@ def get_ute_data(twix_obj: mapvbvd._attrdict.AttrDict) -> Dict[str, Any]:
         4. gradient delay y in microseconds.
         5. gradient delay z in microseconds.
     """
-    raw_fids = twix_obj.image.unsorted().astype(np.cdouble)
+    if raw_fids is None:
+        raw_fids = twix_obj.image.unsorted()
 
     if raw_fids.ndim == 3:
         data = np.transpose(np.squeeze(raw_fids[:, 0, :]))
         data = data[:4600, :]
     else:
         data = np.transpose(raw_fids)
+    data = np.ascontiguousarray(data, dtype=np.cdouble)
 
     return {
         constants.IOFields.FIDS: data,